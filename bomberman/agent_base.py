@@ -1,16 +1,28 @@
 import asyncio
+import collections
 import os
+import time
 import typing
 
 from components.environment.state import GameState
+from components.utils.log import WARNING, get_logger
+
+log = get_logger("agent")
 
 GAME_CONNECTION_URI = os.environ.get(
     'GAME_CONNECTION_STRING') or "ws://127.0.0.1:3000/?role=agent&agentId=agentId&name=defaultName"
 
+# Actions have to reach the engine before its next tick
+TICK_DEADLINE_SECONDS = 1.0 / float(os.environ.get('TICK_RATE_HZ') or 10)
+TICK_LATENCY_WINDOW = 100
+
 
 class Agent():
     def __init__(self, model = None):
         self._model = model
+        # seconds from receiving each tick to sending its last action, for the last TICK_LATENCY_WINDOW ticks
+        self.tick_latencies = collections.deque(maxlen=TICK_LATENCY_WINDOW)
+        self.missed_deadlines = 0
         self._client = GameState(GAME_CONNECTION_URI)
         self._client.set_game_tick_callback(self._on_game_tick)
 
@@ -90,25 +102,46 @@ class Agent():
 
         return action
 
+    async def _make_actions(self, game_state, my_agent_id: str, my_unit_ids: typing.List[str]) -> typing.List[str]:
+        # Agents able to act for all units at once (e.g. one batched forward pass) override this
+        return await asyncio.gather(*(self._make_action(game_state, my_agent_id, my_unit_id) for my_unit_id in my_unit_ids))
+
+    def _action_packet(self, action: str, my_unit_id: str) -> typing.Dict or None:
+        if action in ["up", "left", "right", "down"]:
+            return self._client.move_packet(action, my_unit_id)
+        elif action == "bomb":
+            return self._client.bomb_packet(my_unit_id)
+        elif action == "detonate":
+            bomb_coordinates = self._get_bomb_to_detonate(my_unit_id)
+            if bomb_coordinates != None:
+                x, y = bomb_coordinates
+                return self._client.detonate_packet(x, y, my_unit_id)
+        elif action == "idle":
+            # no-op
+            pass
+        else:
+            log.warning("unhandled_action", action=action, unit_id=my_unit_id)
+        return None
+
+    """
+    Computes the actions of all units first, then sends their packets
+    together, and records the time from receiving the tick to sending the
+    last packet.
+    """
     async def _on_game_tick(self, tick_number, game_state):
+        received_at = self._client.message_received_at or time.perf_counter()
 
         my_agent_id = game_state.get("connection").get("agent_id")
         my_units = game_state.get("agents").get(my_agent_id).get("unit_ids")
 
-        for my_unit_id in my_units:
-            action = await self._make_action(game_state, my_agent_id, my_unit_id)
-
-            if action in ["up", "left", "right", "down"]:
-                await self._client.send_move(action, my_unit_id)
-            elif action == "bomb":
-                await self._client.send_bomb(my_unit_id)
-            elif action == "detonate":
-                bomb_coordinates = self._get_bomb_to_detonate(my_unit_id)
-                if bomb_coordinates != None:
-                    x, y = bomb_coordinates
-                    await self._client.send_detonate(x, y, my_unit_id)
-            elif action == "idle":
-                # no-op
-                continue 
-            else:
-                print(f"Unhandled action: {action} for unit {my_unit_id}")
+        actions = await self._make_actions(game_state, my_agent_id, my_units)
+
+        packets = [self._action_packet(action, my_unit_id) for my_unit_id, action in zip(my_units, actions)]
+        await self._client.send_packets([packet for packet in packets if packet is not None])
+
+        latency = time.perf_counter() - received_at
+        self.tick_latencies.append(latency)
+        if latency > TICK_DEADLINE_SECONDS:
+            self.missed_deadlines += 1
+            log.throttled(WARNING, "missed_tick_deadline", 1.0, tick=tick_number, latency_ms=round(latency * 1000, 1),
+                          deadline_ms=round(TICK_DEADLINE_SECONDS * 1000), missed=self.missed_deadlines)
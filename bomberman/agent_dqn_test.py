@@ -1,5 +1,6 @@
 import time
 import torch
+import typing
 
 from agent_base import Agent
 from components.environment.config import (
@@ -8,15 +9,21 @@ from components.environment.config import (
     FWD_MODEL_CONNECTION_RETRIES,
 )
 from components.models.dqn import DQN_AGENT_PATH 
-from components.state import observation_to_state
+from components.state import STATE_ENCODINGS
 
 
 class DQNAgent(Agent):
-    async def _make_action(self, game_state, my_agent_id: str, my_unit_id: str):
-        state = observation_to_state(game_state, current_agent_id=my_agent_id, current_unit_id=my_unit_id)
-        action, *_ = self._model(state)
-        action = ACTIONS[int(action.item())]
-        return action
+    async def _make_actions(self, game_state, my_agent_id: str, my_unit_ids: typing.List[str]):
+        # models saved before spatial states existed have no state_encoding
+        state_encoding = getattr(self._model, "state_encoding", "flat")
+        if state_encoding == "flat":
+            # the game client keeps the flat encoding up to date tick by tick
+            states = self._client.encode_states(my_agent_id, my_unit_ids)
+        else:
+            states = STATE_ENCODINGS[state_encoding].encode_batch(game_state, current_agent_id=my_agent_id, current_unit_ids=my_unit_ids)
+        with torch.no_grad():
+            q_values = self._model(states)
+        return [ACTIONS[action] for action in q_values.argmax(dim=1).tolist()]
 
 
 def main():
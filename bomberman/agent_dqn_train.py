@@ -1,8 +1,12 @@
 import asyncio
+import contextlib
+import copy
 import datetime
 import math
 import random
+import threading
 import time
+import typing
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -12,20 +16,28 @@ from components.environment.config import (
     ACTIONS,
     FWD_MODEL_CONNECTION_DELAY,
     FWD_MODEL_CONNECTION_RETRIES, 
+    FWD_MODEL_LOCAL,
     FWD_MODEL_URI, 
+    OBSERVATION_CACHE_SIZE,
 )
-from components.environment.gym import Gym, GymEnv
+from components.environment.gym import Gym, VecGymEnv
+from components.environment.local_forward_model import LocalGym
 from components.environment.mocks import MOCK_15x15_INITIAL_OBSERVATION
-from components.models.dqn import DQNAgent, ReplayMemory, Transition
+from components.models.dqn import DQNAgent, PrioritizedReplayMemory, ReplayMemory, SoftUpdate, make_dqn_agent
 from components.action import make_action
 from components.reward import calculate_reward
 from components.state import (
-    action_dimensions, 
-    state_dimensions, 
-    observation_to_state
+    STATE_ENCODINGS,
+    action_dimensions,
+    compact_state_shape,
 )
 from components.types import State
+from components.utils.cache import set_observation_cache_size
 from components.utils.device import device
+from components.utils.log import flush_metrics, get_logger
+from components.utils.profiling import Profiler
+
+log = get_logger("dqn_train")
 
 """
 Simulation of two agents playing one againts the other.
@@ -43,58 +55,78 @@ BATCH_SIZE = 128
 LEARNING_RATE = 0.0003
 GAMMA = 0.99
 TAU = 0.005
+TARGET_UPDATE_EVERY = 1 # soft update the target network every N optimization steps
 EPS_MIN = 0.05
 EPS_MAX = 0.3
 EPS_DECAY = 1000
-PRINT_EVERY = 100
+PRINT_EVERY = 100 # steps between step records in the log
+REPLAY_MEMORY_SIZE = 1000000 # transitions at most, see replay_memory_capacity
+REPLAY_MEMORY_BYTES = 2 * 1024 ** 3 # budget for the stored states, preallocated before the first step
+PRIORITIZED_REPLAY = True
+PRIORITY_ALPHA = 0.6
+PRIORITY_BETA = 0.4
+NUM_ENVS = 8 # environments stepped together over one forward-model connection
+DECOUPLED_LEARNER = True # optimize in a learner thread while the actor keeps stepping the environments
+UPDATE_TO_DATA_RATIO = 0.25 # learner optimization steps per transition pushed by the actor, at most
+WEIGHT_SYNC_EVERY = 10 # optimization steps between copies of the policy into the actor's network
+STATE_ENCODING = "flat" # "flat" binary vectors for an MLP or "spatial" [C, H, W] planes for a CNN, ~320k transitions fit in REPLAY_MEMORY_BYTES
+PROFILE = True # time the phases of every training step
+PROFILE_EVERY = 1000 # steps between timing summaries appended to PROFILE_PATH
+PROFILE_PATH = "agent_dqn_profile.csv"
 
 """
-Epsilon-greedy action selection.
+Epsilon-greedy action selection for the same unit in every environment, with
+one forward pass over the batch of their states.
 """
-def select_action(agent: DQNAgent, state: State, steps_done: int, verbose: bool = True):
+def select_actions(agent: DQNAgent, states: typing.List[State], steps_done: int):
 
     agent_id = AGENTS[steps_done % 2]
     unit_id = UNITS[steps_done % 6]
     
-    if verbose:
-        print(f"Agent: {agent_id}, Unit: {unit_id}")
+    log.debug("select_action", agent_id=agent_id, unit_id=unit_id)
 
     eps_threshold = EPS_MIN + (EPS_MAX - EPS_MIN) * \
         math.exp(-1. * steps_done / EPS_DECAY)
 
-    if random.random() <= eps_threshold:
-        action = random.randrange(len(ACTIONS))
-    else:
-        with torch.no_grad():
-            probs = agent(state)
-            action = torch.argmax(probs)
+    with torch.no_grad():
+        greedy_actions = torch.argmax(agent(torch.stack(states)), dim=1).tolist()
 
-    action = torch.tensor(action, dtype=torch.int64).reshape(1)
+    actions = [
+        torch.tensor(random.randrange(len(ACTIONS)) if random.random() <= eps_threshold else greedy_action, dtype=torch.int64).reshape(1)
+        for greedy_action in greedy_actions
+    ]
 
-    return action, (agent_id, unit_id)
+    return actions, (agent_id, unit_id)
+
+"""
+Transitions the replay memory holds: REPLAY_MEMORY_SIZE, or fewer when their
+states and next states (stored compacted) would not fit in REPLAY_MEMORY_BYTES.
+Packed flat states take 228 bytes a transition on 15x15, spatial ones 2 * C * H * W (6750).
+"""
+def replay_memory_capacity(state_dim) -> int:
+    bytes_per_transition = 2 * math.prod(compact_state_shape(state_dim))
+    return min(REPLAY_MEMORY_SIZE, REPLAY_MEMORY_BYTES // bytes_per_transition)
 
 """
 Optimize memory samples.
 """
-def optimize_model(policy_net: DQNAgent, target_net: DQNAgent, optimizer, memory: ReplayMemory):
-    if len(memory) < BATCH_SIZE:
-        return
-
-    transitions = memory.sample(BATCH_SIZE)
-    # Transpose the batch (see https://stackoverflow.com/a/19343/3343043 for
-    # detailed explanation). This converts batch-array of Transitions
-    # to Transition of batch-arrays.
-    batch = Transition(*zip(*transitions))
-
-    # Compute a mask of non-final states and concatenate the batch elements
-    # (a final state would've been the one after which simulation ended)
-    non_final_mask = torch.tensor(tuple(map(lambda s: s is not None,
-                                          batch.next_state)), device=device, dtype=torch.bool)
-    non_final_next_states = torch.stack([s for s in batch.next_state
-                                                 if s is not None])
-    state_batch = torch.stack(batch.state)
-    action_batch = torch.stack(batch.action)
-    reward_batch = torch.stack(batch.reward)
+def optimize_model(policy_net: DQNAgent, target_net: DQNAgent, optimizer, memory: ReplayMemory, memory_lock: typing.Optional[threading.Lock] = None):
+    memory_lock = memory_lock or contextlib.nullcontext()
+    with memory_lock:
+        if len(memory) < BATCH_SIZE:
+            return
+        if isinstance(memory, PrioritizedReplayMemory):
+            batch, indices, weights = memory.sample(BATCH_SIZE, device)
+        else:
+            batch, indices, weights = memory.sample(BATCH_SIZE, device), None, None
+
+    # Mask of non-final states (a final state would've been the one after
+    # which simulation ended)
+    non_final_mask = ~batch.done
+    non_final_next_states = batch.next_state[non_final_mask]
+    state_batch = batch.state
+    action_batch = batch.action
+    reward_batch = batch.reward
 
     # Compute Q(s_t, a) - the model computes Q(s_t), then we select the
     # columns of actions taken. These are the actions which would've been taken
@@ -112,9 +144,15 @@ def optimize_model(policy_net: DQNAgent, target_net: DQNAgent, optimizer, memory
     # Compute the expected Q values
     expected_state_action_values = (next_state_values * GAMMA) + reward_batch
 
-    # Compute Huber loss
-    criterion = nn.SmoothL1Loss()
-    loss = criterion(state_action_values, expected_state_action_values.unsqueeze(1))
+    # Compute Huber loss, weighted by importance sampling for prioritized samples
+    criterion = nn.SmoothL1Loss(reduction='none')
+    losses = criterion(state_action_values, expected_state_action_values.unsqueeze(1)).squeeze(1)
+    loss = losses.mean() if weights is None else (losses * weights).mean()
+
+    if indices is not None:
+        td_errors = (state_action_values.squeeze(1) - expected_state_action_values).detach()
+        with memory_lock:
+            memory.update_priorities(indices, td_errors.cpu().numpy())
 
     # Optimize the model
     optimizer.zero_grad()
@@ -124,61 +162,181 @@ def optimize_model(policy_net: DQNAgent, target_net: DQNAgent, optimizer, memory
     optimizer.step()
 
 
-async def train(env: GymEnv, policy_net: DQNAgent, target_net: DQNAgent, optimizer, memory: ReplayMemory):
+"""
+Learner side of the decoupled training mode: a thread that keeps optimizing
+the policy on replayed batches while the actor (the asyncio training loop)
+steps the environments with its own copy of the policy.
+
+The learner never runs more than `update_to_data_ratio` optimization steps
+per pushed transition, and copies the policy into the actor's network every
+`sync_every` steps. Torch releases the GIL while it computes, so optimizing
+overlaps with the actor waiting on the forward model.
+
+When an optimization step raises, the thread stops and the next `push` (or
+`stop`) raises a RuntimeError from it, so training does not go on without
+learning.
+"""
+class Learner:
+    def __init__(self, policy_net: DQNAgent, target_net: DQNAgent, optimizer, memory: ReplayMemory, update_to_data_ratio: float, sync_every: int, profiler: typing.Optional[Profiler] = None):
+        self.policy_net = policy_net
+        self.target_net = target_net
+        self.actor_net = copy.deepcopy(policy_net)
+        self.optimizer = optimizer
+        self.memory = memory
+        self.update_to_data_ratio = update_to_data_ratio
+        self.sync_every = sync_every
+        self.profiler = profiler or Profiler(enabled=False)
+        self.soft_update = SoftUpdate(target_net, policy_net, TAU, TARGET_UPDATE_EVERY)
+        self.memory_lock = threading.Lock()
+        self.weights_lock = threading.Lock()
+        self.transitions = 0
+        self.updates = 0
+        self._data_pushed = threading.Condition()
+        self._stopped = False
+        self._error: typing.Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="dqn-learner", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._data_pushed:
+            self._stopped = True
+            self._data_pushed.notify()
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("the learner thread failed") from self._error
+
+    def push(self, *transition):
+        self._raise_error()
+        with self.memory_lock:
+            self.memory.push(*transition)
+        with self._data_pushed:
+            self.transitions += 1
+            self._data_pushed.notify()
+
+    def _can_update(self) -> bool:
+        return len(self.memory) >= BATCH_SIZE and self.updates < self.update_to_data_ratio * self.transitions
+
+    def _run(self):
+        try:
+            self._optimize()
+        except BaseException as error:
+            self._error = error
+
+    def _optimize(self):
+        while True:
+            with self._data_pushed:
+                self._data_pushed.wait_for(lambda: self._stopped or self._can_update())
+                if self._stopped:
+                    return
+            with self.profiler.phase("optimize_model"):
+                optimize_model(self.policy_net, self.target_net, self.optimizer, self.memory, self.memory_lock)
+            with self.profiler.phase("target_update"):
+                self.soft_update()
+            self.updates += 1
+            if self.updates % self.sync_every == 0:
+                with self.weights_lock:
+                    self.actor_net.load_state_dict(self.policy_net.state_dict())
+
+
+"""
+Without a learner every vector step is followed by one optimization step;
+with one, transitions are handed to the learner thread and actions come from
+its periodically synced actor network.
+
+The phases of every step are timed by `profiler` (optimization and target
+updates by the learner's, when there is one).
+"""
+async def train(env: VecGymEnv, policy_net: DQNAgent, target_net: DQNAgent, optimizer, memory: ReplayMemory, learner: typing.Optional[Learner] = None, profiler: typing.Optional[Profiler] = None):
     cumulative_rewards = []
+    soft_update = SoftUpdate(target_net, policy_net, TAU, TARGET_UPDATE_EVERY)
+    acting_net = policy_net if learner is None else learner.actor_net
+    weights_lock = contextlib.nullcontext() if learner is None else learner.weights_lock
+    push = memory.push if learner is None else learner.push
+    encode = STATE_ENCODINGS[STATE_ENCODING].encode
+    profiler = profiler or Profiler(enabled=False)
 
     for epoch in range(EPOCHS):
-        print(f"Started {epoch} epoch...")
+        log.info("epoch_started", epoch=epoch)
         cumulative_reward = 0
 
-        # Initialize the environment and get it's state
-        prev_observation = await env.reset()
-        prev_state = observation_to_state(prev_observation, current_agent_id='a', current_unit_id='c')
+        # Initialize the environments and get their states
+        prev_observations = await env.reset()
+        with profiler.phase("observation_to_state"):
+            prev_states = [
+                encode(prev_observation, current_agent_id='a', current_unit_id='c')
+                for prev_observation in prev_observations
+            ]
 
-        # Iterate and gather experience
+        # Iterate and gather experience from all environments at once
         for steps_done in range(STEPS):
-            action, (agent_id, unit_id) = select_action(policy_net, prev_state, steps_done)
-            action_or_idle = make_action(prev_observation, agent_id, unit_id, action=int(action.item()))
-            action_is_idle = action_or_idle is None
-
-            if action_is_idle:
-                next_observation, done, info = await env.step([])
+            with profiler.phase("select_action"), weights_lock:
+                actions, (agent_id, unit_id) = select_actions(acting_net, prev_states, steps_done)
+            with profiler.phase("make_action"):
+                env_actions = []
+                for action, prev_observation in zip(actions, prev_observations):
+                    action_or_idle = make_action(prev_observation, agent_id, unit_id, action=int(action.item()))
+                    env_actions.append([] if action_or_idle is None else [action_or_idle])
+
+            with profiler.phase("env_step"):
+                next_observations, dones, infos = await env.step(env_actions)
+
+            next_states, rewards = [], []
+            for i in range(env.num_envs):
+                with profiler.phase("calculate_reward"):
+                    reward = calculate_reward(prev_observations[i], next_observations[i], current_agent_id=agent_id, current_unit_id=unit_id)
+                with profiler.phase("observation_to_state"):
+                    next_state = encode(next_observations[i], current_agent_id=agent_id, current_unit_id=unit_id)
+
+                # Store the transition in memory
+                push(prev_states[i], actions[i], next_state, reward, dones[i])
+                next_states.append(next_state)
+
+                # Compute statistics
+                rewards.append(reward.item())
+                cumulative_reward += reward.item()
+
+                if dones[i]:
+                    log.info("episode_done", env=i, step=steps_done)
+
+            if learner is None:
+                # Perform one step of the optimization (on the policy network)
+                with profiler.phase("optimize_model"):
+                    optimize_model(policy_net, target_net, optimizer, memory)
+
+                # Soft update of the target network's weights
+                # θ′ ← τ θ + (1 −τ )θ′
+                with profiler.phase("target_update"):
+                    soft_update()
+
+            # Finished environments were reset, continue from their initial state
+            prev_observations = env.observations
+            if any(dones):
+                with profiler.phase("observation_to_state"):
+                    prev_states = [
+                        encode(prev_observations[i], current_agent_id=agent_id, current_unit_id=unit_id) if dones[i] else next_states[i]
+                        for i in range(env.num_envs)
+                    ]
             else:
-                next_observation, done, info = await env.step([action_or_idle])
-
-            reward = calculate_reward(prev_observation, next_observation, current_agent_id=agent_id, current_unit_id=unit_id)
-            next_state = observation_to_state(next_observation, current_agent_id=agent_id, current_unit_id=unit_id)
-
-            # Store the transition in memory
-            memory.push(prev_state, action, next_state, reward)
-
-            # Perform one step of the optimization (on the policy network)
-            optimize_model(policy_net, target_net, optimizer, memory)
-
-            # Soft update of the target network's weights
-            # θ′ ← τ θ + (1 −τ )θ′
-            target_net_state_dict = target_net.state_dict()
-            policy_net_state_dict = policy_net.state_dict()
-            for key in policy_net_state_dict:
-                target_net_state_dict[key] = policy_net_state_dict[key]*TAU + target_net_state_dict[key]*(1-TAU)
-            target_net.load_state_dict(target_net_state_dict)
-
-            prev_state = next_state
-            prev_observation = next_observation
-
-            # Compute statistics
-            cumulative_reward += reward.item()
+                prev_states = next_states
+            profiler.step()
 
             if steps_done % PRINT_EVERY == 0:
-                print(f"Action: {action}")
-                print(f"Reward: {reward}, Done: {done}, Info: {info}, Observation: {next_observation}")
-
-            if done:
-                print(f"Agent achieved the goal during step {steps_done}")
-                break
+                log.info("step", step=steps_done, actions=[action.item() for action in actions], mean_reward=sum(rewards) / len(rewards), rewards=rewards, dones=dones, info=infos[0])
+                log.debug("observation", step=steps_done, observation=next_observations[0])
 
         # Compute statistics
         cumulative_rewards.append(cumulative_reward)
+        log.info("epoch_finished", epoch=epoch, cumulative_reward=cumulative_reward)
+        flush_metrics()
+
+    print("Time per phase over the whole training:")
+    profiler.print_summary()
+    profiler.export()
     
     print("Drawing plot: reward distribution over epochs")
     epochs = range(1, EPOCHS + 1) 
@@ -195,7 +353,7 @@ async def main():
     print("============================================================================================")
     print("DQN agent")
     print("Connecting to gym")
-    gym = Gym(FWD_MODEL_URI)
+    gym = LocalGym() if FWD_MODEL_LOCAL else Gym(FWD_MODEL_URI)
     for retry in range(1, FWD_MODEL_CONNECTION_RETRIES):
         try:
             await gym.connect()
@@ -209,25 +367,40 @@ async def main():
 
     print("============================================================================================")
     print("Initializing agent")
-    env = gym.make("bomberland-gym", MOCK_15x15_INITIAL_OBSERVATION)
-    observation = await env.reset()
-    n_states = state_dimensions(observation)
+    env = gym.make_vec("bomberland-gym", MOCK_15x15_INITIAL_OBSERVATION, NUM_ENVS)
+    # every step's observations are read again as the previous ones of the next step
+    set_observation_cache_size(max(OBSERVATION_CACHE_SIZE, 2 * NUM_ENVS))
+    observations = await env.reset()
+    n_states = STATE_ENCODINGS[STATE_ENCODING].dimensions(observations[0])
     n_actions = action_dimensions()
     print(f"Agent: states = {n_states}, actions = {n_actions}")
 
-    policy_net = DQNAgent(n_states, n_actions)
-    target_net = DQNAgent(n_states, n_actions)
+    policy_net = make_dqn_agent(n_states, n_actions)
+    target_net = make_dqn_agent(n_states, n_actions)
     target_net.load_state_dict(policy_net.state_dict())
 
     optimizer = optim.AdamW(policy_net.parameters(), lr=LEARNING_RATE, amsgrad=True)
-    memory = ReplayMemory(8192)
+    memory_capacity = replay_memory_capacity(n_states)
+    print(f"Replay memory: {memory_capacity} transitions")
+    if PRIORITIZED_REPLAY:
+        memory = PrioritizedReplayMemory(memory_capacity, n_states, PRIORITY_ALPHA, PRIORITY_BETA)
+    else:
+        memory = ReplayMemory(memory_capacity, n_states)
     print("============================================================================================")
 
     print("============================================================================================")
     print("Training agent")
     start_time = datetime.datetime.now().replace(microsecond=0)
     print("Started training at (GMT) : ", start_time)
-    await train(env, policy_net, target_net, optimizer, memory)
+    profiler = Profiler(PROFILE_PATH, PROFILE_EVERY, enabled=PROFILE)
+    if DECOUPLED_LEARNER:
+        learner = Learner(policy_net, target_net, optimizer, memory, UPDATE_TO_DATA_RATIO, WEIGHT_SYNC_EVERY, profiler)
+        learner.start()
+        await train(env, policy_net, target_net, optimizer, memory, learner, profiler)
+        learner.stop()
+        print(f"Learner: {learner.updates} updates for {learner.transitions} transitions")
+    else:
+        await train(env, policy_net, target_net, optimizer, memory, profiler=profiler)
     end_time = datetime.datetime.now().replace(microsecond=0)
     print("Started training at (GMT) : ", start_time)
     print("Finished training at (GMT) : ", end_time)
@@ -6,19 +6,25 @@ import matplotlib.pyplot as plt
 from components.environment.config import (
     FWD_MODEL_CONNECTION_DELAY,
     FWD_MODEL_CONNECTION_RETRIES, 
+    FWD_MODEL_LOCAL,
     FWD_MODEL_URI,  
 )
 from components.environment.gym import Gym, GymEnv
+from components.environment.local_forward_model import LocalGym
 from components.environment.mocks import MOCK_15x15_INITIAL_OBSERVATION
 from components.models.ppo import PPO
+from components.models.ppo_rollout import RolloutConfig, RolloutWorkers
 from components.action import make_action
 from components.reward import calculate_reward
 from components.state import (
-    action_dimensions, 
-    state_dimensions, 
-    observation_to_state
+    STATE_ENCODINGS,
+    action_dimensions,
 )
 from components.types import State
+from components.utils.log import flush_metrics, get_logger
+from components.utils.profiling import Profiler
+
+log = get_logger("ppo_train")
 
 """
 Simulation of two agents playing one againts the other.
@@ -35,60 +41,73 @@ STEPS = 1000
 BATCH_SIZE = 128
 LEARNING_RATE_ACTOR = 0.0001
 LEARNING_RATE_CRITIC = 0.0003
-K_EPOCHS = 100 # update policy for K epochs in one PPO update
+K_EPOCHS = 10 # update policy for K epochs in one PPO update
+TARGET_KL = 0.02 # stop a PPO update early once the policy moved this far from the old one
+SHARED_TRUNK = True # actor and critic share their input layers
+STATE_ENCODING = "flat" # "flat" binary vectors for an MLP or "spatial" [C, H, W] planes for a CNN
 GAMMA = 0.99
+GAE_LAMBDA = 0.95 # advantages by GAE-lambda, None uses normalized Monte Carlo returns instead
 TAU = 0.007
 EPS_CLIP = 0.1 # clip parameter for PPO
 ACTION_STD = 0.6
 HAS_CONTINUOUS_ACTION_SPACE = False
-PRINT_EVERY = 100
+PRINT_EVERY = 100 # steps between step records in the log
 UPDATE_EVERY = 50
 SAVE_EVERY = 1000
+NUM_ROLLOUT_WORKERS = 4 # processes collecting experience, 0 collects it in the training process
+PROFILE = True # time the phases of every training step
+PROFILE_EVERY = 1000 # steps between timing summaries appended to PROFILE_PATH
+PROFILE_PATH = "agent_ppo_profile.csv"
 
 """
 Epsilon-greedy action selection.
 """
-def select_action(agent: PPO, state: State, steps_done: int, verbose: bool = True):
+def select_action(agent: PPO, state: State, steps_done: int):
 
     agent_id = AGENTS[steps_done % 2]
     unit_id = UNITS[steps_done % 6]
     
-    if verbose:
-        print(f"Agent: {agent_id}, Unit: {unit_id}")
+    log.debug("select_action", agent_id=agent_id, unit_id=unit_id)
 
     action = agent.select_action(state)
 
     return action, (agent_id, unit_id)
 
 
-async def train(env: GymEnv, agent: PPO):
+async def train(env: GymEnv, agent: PPO, profiler: Profiler):
     cumulative_rewards = []
+    encode = STATE_ENCODINGS[STATE_ENCODING].encode
 
     for epoch in range(EPOCHS):
-        print(f"Started {epoch} epoch...")
+        log.info("epoch_started", epoch=epoch)
         cumulative_reward = 0
 
         # Initialize the environment and get it's state
         prev_observation = await env.reset()
-        prev_state = observation_to_state(prev_observation, current_agent_id='a', current_unit_id='c')
+        with profiler.phase("observation_to_state"):
+            prev_state = encode(prev_observation, current_agent_id='a', current_unit_id='c')
 
         # Iterate and gather experience
         for steps_done in range(1, STEPS):
-            action, (agent_id, unit_id) = select_action(agent, prev_state, steps_done)
-            action_or_idle = make_action(prev_observation, agent_id, unit_id, action)
+            with profiler.phase("select_action"):
+                action, (agent_id, unit_id) = select_action(agent, prev_state, steps_done)
+            with profiler.phase("make_action"):
+                action_or_idle = make_action(prev_observation, agent_id, unit_id, action)
             action_is_idle = action_or_idle is None
 
-            if action_is_idle:
-                next_observation, done, info = await env.step([])
-            else:
-                next_observation, done, info = await env.step([action_or_idle])
+            with profiler.phase("env_step"):
+                if action_is_idle:
+                    next_observation, done, info = await env.step([])
+                else:
+                    next_observation, done, info = await env.step([action_or_idle])
 
-            reward = calculate_reward(prev_observation, next_observation, current_agent_id=agent_id, current_unit_id=unit_id)
-            next_state = observation_to_state(next_observation, current_agent_id=agent_id, current_unit_id=unit_id)
+            with profiler.phase("calculate_reward"):
+                reward = calculate_reward(prev_observation, next_observation, current_agent_id=agent_id, current_unit_id=unit_id)
+            with profiler.phase("observation_to_state"):
+                next_state = encode(next_observation, current_agent_id=agent_id, current_unit_id=unit_id)
 
             # saving reward and is_terminals
-            agent.buffer.rewards.append(reward)
-            agent.buffer.is_terminals.append(done)
+            agent.buffer.add_reward(reward, done)
 
             prev_state = next_state
             prev_observation = next_observation
@@ -97,18 +116,31 @@ async def train(env: GymEnv, agent: PPO):
             cumulative_reward += reward.item()
 
             if steps_done % UPDATE_EVERY == 0:
-                agent.update()
+                with profiler.phase("ppo_update"):
+                    agent.update()
+            profiler.step()
 
             if steps_done % PRINT_EVERY == 0:
-                print(f"Action: {action}")
-                print(f"Reward: {reward}, Done: {done}, Info: {info}, Observation: {next_observation}")
+                log.info("step", step=steps_done, action=action, reward=reward.item(), done=done, info=info, update=agent.update_stats)
+                log.debug("observation", step=steps_done, observation=next_observation)
 
             if done:
-                print(f"Agent achieved the goal during step {steps_done}")
+                log.info("episode_done", step=steps_done)
                 break
 
+        # The buffer only holds UPDATE_EVERY transitions, learn from the rest of the epoch's
+        if agent.buffer.size > 0:
+            with profiler.phase("ppo_update"):
+                agent.update()
+
         # Compute statistics
         cumulative_rewards.append(cumulative_reward)
+        log.info("epoch_finished", epoch=epoch, cumulative_reward=cumulative_reward)
+        flush_metrics()
+
+    print("Time per phase over the whole training:")
+    profiler.print_summary()
+    profiler.export()
     
     print("Drawing plot: reward distribution over epochs")
     epochs = range(1, EPOCHS + 1) 
@@ -121,11 +153,59 @@ async def train(env: GymEnv, agent: PPO):
     plt.savefig("agent_ppo_rewards.png")
 
 
+"""
+The per step phases run in the worker processes, the learner times what it
+waits for: collecting the rollouts, the update and the weight broadcast.
+"""
+def train_with_workers(workers: RolloutWorkers, agent: PPO, profiler: Profiler):
+    cumulative_rewards = []
+
+    for epoch in range(EPOCHS):
+        log.info("epoch_started", epoch=epoch)
+        cumulative_reward = 0
+
+        # Every update consumes one rollout of UPDATE_EVERY steps from each worker
+        for update in range(STEPS // UPDATE_EVERY):
+            with profiler.phase("collect_rollouts"):
+                stats = workers.collect(reset=update == 0)
+                transitions = workers.to_buffer(agent.buffer)
+            with profiler.phase("ppo_update"):
+                agent.update()
+            with profiler.phase("broadcast_weights"):
+                workers.broadcast(agent.policy_old.state_dict())
+            profiler.step(transitions)
+
+            # Compute statistics
+            cumulative_reward += sum(stat.cumulative_reward for stat in stats)
+
+            if update % max(PRINT_EVERY // UPDATE_EVERY, 1) == 0:
+                log.info("update", update=update, rollouts=stats, stats=agent.update_stats)
+
+        # Compute statistics
+        cumulative_rewards.append(cumulative_reward)
+        log.info("epoch_finished", epoch=epoch, cumulative_reward=cumulative_reward)
+        flush_metrics()
+
+    print("Time per phase over the whole training:")
+    profiler.print_summary()
+    profiler.export()
+
+    print("Drawing plot: reward distribution over epochs")
+    epochs = range(1, EPOCHS + 1) 
+    ax = plt.axes()
+    ax.plot(epochs, cumulative_rewards)
+    ax.set_title('Cumulative reward by epoch')
+    ax.set_xlabel('Epoch')
+    ax.set_ylabel('Cumulative reward')
+    ax.xaxis.set_ticks(epochs)
+    plt.savefig("agent_ppo_rewards.png")
+
+
 async def main():
     print("============================================================================================")
     print("PPO agent")
     print("Connecting to gym")
-    gym = Gym(FWD_MODEL_URI)
+    gym = LocalGym() if FWD_MODEL_LOCAL else Gym(FWD_MODEL_URI)
     for retry in range(1, FWD_MODEL_CONNECTION_RETRIES):
         try:
             await gym.connect()
@@ -141,7 +221,7 @@ async def main():
     print("Initializing agent")
     env = gym.make("bomberland-gym", MOCK_15x15_INITIAL_OBSERVATION)
     observation = await env.reset()
-    n_states = state_dimensions(observation)
+    n_states = STATE_ENCODINGS[STATE_ENCODING].dimensions(observation)
     n_actions = action_dimensions()
     print(f"Agent: states = {n_states}, actions = {n_actions}")
 
@@ -154,7 +234,13 @@ async def main():
         K_EPOCHS, 
         EPS_CLIP,
         HAS_CONTINUOUS_ACTION_SPACE, 
-        ACTION_STD
+        ACTION_STD,
+        buffer_size=max(NUM_ROLLOUT_WORKERS, 1) * UPDATE_EVERY,
+        gae_lambda=GAE_LAMBDA,
+        packed_states=True,
+        minibatch_size=BATCH_SIZE,
+        target_kl=TARGET_KL,
+        shared_trunk=SHARED_TRUNK,
     )
     print("============================================================================================")
 
@@ -162,7 +248,14 @@ async def main():
     print("Training agent")
     start_time = datetime.datetime.now().replace(microsecond=0)
     print("Started training at (GMT) : ", start_time)
-    await train(env, ppo_agent)
+    profiler = Profiler(PROFILE_PATH, PROFILE_EVERY, enabled=PROFILE)
+    if NUM_ROLLOUT_WORKERS > 0:
+        workers = RolloutWorkers(NUM_ROLLOUT_WORKERS, ppo_agent.policy_old, RolloutConfig(
+            n_states, n_actions, UPDATE_EVERY, MOCK_15x15_INITIAL_OBSERVATION, AGENTS, UNITS, FWD_MODEL_URI, FWD_MODEL_LOCAL, STATE_ENCODING))
+        train_with_workers(workers, ppo_agent, profiler)
+        workers.close()
+    else:
+        await train(env, ppo_agent, profiler)
     end_time = datetime.datetime.now().replace(microsecond=0)
     print("Started training at (GMT) : ", start_time)
     print("Finished training at (GMT) : ", end_time)
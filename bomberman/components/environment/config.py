@@ -10,3 +10,37 @@ FWD_MODEL_URI = os.environ.get(
     "FWD_MODEL_CONNECTION_STRING") or "ws://127.0.0.1:6969/?role=admin"
 FWD_MODEL_CONNECTION_RETRIES = 10
 FWD_MODEL_CONNECTION_DELAY = 5
+# Seconds to wait for an evaluated next state before giving up on the request
+FWD_MODEL_RESPONSE_TIMEOUT = 30
+# Train against the in-process forward model instead of the engine's websocket
+FWD_MODEL_LOCAL = os.environ.get("FWD_MODEL_LOCAL") == "1"
+
+# Logging, see components/utils/log.py
+LOG_LEVEL = os.environ.get("LOG_LEVEL") or "INFO"
+# One JSON object per record instead of "key=value" text
+LOG_JSON = os.environ.get("LOG_JSON") == "1"
+# Seconds between the aggregated records of logged metrics
+LOG_METRICS_INTERVAL = 10
+# Records waiting for the log writer before new ones are dropped
+LOG_QUEUE_SIZE = 10000
+
+# Observations whose index, danger map, reachability and reward features are
+# kept, see components/utils/cache.py; trainers stepping several environments raise it
+OBSERVATION_CACHE_SIZE = 8
+
+# Engine rules mirrored by the local forward model (see engine/bomberland-engine/src/Config/getConfig.ts)
+AMMUNITION_DURATION_TICKS = 40
+AMMUNITION_SPAWN_WEIGHTING = 0.0
+BLAST_DURATION_TICKS = 5
+BLAST_POWERUP_DURATION_TICKS = 40
+BLAST_POWERUP_SPAWN_WEIGHTING = 0.5
+BOMB_ARMED_TICKS = 5
+BOMB_DURATION_TICKS = 30
+ENTITY_SPAWN_PROBABILITY_PER_TICK = 0.0
+FREEZE_DEBUFF_DURATION_TICKS = 15
+FREEZE_POWERUP_SPAWN_WEIGHTING = 0.5
+INITIAL_BLAST_DIAMETER = 3
+INITIAL_HP = 3
+INVULNERABILITY_TICKS = 5
+MAXIMUM_CONCURRENT_BOMBS = 3
+OBJECT_DESTRUCTION_ITEM_DROP_PROBABILITY = 0.5
@@ -6,6 +6,7 @@ class ForwardModel:
     def __init__(self, connection_string: str):
         self._connection_string = connection_string
         self._next_state_callback = None
+        self._connection_closed_callback = None
         self.connection = None
 
     async def close(self):
@@ -15,6 +16,9 @@ class ForwardModel:
     def set_next_state_callback(self, next_state_callback):
         self._next_state_callback = next_state_callback
 
+    def set_connection_closed_callback(self, connection_closed_callback):
+        self._connection_closed_callback = connection_closed_callback
+
     async def connect(self):
         self.connection = await websockets.connect(self._connection_string)
         if self.connection.open:
@@ -28,6 +32,8 @@ class ForwardModel:
                 await self._on_data(data)
             except websockets.exceptions.ConnectionClosed:
                 print('Connection with server closed')
+                if self._connection_closed_callback != None:
+                    await self._connection_closed_callback()
                 break
 
     async def _on_data(self, data):
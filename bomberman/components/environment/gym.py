@@ -2,8 +2,12 @@ import asyncio
 import gymnasium as gym
 import typing
 
+from components.utils.log import get_logger
+from .config import FWD_MODEL_RESPONSE_TIMEOUT
 from .forward_model import ForwardModel
 
+log = get_logger("gym")
+
 class GymEnv(gym.Env):
     def __init__(self, fwd_model: ForwardModel, channel: int, initial_state: typing.Dict, send_next_state: typing.Callable[[typing.Dict, typing.List[typing.Dict],  int], typing.Dict]):
         self._state = initial_state
@@ -22,13 +26,51 @@ class GymEnv(gym.Env):
         return [state.get("next_state"), state.get("is_complete"), state.get("tick_result").get("events")]
 
 
+"""
+N environments stepped together: all N evaluate requests are sent at once
+and their responses gathered concurrently, so one round-trip to the forward
+model yields N transitions.
+
+`step` returns the states the actions led to (terminal states included);
+environments that finished are reset afterwards and `observations` holds the
+states the next actions should be chosen from.
+"""
+class VecGymEnv():
+    def __init__(self, envs: typing.List[GymEnv]):
+        self.envs = envs
+        self.observations: typing.List[typing.Dict] = [env._state for env in envs]
+
+    @property
+    def num_envs(self) -> int:
+        return len(self.envs)
+
+    async def reset(self) -> typing.List[typing.Dict]:
+        self.observations = list(await asyncio.gather(*[env.reset() for env in self.envs]))
+        return self.observations
+
+    async def step(self, actions: typing.List[typing.List[typing.Dict]]):
+        if len(actions) != len(self.envs):
+            raise ValueError(f"expected actions for {len(self.envs)} environments, got {len(actions)}")
+        results = await asyncio.gather(*[env.step(env_actions) for env, env_actions in zip(self.envs, actions)])
+        next_observations = [result[0] for result in results]
+        dones = [result[1] for result in results]
+        events = [result[2] for result in results]
+
+        self.observations = list(next_observations)
+        for i, done in enumerate(dones):
+            if done:
+                self.observations[i] = await self.envs[i].reset()
+        return [next_observations, dones, events]
+
+
 class Gym():
     def __init__(self, fwd_model_uri: str):
         self._client_fwd = ForwardModel(fwd_model_uri)
         self._channel_counter = 0
-        self._channel_is_busy_status: typing.Dict[int, bool] = {}
-        self._channel_buffer: typing.Dict[int, typing.Dict] = {}
+        self._sequence_counter = 0
+        self._pending_next_states: typing.Dict[int, asyncio.Future] = {}
         self._client_fwd.set_next_state_callback(self._on_next_game_state)
+        self._client_fwd.set_connection_closed_callback(self._on_connection_closed)
         self._environments: typing.Dict[str, GymEnv] = {}
 
     async def connect(self):
@@ -44,9 +86,18 @@ class Gym():
         await self._client_fwd.close()
 
     async def _on_next_game_state(self, state):
-        channel = state.get("sequence_id")
-        self._channel_is_busy_status[channel] = False
-        self._channel_buffer[channel] = state
+        future = self._pending_next_states.pop(state.get("sequence_id"), None)
+        if future is None:
+            log.warning("unknown_sequence_id", sequence_id=state.get("sequence_id"))
+        elif not future.done():
+            future.set_result(state)
+
+    async def _on_connection_closed(self):
+        pending_next_states, self._pending_next_states = self._pending_next_states, {}
+        for sequence_id, future in pending_next_states.items():
+            if not future.done():
+                future.set_exception(ConnectionError(
+                    f"connection closed before next state {sequence_id} was received"))
 
     def make(self, name: str, initial_state: typing.Dict) -> GymEnv:
         if self._environments.get(name) is not None:
@@ -57,12 +108,24 @@ class Gym():
         self._channel_counter += 1
         return self._environments[name]
 
-    async def _send_next_state(self, state, actions, channel: int):
-        self._channel_is_busy_status[channel] = True
-        await self._client_fwd.send_next_state(channel, state, actions)
-        while self._channel_is_busy_status[channel] == True:
-            # TODO figure out why packets are not received without some sleep
-            await asyncio.sleep(0.0001)
-        result = self._channel_buffer[channel]
-        del self._channel_buffer[channel]
-        return result
+    def make_vec(self, name: str, initial_state: typing.Dict, num_envs: int) -> VecGymEnv:
+        return VecGymEnv([self.make(f"{name}-{i}", initial_state) for i in range(num_envs)])
+
+    """
+    Every request gets its own sequence id, so any number of them can be in
+    flight at once (on the same or different channels); responses resolve the
+    matching future in whatever order they arrive.
+    """
+    async def _send_next_state(self, state, actions, channel: int, timeout: float = FWD_MODEL_RESPONSE_TIMEOUT):
+        sequence_id = self._sequence_counter
+        self._sequence_counter += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending_next_states[sequence_id] = future
+        try:
+            await self._client_fwd.send_next_state(sequence_id, state, actions)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(
+                f"no next state for sequence id {sequence_id} (channel {channel}) within {timeout}s")
+        finally:
+            self._pending_next_states.pop(sequence_id, None)
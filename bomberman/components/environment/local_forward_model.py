@@ -0,0 +1,511 @@
+import functools
+import math
+import random
+import typing
+
+from .config import (
+    AMMUNITION_DURATION_TICKS,
+    AMMUNITION_SPAWN_WEIGHTING,
+    BLAST_DURATION_TICKS,
+    BLAST_POWERUP_DURATION_TICKS,
+    BLAST_POWERUP_SPAWN_WEIGHTING,
+    BOMB_ARMED_TICKS,
+    BOMB_DURATION_TICKS,
+    ENTITY_SPAWN_PROBABILITY_PER_TICK,
+    FREEZE_DEBUFF_DURATION_TICKS,
+    FREEZE_POWERUP_SPAWN_WEIGHTING,
+    INVULNERABILITY_TICKS,
+    MAXIMUM_CONCURRENT_BOMBS,
+    OBJECT_DESTRUCTION_ITEM_DROP_PROBABILITY,
+)
+from .gym import GymEnv, VecGymEnv
+
+_move_deltas = {"up": (0, 1), "down": (0, -1), "left": (-1, 0), "right": (1, 0)}
+_action_order = {"bomb": 0, "detonate": 1, "move": 2}
+_walkable_entities = set(("a", "t", "x", "bp", "fp"))
+_entity_keys = ("created", "x", "y", "type", "unit_id", "agent_id", "expires", "hp", "blast_diameter")
+
+
+class InvalidActionError(Exception):
+    pass
+
+
+"""
+Order in which end-game fire fills the map: two clockwise spirals, one from
+the top-left and one from the bottom-right corner, interleaved cell by cell.
+Port of generateGrowingFireProgression.ts.
+"""
+@functools.lru_cache(maxsize=None)
+def growing_fire_progression(width: int, height: int) -> typing.Tuple[int, ...]:
+    directions = [(0, -1), (-1, 0), (0, 1), (1, 0)]  # down, left, up, right (clockwise order)
+    used_cells: typing.Dict[int, None] = {}
+    spirals = [[0, height - 1, 3], [width - 1, 0, 1]]  # x, y, direction index
+    for x, y, _ in spirals:
+        used_cells[x + y * width] = None
+
+    def is_valid(x, y):
+        return 0 <= x < width and 0 <= y < height and (x + y * width) not in used_cells
+
+    for _ in range(width * height):
+        for spiral in spirals:
+            if len(used_cells) >= width * height:
+                continue
+            x, y, direction = spiral
+            dx, dy = directions[direction]
+            if not is_valid(x + dx, y + dy):
+                direction = (direction + 1) % 4
+                dx, dy = directions[direction]
+            spiral[0], spiral[1], spiral[2] = x + dx, y + dy, direction
+            used_cells[spiral[0] + spiral[1] * width] = None
+    return tuple(used_cells)
+
+
+def _entity(**fields) -> typing.Dict:
+    return {key: fields[key] for key in _entity_keys if fields.get(key) is not None}
+
+
+def _unit(unit: typing.Dict) -> typing.Dict:
+    return {
+        "coordinates": list(unit["coordinates"]),
+        "hp": unit["hp"],
+        "inventory": {"bombs": unit["inventory"]["bombs"]},
+        "blast_diameter": unit["blast_diameter"],
+        "unit_id": unit["unit_id"],
+        "agent_id": unit["agent_id"],
+        "invulnerable": unit["invulnerable"],
+        "stunned": unit["stunned"],
+    }
+
+
+"""
+One evaluation of the engine's World: entities are keyed by cell number in
+insertion order (like the engine's EntityTracker map), units by unit id.
+
+Entity dicts are shared with the state they were read from and replaced
+(never mutated) when their hp changes, so input states stay untouched.
+"""
+class _World:
+    def __init__(self, state: typing.Dict, rng: random.Random):
+        self.rng = rng
+        self.game_id = state.get("game_id")
+        self.width = state["world"]["width"]
+        self.height = state["world"]["height"]
+        self.tick = state["tick"]
+        self.config = dict(state["config"])
+        self.units = {unit_id: _unit(unit) for unit_id, unit in state["unit_state"].items()}
+        self.entities: typing.Dict[int, typing.Dict] = {}
+        for entity in state["entities"]:
+            cell = self.cell_number(entity["x"], entity["y"])
+            if cell in self.entities:
+                raise ValueError(f"Cell {entity['x']}, {entity['y']} - number {cell} could not be reserved")
+            self.entities[cell] = entity
+        self.agent_cells = set(self.cell_number(*unit["coordinates"]) for unit in self.units.values())
+        self.events: typing.List[typing.Dict] = []
+
+    def cell_number(self, x: int, y: int) -> int:
+        return x + y * self.width
+
+    def coordinates(self, cell: int) -> typing.List[int]:
+        return [cell % self.width, cell // self.width]
+
+    def flush_events(self) -> typing.List[typing.Dict]:
+        events, self.events = self.events, []
+        return events
+
+    def game_state(self) -> typing.Dict:
+        agents: typing.Dict[str, typing.Dict] = {}
+        for unit in self.units.values():
+            agent_id = unit["agent_id"]
+            if agent_id not in agents:
+                agents[agent_id] = {"agent_id": agent_id, "unit_ids": []}
+            agents[agent_id]["unit_ids"].append(unit["unit_id"])
+        return {
+            "game_id": self.game_id,
+            "agents": agents,
+            "unit_state": {unit_id: _unit(unit) for unit_id, unit in self.units.items()},
+            "entities": list(self.entities.values()),
+            "world": {"width": self.width, "height": self.height},
+            "tick": self.tick,
+            "config": dict(self.config),
+        }
+
+    def is_game_complete(self) -> bool:
+        agents_alive = set(unit["agent_id"] for unit in self.units.values() if unit["hp"] > 0)
+        return len(agents_alive) <= 1
+
+    """
+    World.Tick and EndGameFireSpreader.Spread
+    """
+
+    def spread_fire(self):
+        game_duration_ticks = self.config["game_duration_ticks"]
+        fire_spawn_interval_ticks = self.config["fire_spawn_interval_ticks"]
+        if self.tick < game_duration_ticks:
+            return
+        delta = self.tick - game_duration_ticks
+        if delta % fire_spawn_interval_ticks != 0:
+            return
+        progression = growing_fire_progression(self.width, self.height)
+        index = int(delta // fire_spawn_interval_ticks)
+        if index >= len(progression):
+            return
+        cell = progression[index]
+        x, y = self.coordinates(cell)
+        blast = _entity(created=self.tick, x=x, y=y, type="x")
+        entity_in_cell = self.entities.get(cell)
+        self.remove_entity(cell)
+        if entity_in_cell is not None and entity_in_cell["type"] == "b":
+            self.create_blast_from_origin([x, y], entity_in_cell["blast_diameter"], entity_in_cell.get("unit_id"))
+        self.place_entity(blast)
+
+    def tick_world(self):
+        self.expire_entities()
+        self.check_agent_entity_collision()
+        self.roll_random_spawn()
+
+    def expire_entities(self):
+        for cell, entity in list(self.entities.items()):
+            if self.entities.get(cell) is not entity:
+                continue  # already removed by an earlier blast this tick
+            if entity.get("expires") is not None and entity["expires"] <= self.tick:
+                self.expire_entity(entity)
+
+    def expire_entity(self, entity: typing.Dict):
+        cell = self.cell_number(entity["x"], entity["y"])
+        self.remove_entity(cell)
+        if entity["type"] == "b":
+            self.create_blast_from_origin([entity["x"], entity["y"]], entity["blast_diameter"], entity.get("unit_id"))
+
+    def expire_entity_in_cell(self, cell: int):
+        entity = self.entities.get(cell)
+        if entity is not None:
+            self.expire_entity(entity)
+
+    def units_in_cell(self, cell: int) -> typing.List[typing.Dict]:
+        if cell not in self.agent_cells:
+            return []
+        return [unit for unit in self.units.values() if self.cell_number(*unit["coordinates"]) == cell]
+
+    def check_agent_entity_collision(self):
+        for cell, entity in list(self.entities.items()):
+            if self.entities.get(cell) is not entity:
+                continue
+            entity_type = entity["type"]
+            for unit in self.units_in_cell(cell):
+                if entity_type == "x":
+                    self.reduce_unit_health(unit)
+                elif entity_type == "a":
+                    unit["inventory"]["bombs"] += 1
+                    self.push_unit_state(unit)
+                    self.remove_entity(cell)
+                elif entity_type == "bp":
+                    unit["blast_diameter"] += 2
+                    self.push_unit_state(unit)
+                    self.remove_entity(cell)
+                elif entity_type == "fp":
+                    self.trigger_unit_freeze(unit)
+                    self.remove_entity(cell)
+
+    def roll_random_spawn(self):
+        if self.rng.random() >= ENTITY_SPAWN_PROBABILITY_PER_TICK:
+            return
+        empty_cells = [
+            cell for cell in range(self.width * self.height)
+            if cell not in self.entities and cell not in self.agent_cells
+        ]
+        if empty_cells:
+            self.place_random_spawn(self.rng.choice(empty_cells))
+
+    def place_random_spawn(self, cell: int):
+        x, y = self.coordinates(cell)
+        roll = self.rng.random()
+        if roll < AMMUNITION_SPAWN_WEIGHTING:
+            entity = _entity(created=self.tick, x=x, y=y, type="a", expires=self.tick + AMMUNITION_DURATION_TICKS, hp=1)
+        elif roll < AMMUNITION_SPAWN_WEIGHTING + BLAST_POWERUP_SPAWN_WEIGHTING:
+            entity = _entity(created=self.tick, x=x, y=y, type="bp", expires=self.tick + BLAST_POWERUP_DURATION_TICKS, hp=1)
+        else:
+            # the engine uses the blast powerup duration for freeze powerups as well
+            entity = _entity(created=self.tick, x=x, y=y, type="fp", expires=self.tick + BLAST_POWERUP_DURATION_TICKS, hp=1)
+        self.place_entity(entity)
+
+    """
+    Blasts
+    """
+
+    def create_blast_from_origin(self, origin: typing.List[int], blast_diameter: int, unit_id: typing.Optional[str]):
+        blast_radius = (blast_diameter - 1) / 2
+        x, y = origin
+        self.generate_blast_in_cell(self.cell_number(x, y), unit_id)
+        for dx, dy in ((0, 1), (0, -1), (-1, 0), (1, 0)):
+            for i in range(math.ceil(blast_radius)):
+                blast_x, blast_y = x + dx * (i + 1), y + dy * (i + 1)
+                if 0 <= blast_x < self.width and 0 <= blast_y < self.height:
+                    blast = self.generate_blast_in_cell(self.cell_number(blast_x, blast_y), unit_id)
+                    if blast is None:
+                        break
+
+    def generate_blast_in_cell(self, cell: int, unit_id: typing.Optional[str]) -> typing.Optional[typing.Dict]:
+        entity = self.entities.get(cell)
+        unit = self.units.get(unit_id)
+        agent_id = unit["agent_id"] if unit is not None else None
+        x, y = self.coordinates(cell)
+
+        for unit_in_cell in self.units_in_cell(cell):
+            self.reduce_unit_health(unit_in_cell)
+
+        if entity is None:
+            blast = _entity(created=self.tick, x=x, y=y, type="x", unit_id=unit_id, agent_id=agent_id,
+                            expires=self.tick + BLAST_DURATION_TICKS)
+            self.place_entity(blast)
+            return blast
+        elif entity["type"] == "x":
+            expires = self.tick + BLAST_DURATION_TICKS if entity.get("expires") is not None else None
+            blast = _entity(created=self.tick, x=x, y=y, type="x", unit_id=unit_id, agent_id=agent_id, expires=expires)
+            self.expire_entity(entity)
+            self.place_entity(blast)
+            return blast
+        elif entity.get("hp") is not None:
+            entity = dict(entity, hp=entity["hp"] - 1)
+            self.entities[cell] = entity
+            self.events.append({"type": "entity_state", "coordinates": [x, y], "updated_entity": entity})
+            if entity["hp"] <= 0:
+                self.remove_entity(cell)
+                if entity["type"] == "b":
+                    self.create_blast_from_origin([x, y], entity["blast_diameter"], entity.get("unit_id"))
+                elif entity["type"] in ("w", "o"):
+                    if self.rng.random() < OBJECT_DESTRUCTION_ITEM_DROP_PROBABILITY:
+                        self.place_random_spawn(cell)
+        return None
+
+    def remove_entity(self, cell: int) -> bool:
+        if cell not in self.entities:
+            return False
+        del self.entities[cell]
+        self.events.append({"type": "entity_expired", "data": self.coordinates(cell)})
+        return True
+
+    def place_entity(self, entity: typing.Dict):
+        self.entities[self.cell_number(entity["x"], entity["y"])] = entity
+        self.events.append({"type": "entity_spawned", "data": entity})
+
+    """
+    Units
+    """
+
+    def push_unit_state(self, unit: typing.Dict):
+        self.events.append({"type": "unit_state", "data": _unit(unit)})
+
+    def reduce_unit_health(self, unit: typing.Dict):
+        if unit["invulnerable"] < self.tick:
+            unit["hp"] -= 1
+            unit["invulnerable"] = self.tick + INVULNERABILITY_TICKS
+            self.push_unit_state(unit)
+
+    def trigger_unit_freeze(self, unit: typing.Dict):
+        agent_to_punish = "b" if unit["agent_id"] == "a" else "a"
+        alive_units = [
+            candidate for candidate in self.units.values()
+            if candidate["agent_id"] == agent_to_punish and candidate["hp"] > 0
+        ]
+        if not alive_units:
+            return
+        unit_to_freeze = alive_units[math.floor(self.rng.random() * len(alive_units))]
+        unit_to_freeze["stunned"] = self.tick + FREEZE_DEBUFF_DURATION_TICKS
+        self.push_unit_state(unit_to_freeze)
+
+    def is_coordinate_vacant(self, x: int, y: int) -> bool:
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return False
+        entity = self.entities.get(self.cell_number(x, y))
+        return entity is None or entity["type"] in _walkable_entities
+
+    def move(self, unit: typing.Dict, move: str):
+        x, y = unit["coordinates"]
+        dx, dy = _move_deltas[move]
+        new_x, new_y = x + dx, y + dy
+        is_occupied = any(other["coordinates"] == [new_x, new_y] for other in self.units.values())
+        if not self.is_coordinate_vacant(new_x, new_y) or is_occupied:
+            raise InvalidActionError(f"Cannot move {move}, cell is not vacant")
+        self.agent_cells.discard(self.cell_number(x, y))
+        self.agent_cells.add(self.cell_number(new_x, new_y))
+        unit["coordinates"] = [new_x, new_y]
+
+    def place_bomb(self, unit: typing.Dict):
+        if unit["inventory"]["bombs"] <= 0:
+            raise InvalidActionError("No bombs in inventory.")
+        placed_bombs = sum(
+            1 for entity in self.entities.values()
+            if entity["type"] == "b" and entity.get("agent_id") == unit["agent_id"]
+        )
+        if placed_bombs >= MAXIMUM_CONCURRENT_BOMBS:
+            raise InvalidActionError(f"Agent {unit['agent_id']} cannot place more than {MAXIMUM_CONCURRENT_BOMBS} bombs")
+
+        x, y = unit["coordinates"]
+        cell = self.cell_number(x, y)
+        entity_in_cell = self.entities.get(cell)
+        if entity_in_cell is None:
+            self.spawn_bomb(unit, cell)
+        elif entity_in_cell["type"] == "x":
+            # placing a bomb into a blast detonates it straight away, as in the engine
+            has_expiry = entity_in_cell.get("expires") is not None
+            blast = _entity(
+                created=self.tick, x=x, y=y, type="x",
+                unit_id=entity_in_cell.get("unit_id") if has_expiry else None,
+                agent_id=entity_in_cell.get("agent_id") if has_expiry else None,
+                expires=self.tick + BLAST_DURATION_TICKS if has_expiry else None,
+            )
+            self.remove_entity(cell)
+            self.spawn_bomb(unit, cell)
+            self.expire_entity_in_cell(cell)
+            self.expire_entity_in_cell(cell)
+            self.place_entity(blast)
+        else:
+            raise InvalidActionError("Unable to place bomb already occupied")
+
+    def spawn_bomb(self, unit: typing.Dict, cell: int):
+        x, y = self.coordinates(cell)
+        if not self.is_coordinate_vacant(x, y):
+            return
+        bomb = _entity(
+            created=self.tick, x=x, y=y, type="b", unit_id=unit["unit_id"], agent_id=unit["agent_id"],
+            expires=self.tick + BOMB_DURATION_TICKS, hp=1, blast_diameter=unit["blast_diameter"],
+        )
+        self.place_entity(bomb)
+        unit["inventory"]["bombs"] -= 1
+        self.push_unit_state(unit)
+
+    def detonate(self, unit: typing.Dict, coordinates: typing.Optional[typing.List[int]]):
+        if coordinates is None:
+            raise InvalidActionError("Detonate packet without coordinates")
+        entity = self.entities.get(self.cell_number(*coordinates))
+        if entity is not None and entity["type"] == "b" and entity.get("unit_id") == unit["unit_id"]:
+            if self.tick - entity["created"] > BOMB_ARMED_TICKS:
+                self.expire_entity(entity)
+            else:
+                raise InvalidActionError("Bomb not armed")
+
+    def handle_unit_action(self, packet: typing.Dict):
+        unit = self.units[packet["unit_id"]]
+        action_type = packet["type"]
+        if action_type == "move":
+            self.move(unit, packet.get("move"))
+        elif action_type == "bomb":
+            self.place_bomb(unit)
+        elif action_type == "detonate":
+            self.detonate(unit, packet.get("coordinates"))
+
+
+"""
+In-process counterpart of the engine's evaluate_next_state
+(engine/bomberland-engine/src/Game/Training/evaluateNextState.ts).
+
+Returns the same payload as the "next_game_state" packet, without the
+websocket round-trip and JSON (de)serialization. The tick runs in the same
+order as Game.GetTickResult: end-game fire, entity expiry and blasts, unit
+pickups, then bomb, detonate and move actions. Unlike the engine's training
+endpoint, entity state read from the input (ore block hp, powerup expiry,
+bomb blast diameter) is kept as is rather than reset on reconstruction,
+which matches how a live game evolves.
+"""
+class LocalForwardModel:
+    def __init__(self, seed: typing.Optional[int] = None):
+        self._rng = random.Random(seed)
+
+    def evaluate_next_state(self, game_state: typing.Dict, actions: typing.List[typing.Dict]) -> typing.Dict:
+        world = _World(game_state, self._rng)
+        queued_actions = self._queue_actions(world, actions)
+
+        world.tick += 1
+        world.spread_fire()
+        world.tick_world()
+        events = world.flush_events()
+        events.extend(self._process_actions(world, queued_actions))
+        events.extend(world.flush_events())
+
+        return {
+            "next_state": world.game_state(),
+            "is_complete": world.is_game_complete(),
+            "tick_result": {"tick": world.tick, "events": events},
+        }
+
+    def _queue_actions(self, world: _World, actions: typing.List[typing.Dict]) -> typing.List[typing.Tuple[str, typing.Dict]]:
+        queued_actions = []
+        last_action_ticks: typing.Dict[str, int] = {}
+        for forward_action in actions:
+            agent_id, packet = forward_action["agent_id"], forward_action["action"]
+            unit_id = packet.get("unit_id")
+            unit = world.units.get(unit_id)
+            if unit is None or unit["agent_id"] != agent_id:
+                continue
+            if unit["hp"] <= 0 or last_action_ticks.get(unit_id, -1) >= world.tick or unit["stunned"] >= world.tick:
+                continue
+            last_action_ticks[unit_id] = world.tick
+            if packet.get("type") in _action_order:
+                queued_actions.append((agent_id, packet))
+        return queued_actions
+
+    def _process_actions(self, world: _World, actions: typing.List[typing.Tuple[str, typing.Dict]]) -> typing.List[typing.Dict]:
+        actions = sorted(actions, key=lambda action: _action_order[action[1]["type"]])
+        non_move_actions = [action for action in actions if action[1]["type"] != "move"]
+        move_actions = [action for action in actions if action[1]["type"] == "move"]
+        return self._handle_actions(world, non_move_actions) + self._handle_actions(world, self._filter_same_cell_moves(world, move_actions))
+
+    def _filter_same_cell_moves(self, world: _World, move_actions: typing.List[typing.Tuple[str, typing.Dict]]):
+        # Drops every move whose target cell is also targeted by another unit
+        targeted_cells: typing.Dict[int, typing.Set[str]] = {}
+        for _, packet in move_actions:
+            move = packet.get("move")
+            if move not in _move_deltas:
+                raise ValueError(f"Unknown move: {move}")
+            x, y = world.units[packet["unit_id"]]["coordinates"]
+            dx, dy = _move_deltas[move]
+            targeted_cells.setdefault(world.cell_number(x + dx, y + dy), set()).add(packet["unit_id"])
+        blocked_unit_ids = set()
+        for unit_ids in targeted_cells.values():
+            if len(unit_ids) > 1:
+                blocked_unit_ids.update(unit_ids)
+        return [action for action in move_actions if action[1]["unit_id"] not in blocked_unit_ids]
+
+    def _handle_actions(self, world: _World, actions: typing.List[typing.Tuple[str, typing.Dict]]) -> typing.List[typing.Dict]:
+        unit_events = []
+        for agent_id, packet in actions:
+            try:
+                world.handle_unit_action(packet)
+            except InvalidActionError:
+                continue
+            unit_events.append({"type": "unit", "agent_id": agent_id, "data": packet})
+        return unit_events + world.flush_events()
+
+
+"""
+Drop-in replacement for Gym backed by LocalForwardModel.
+"""
+class LocalGym():
+    def __init__(self, seed: typing.Optional[int] = None):
+        self._fwd = LocalForwardModel(seed)
+        self._channel_counter = 0
+        self._environments: typing.Dict[str, GymEnv] = {}
+
+    async def connect(self):
+        return None
+
+    async def close(self):
+        return None
+
+    def make(self, name: str, initial_state: typing.Dict) -> GymEnv:
+        if self._environments.get(name) is not None:
+            raise Exception(
+                f"environment \"{name}\" has already been instantiated")
+        self._environments[name] = GymEnv(
+            self._fwd, self._channel_counter, initial_state, self._send_next_state)
+        self._channel_counter += 1
+        return self._environments[name]
+
+    def make_vec(self, name: str, initial_state: typing.Dict, num_envs: int) -> VecGymEnv:
+        return VecGymEnv([self.make(f"{name}-{i}", initial_state) for i in range(num_envs)])
+
+    async def _send_next_state(self, state, actions, channel: int):
+        state = {key: value for key, value in state.items() if key != "connection"}
+        result = self._fwd.evaluate_next_state(state, actions)
+        result["sequence_id"] = channel
+        return result
@@ -0,0 +1,93 @@
+import collections
+import json
+import os
+import typing
+
+from components.environment.config import ACTIONS
+from components.environment.state import GameState
+
+ReplayStep = collections.namedtuple(
+    'ReplayStep',
+    ('tick', 'observation', 'actions')
+)
+
+
+"""
+Replay files are written by the engine at the end of a game: an
+"endgame_state" packet whose payload holds the `initial_state`, the
+`history` of tick packets (ticks without events are left out) and the
+`winning_agent_id`. A bare payload is accepted too.
+"""
+def load_replay(path: str) -> typing.Dict:
+    with open(path) as file:
+        replay = json.load(file)
+    if replay.get("type") == "endgame_state":
+        replay = replay.get("payload")
+    return replay
+
+
+"""
+Replay files under the given paths, a path being a file or a directory
+searched recursively, in a stable (sorted) order. Files are listed lazily,
+so directories of any size can be walked.
+"""
+def find_replays(paths: typing.Iterable[str], extension: str = ".json") -> typing.Iterator[str]:
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(extension):
+                    yield os.path.join(root, name)
+
+
+"""
+A copy of the game state that later events do not change. Events replace
+entities, entity lists (see EntityStore) and unit states rather than
+modifying them, so copying the top level and the unit_state mapping is enough.
+"""
+def snapshot_observation(game_state: typing.Dict) -> typing.Dict:
+    observation = dict(game_state.items())
+    observation["unit_state"] = dict(game_state["unit_state"])
+    return observation
+
+
+# Index into ACTIONS of a unit action packet, None for unknown ones
+def action_index(action_packet: typing.Dict) -> typing.Optional[int]:
+    action_type = action_packet.get("type")
+    action = action_packet.get("move") if action_type == "move" else action_type
+    return ACTIONS.index(action) if action in ACTIONS else None
+
+
+"""
+The observations of a replayed game, rebuilt by applying its events with
+GameState's handlers, one per tick from the initial state to the last tick
+of the history. Each step holds the observation after the tick's events and
+the actions (indices into ACTIONS, by unit id) the units took during the
+tick; units that did nothing are left out and the initial step has none.
+Observations are snapshots, so they can be kept across steps, and the
+replay itself is left unchanged.
+"""
+def replay_observations(replay: typing.Dict) -> typing.Iterator[ReplayStep]:
+    initial_state = replay["initial_state"]
+    game_state = GameState(None)
+    # unit states are set by events, keep the replay's own mapping as it is
+    game_state.set_state({**initial_state, "unit_state": dict(initial_state["unit_state"])})
+    tick = initial_state.get("tick", 0)
+    yield ReplayStep(tick, snapshot_observation(game_state.state), {})
+
+    history = replay.get("history", [])
+    last_tick = history[-1]["tick"] if history else tick
+    game_ticks = {game_tick["tick"]: game_tick for game_tick in history}
+    for tick in range(tick + 1, last_tick + 1):
+        game_tick = game_ticks.get(tick, {"tick": tick, "events": []})
+        game_state.apply_tick(game_tick)
+        actions = {}
+        for event in game_tick["events"]:
+            if event.get("type") == "unit":
+                action = action_index(event["data"])
+                if action is not None:
+                    actions[event["data"]["unit_id"]] = action
+        yield ReplayStep(tick, snapshot_observation(game_state.state), actions)
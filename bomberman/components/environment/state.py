@@ -1,16 +1,109 @@
+import asyncio
+import collections
 import json
+import time
 import typing
 import websockets
 
 from websockets.client import WebSocketClientProtocol
 
+from components.state import IncrementalStateEncoder
+
 _move_set = set(("up", "down", "left", "right"))
 
+"""
+Entities of the game state with O(1) spawn, expire and update by cell.
+
+Entities are kept in a dict by insertion sequence, which iterates in the
+order the engine's entities list would have, and indexed by (x, y). The list
+view is only built when asked for, and a change always produces a new list,
+so caches keyed by the list's identity (see get_observation_index) stay valid.
+"""
+class EntityStore:
+    def __init__(self, entities: typing.List[typing.Dict]):
+        self._entities: typing.Dict[int, typing.Dict] = {}
+        self._by_cell: typing.Dict[typing.Tuple[int, int], typing.List[int]] = collections.defaultdict(list)
+        self._next_id = 0
+        self._view = None
+        for entity in entities:
+            self.add(entity)
+
+    def __len__(self):
+        return len(self._entities)
+
+    def add(self, entity: typing.Dict):
+        self._entities[self._next_id] = entity
+        self._by_cell[(entity.get("x"), entity.get("y"))].append(self._next_id)
+        self._next_id += 1
+        self._view = None
+
+    def remove_at(self, x: int, y: int):
+        ids = self._by_cell.pop((x, y), None)
+        if ids:
+            for id in ids:
+                del self._entities[id]
+            self._view = None
+
+    def replace_at(self, x: int, y: int, entity: typing.Dict):
+        self.remove_at(x, y)
+        self.add(entity)
+
+    def as_list(self) -> typing.List[typing.Dict]:
+        if self._view is None:
+            self._view = list(self._entities.values())
+        return self._view
+
+
+"""
+Game state dict whose "entities" are read from an EntityStore, so the list
+is materialized on access instead of after every event.
+
+Every way of reading the dict's entries (indexing, get, iteration, items,
+values, copy, and through them dict(state), {**state} and json.dumps)
+refreshes the raw "entities" entry from the store first.
+"""
+class StoredGameState(dict):
+    def __init__(self, game_state: typing.Dict, entities: EntityStore):
+        super().__init__(game_state)
+        self.entities = entities
+        self._refresh()
+
+    def _refresh(self):
+        dict.__setitem__(self, "entities", self.entities.as_list())
+
+    def __getitem__(self, key):
+        if key == "entities":
+            self._refresh()
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __iter__(self):
+        self._refresh()
+        return super().__iter__()
+
+    def items(self):
+        self._refresh()
+        return super().items()
+
+    def values(self):
+        self._refresh()
+        return super().values()
+
+    def copy(self):
+        self._refresh()
+        return super().copy()
+
+
 class GameState:
     def __init__(self, connection_string: str):
         self._connection_string = connection_string
         self._state = None
+        self._encoder = None
         self._tick_callback = None
+        # perf_counter() when the last message arrived, ticks are timed from it
+        self.message_received_at = None
 
     def set_game_tick_callback(self, generate_agent_action_callback):
         self._tick_callback = generate_agent_action_callback
@@ -23,24 +116,43 @@ class GameState:
     async def _send(self, packet):
         await self.connection.send(json.dumps(packet))
 
-    async def send_move(self, move: str, unit_id: str):
+    """
+    Sends several packets at once: all of them are serialized before the
+    first one is written, then written concurrently. The engine reads one
+    packet per websocket frame, so they cannot be merged into one message.
+    """
+    async def send_packets(self, packets: typing.List[typing.Dict]):
+        messages = [json.dumps(packet) for packet in packets]
+        await asyncio.gather(*(self.connection.send(message) for message in messages))
+
+    def move_packet(self, move: str, unit_id: str):
         if move in _move_set:
-            packet = {"type": "move", "move": move, "unit_id": unit_id}
+            return {"type": "move", "move": move, "unit_id": unit_id}
+        return None
+
+    def bomb_packet(self, unit_id: str):
+        return {"type": "bomb", "unit_id": unit_id}
+
+    def detonate_packet(self, x, y, unit_id: str):
+        return {"type": "detonate", "coordinates": [
+            x, y], "unit_id": unit_id}
+
+    async def send_move(self, move: str, unit_id: str):
+        packet = self.move_packet(move, unit_id)
+        if packet is not None:
             await self._send(packet)
 
     async def send_bomb(self, unit_id: str):
-        packet = {"type": "bomb", "unit_id": unit_id}
-        await self._send(packet)
+        await self._send(self.bomb_packet(unit_id))
 
     async def send_detonate(self, x, y, unit_id: str):
-        packet = {"type": "detonate", "coordinates": [
-            x, y], "unit_id": unit_id}
-        await self._send(packet)
+        await self._send(self.detonate_packet(x, y, unit_id))
 
     async def _handle_messages(self, connection: WebSocketClientProtocol):
         while True:
             try:
                 raw_data = await connection.recv()
+                self.message_received_at = time.perf_counter()
                 data = json.loads(raw_data)
                 await self._on_data(data)
             except websockets.exceptions.ConnectionClosed:
@@ -55,7 +167,7 @@ class GameState:
             pass
         elif data_type == "game_state":
             payload = data.get("payload")
-            self._on_game_state(payload)
+            self.set_state(payload)
         elif data_type == "tick":
             payload = data.get("payload")
             await self._on_game_tick(payload)
@@ -66,12 +178,33 @@ class GameState:
         else:
             print(f"unknown packet \"{data_type}\": {data}")
 
-    def _on_game_state(self, game_state):
-        self._state = game_state
+    def set_state(self, game_state):
+        self._state = StoredGameState(game_state, EntityStore(game_state.get("entities", [])))
+        self._encoder = IncrementalStateEncoder(game_state)
+
+    @property
+    def state(self):
+        return self._state
+
+    """
+    Flat states (see observation_to_states) of the current game state, one
+    row per unit. The encoded map is kept up to date by the tick events, so
+    this only costs the units' cells and coordinates.
+    """
+    def encode_states(self, agent_id: str, unit_ids: typing.List[str]):
+        return self._encoder.encode_batch(self._state, agent_id, unit_ids)
 
     async def _on_game_tick(self, game_tick):
-        events = game_tick.get("events")
-        for event in events:
+        self.apply_tick(game_tick)
+        if self._tick_callback is not None:
+            await self._tick_callback(game_tick.get("tick"), self._state)
+
+    """
+    Applies the events of a tick packet to the game state, e.g. the ticks of
+    a replay's history (see components/environment/replay.py).
+    """
+    def apply_tick(self, game_tick):
+        for event in game_tick.get("events"):
             event_type = event.get("type")
             if event_type == "entity_spawned":
                 self._on_entity_spawned(event)
@@ -89,37 +222,27 @@ class GameState:
                 self._on_unit_action(unit_action)
             else:
                 print(f"unknown event type {event_type}: {event}")
-        if self._tick_callback is not None:
-            tick_number = game_tick.get("tick")
-            self._state["tick"] = tick_number
-            await self._tick_callback(tick_number, self._state)
+        self._state["tick"] = game_tick.get("tick")
 
     def _on_entity_spawned(self, spawn_event):
         spawn_payload = spawn_event.get("data")
-        self._state["entities"].append(spawn_payload)
+        self._state.entities.add(spawn_payload)
+        self._encoder.set_entity(spawn_payload)
 
     def _on_entity_expired(self, spawn_event):
         expire_payload = spawn_event.get("data")
-
-        def filter_entity_fn(entity):
-            [x, y] = expire_payload
-            entity_x = entity.get("x")
-            entity_y = entity.get("y")
-            should_remove = entity_x == x and entity_y == y
-            return should_remove == False
-
-        self._state["entities"] = list(filter(
-            filter_entity_fn, self._state["entities"]))
+        [x, y] = expire_payload
+        self._state.entities.remove_at(x, y)
+        self._encoder.clear_cell(x, y)
 
     def _on_unit_state(self, unit_state):
         unit_id = unit_state.get("unit_id")
         self._state["unit_state"][unit_id] = unit_state
 
     def _on_entity_state(self, x, y, updated_entity):
-        for entity in self._state.get("entities"):
-            if entity.get("x") == x and entity.get("y") == y:
-                self._state["entities"].remove(entity)
-        self._state["entities"].append(updated_entity)
+        self._state.entities.replace_at(x, y, updated_entity)
+        self._encoder.clear_cell(x, y)
+        self._encoder.set_entity(updated_entity)
 
     def _on_unit_action(self, action_packet):
         unit_id = action_packet["unit_id"]
@@ -131,7 +254,8 @@ class GameState:
             if move in _move_set:
                 new_coordinates = self._get_new_unit_coordinates(
                     coordinates, move)
-                self._state["unit_state"][unit_id]["coordinates"] = new_coordinates
+                # a new dict, the unit's may be an event payload or in a kept observation
+                self._state["unit_state"][unit_id] = {**unit, "coordinates": new_coordinates}
         elif action_type == "bomb":
             # no - op since this is redundant info
             pass
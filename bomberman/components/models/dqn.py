@@ -1,31 +1,182 @@
 import collections
-import random
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from components.models.spatial import SpatialEncoder
+from components.state import compact_state_shape, compact_states, expand_states, is_spatial_state_dim
+
 DQN_AGENT_PATH = "agent_dqn.pt"
 
 Transition = collections.namedtuple(
     'Transition',
-    ('state', 'action', 'next_state', 'reward')
+    ('state', 'action', 'next_state', 'reward', 'done')
 )
 
+"""
+Ring buffer of transitions in preallocated tensors. States are stored
+compacted (flat states bit-packed, spatial states as uint8, see
+compact_states); states already compacted are stored as they are. A pushed
+`next_state` of None marks a final transition. `sample` returns a Transition
+of ready-made, expanded batch tensors.
+"""
 class ReplayMemory(object):
-    def __init__(self, capacity: int):
-        self.memory = collections.deque([], maxlen=capacity)
+    def __init__(self, capacity: int, state_dim):
+        self.capacity = capacity
+        self.state_dim = state_dim
+        compact_shape = compact_state_shape(state_dim)
+        self.states = torch.zeros((capacity, *compact_shape), dtype=torch.uint8)
+        self.next_states = torch.zeros((capacity, *compact_shape), dtype=torch.uint8)
+        self.actions = torch.zeros((capacity, 1), dtype=torch.int64)
+        self.rewards = torch.zeros(capacity, dtype=torch.float32)
+        self.dones = torch.zeros(capacity, dtype=torch.bool)
+        self.position = 0
+        self.size = 0
+
+    def _compact(self, state):
+        return compact_states(state, self.state_dim)
+
+    def push(self, state, action, next_state, reward, done=False):
+        i = self.position
+        self.states[i] = self._compact(state)
+        self.actions[i] = action
+        self.rewards[i] = float(reward)
+        if next_state is None:
+            self.next_states[i] = 0
+            self.dones[i] = True
+        else:
+            self.next_states[i] = self._compact(next_state)
+            self.dones[i] = bool(done)
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
 
-    def push(self, *args):
-        self.memory.append(Transition(*args))
+    def sample(self, batch_size, device=None):
+        indices = torch.randint(0, self.size, (batch_size,))
+        return self.get(indices, device)
 
-    def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
+    def get(self, indices, device=None):
+        return Transition(
+            expand_states(self.states[indices].to(device), self.state_dim),
+            self.actions[indices].to(device),
+            expand_states(self.next_states[indices].to(device), self.state_dim),
+            self.rewards[indices].to(device),
+            self.dones[indices].to(device),
+        )
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
+
+
+"""
+Binary sum tree over `capacity` leaves in one flat array (root at 1, the
+children of node i at 2i and 2i + 1). Updates and prefix-sum lookups are
+done for a whole batch of leaves at once, one tree level per step.
+"""
+class SumTree(object):
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.depth = max(int(np.ceil(np.log2(capacity))), 0)
+        self.leaves = 2 ** self.depth
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    @property
+    def total(self) -> float:
+        return self.tree[1]
+
+    def get(self, indices: np.ndarray) -> np.ndarray:
+        return self.tree[indices + self.leaves]
+
+    def update(self, indices: np.ndarray, priorities: np.ndarray):
+        nodes = np.asarray(indices, dtype=np.int64) + self.leaves
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    # Leaf index of every value's position in the cumulative priorities
+    def find(self, values: np.ndarray) -> np.ndarray:
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values > self.tree[left]
+            values -= self.tree[left] * go_right
+            nodes = left + go_right
+        return nodes - self.leaves
+
+
+"""
+Proportional prioritized replay (Schaul et al., 2015). Transitions are
+sampled with probability p_i^alpha / sum_k p_k^alpha, where p_i is the last
+TD error seen for them (new transitions get the highest priority so far).
+`sample` also returns the transitions' indices, for `update_priorities`, and
+importance-sampling weights (N * P(i))^-beta normalized by their maximum;
+beta is annealed towards 1 by `beta_increment` per sampled batch.
+"""
+class PrioritizedReplayMemory(ReplayMemory):
+    def __init__(self, capacity: int, state_dim, alpha: float = 0.6, beta: float = 0.4, beta_increment: float = 1e-5, eps: float = 1e-6):
+        super(PrioritizedReplayMemory, self).__init__(capacity, state_dim)
+        self.priorities = SumTree(capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.eps = eps
+        self.max_priority = 1.0
+
+    def push(self, *args, **kwargs):
+        position = self.position
+        super(PrioritizedReplayMemory, self).push(*args, **kwargs)
+        self.priorities.update(np.array([position]), np.array([self.max_priority ** self.alpha]))
+
+    def sample(self, batch_size, device=None):
+        # One value per equal segment of the total priority (stratified sampling)
+        segment = self.priorities.total / batch_size
+        values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * segment
+        indices = np.minimum(self.priorities.find(values), self.size - 1)
+
+        probabilities = self.priorities.get(indices) / self.priorities.total
+        weights = (self.size * probabilities) ** -self.beta
+        weights = weights / weights.max()
+        self.beta = min(1.0, self.beta + self.beta_increment)
+
+        indices = torch.from_numpy(indices)
+        return self.get(indices, device), indices, torch.tensor(weights, dtype=torch.float32, device=device)
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64)) + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.priorities.update(np.asarray(indices), priorities ** self.alpha)
+
+
+"""
+Polyak update of the target network, θ′ ← τ θ + (1 − τ) θ′, applied in place
+over all parameters with fused multi-tensor ops.
+
+With `every` > 1 the update only runs on every `every`-th call, using the
+compounded rate 1 − (1 − τ)^every so the target moves at about the same
+overall speed.
+"""
+class SoftUpdate(object):
+    def __init__(self, target_net: nn.Module, policy_net: nn.Module, tau: float, every: int = 1):
+        self.target_tensors = list(target_net.parameters()) + [b for b in target_net.buffers() if b.is_floating_point()]
+        self.policy_tensors = list(policy_net.parameters()) + [b for b in policy_net.buffers() if b.is_floating_point()]
+        self.tau = 1 - (1 - tau) ** every
+        self.every = every
+        self.calls = 0
+
+    @torch.no_grad()
+    def __call__(self):
+        self.calls += 1
+        if self.calls % self.every != 0:
+            return
+        torch._foreach_mul_(self.target_tensors, 1 - self.tau)
+        torch._foreach_add_(self.target_tensors, self.policy_tensors, alpha=self.tau)
 
 
 class DQNAgent(nn.Module):
+    state_encoding = 'flat'
+
     def __init__(self, n_observations, n_actions):
         super(DQNAgent, self).__init__()
         self.layer1 = nn.Linear(n_observations, 64)
@@ -43,3 +194,28 @@ class DQNAgent(nn.Module):
    
     def show(self):
         print(self)
+
+
+"""
+DQNAgent over spatial states: the convolutional backbone replaces the
+n_observations x 64 input layer.
+"""
+class SpatialDQNAgent(DQNAgent):
+    state_encoding = 'spatial'
+
+    def __init__(self, state_shape, n_actions):
+        nn.Module.__init__(self)
+        self.encoder = SpatialEncoder(state_shape[0])
+        self.layer1 = nn.Linear(self.encoder.features, 64)
+        self.layer2 = nn.Linear(64, 64)
+        self.layer3 = nn.Linear(64, n_actions)
+
+    def forward(self, state):
+        return super(SpatialDQNAgent, self).forward(self.encoder(state))
+
+
+# The DQN agent matching a state encoding's dimensions (see STATE_ENCODINGS)
+def make_dqn_agent(state_dim, n_actions) -> DQNAgent:
+    if is_spatial_state_dim(state_dim):
+        return SpatialDQNAgent(state_dim, n_actions)
+    return DQNAgent(state_dim, n_actions)
@@ -1,34 +1,132 @@
 # Reference: https://github.com/nikhilbarhate99/PPO-PyTorch/blob/master/PPO.py
 
+import time
 import torch
 import torch.nn as nn
 
 from torch.distributions import MultivariateNormal
 from torch.distributions import Categorical
 
+from components.models.spatial import SpatialEncoder
+from components.state import compact_state_shape, compact_states, expand_states, is_compact_state, is_spatial_state_dim
 from components.utils.device import device
 
 PPO_AGENT_PATH = "agent_ppo.pt"
 
+"""
+Fixed-capacity buffer of one rollout, written into preallocated tensors by
+index. `add` records what select_action produced, `add_reward` what the
+environment answered; `clear` only rewinds the write positions.
+
+With `packed_states` the states are stored compacted, see compact_states;
+both compacted and expanded states are accepted.
+"""
 class RolloutBuffer:
-    def __init__(self):
-        self.actions = []
-        self.states = []
-        self.logprobs = []
-        self.rewards = []
-        self.state_values = []
-        self.is_terminals = []
-    
-    def clear(self):
-        del self.actions[:]
-        del self.states[:]
-        del self.logprobs[:]
-        del self.rewards[:]
-        del self.state_values[:]
-        del self.is_terminals[:]
+    def __init__(self, capacity, state_dim, action_shape=(), action_dtype=torch.int64, packed_states=False):
+        self.capacity = capacity
+        self.state_dim = state_dim
+        self.packed_states = packed_states
+        if packed_states:
+            self.states = torch.zeros((capacity, *compact_state_shape(state_dim)), dtype=torch.uint8, device=device)
+        else:
+            state_shape = tuple(state_dim) if is_spatial_state_dim(state_dim) else (state_dim,)
+            self.states = torch.zeros((capacity, *state_shape), dtype=torch.float32, device=device)
+        self.actions = torch.zeros((capacity, *action_shape), dtype=action_dtype, device=device)
+        self.logprobs = torch.zeros(capacity, dtype=torch.float32, device=device)
+        self.rewards = torch.zeros(capacity, dtype=torch.float32, device=device)
+        self.state_values = torch.zeros(capacity, dtype=torch.float32, device=device)
+        self.is_terminals = torch.zeros(capacity, dtype=torch.bool, device=device)
+        self.size = 0
+        self.rewarded = 0
+
+    def _stored(self, states):
+        if is_compact_state(states, self.state_dim):
+            return states if self.packed_states else expand_states(states, self.state_dim)
+        return compact_states(states, self.state_dim) if self.packed_states else states
+
+    def get_states(self, indices=None):
+        states = self.states[:self.size] if indices is None else self.states[indices]
+        return expand_states(states, self.state_dim) if self.packed_states else states
+
+    def add(self, state, action, logprob, state_value):
+        if self.size >= self.capacity:
+            raise IndexError(f"rollout buffer is full ({self.capacity} transitions), call PPO.update first")
+        self.states[self.size] = self._stored(state)
+        self.actions[self.size] = action
+        self.logprobs[self.size] = logprob
+        self.state_values[self.size] = state_value.reshape(())
+        self.size += 1
+
+    def add_reward(self, reward, is_terminal):
+        self.rewards[self.rewarded] = float(reward)
+        self.is_terminals[self.rewarded] = bool(is_terminal)
+        self.rewarded += 1
+
+    def extend(self, states, actions, logprobs, state_values, rewards, is_terminals):
+        if self.size != self.rewarded:
+            raise ValueError("cannot extend a rollout buffer with transitions still waiting for their rewards")
+        start, end = self.size, self.size + len(states)
+        if end > self.capacity:
+            raise IndexError(f"rollout buffer is full ({self.capacity} transitions), call PPO.update first")
+        self.states[start:end] = self._stored(states)
+        self.actions[start:end] = actions
+        self.logprobs[start:end] = logprobs
+        self.state_values[start:end] = state_values
+        self.rewards[start:end] = rewards
+        self.is_terminals[start:end] = is_terminals
+        self.size = self.rewarded = end
 
+    def clear(self):
+        self.size = 0
+        self.rewarded = 0
+
+
+"""
+Discounted returns restarted at every terminal step, in a single backward
+pass. Scalars are read out once, the loop itself stays off the tensors.
+"""
+def discounted_returns(rewards: torch.Tensor, is_terminals: torch.Tensor, gamma: float) -> torch.Tensor:
+    returns = [0.0] * len(rewards)
+    discounted_reward = 0.0
+    for i, (reward, is_terminal) in enumerate(zip(reversed(rewards.tolist()), reversed(is_terminals.tolist()))):
+        if is_terminal:
+            discounted_reward = 0.0
+        discounted_reward = reward + gamma * discounted_reward
+        returns[-1 - i] = discounted_reward
+    return torch.tensor(returns, dtype=torch.float32, device=rewards.device)
+
+
+"""
+Generalized advantage estimation (GAE-lambda). The step after a terminal, and
+after the last step of the buffer, is valued 0.
+"""
+def generalized_advantages(rewards: torch.Tensor, state_values: torch.Tensor, is_terminals: torch.Tensor, gamma: float, gae_lambda: float) -> torch.Tensor:
+    advantages = [0.0] * len(rewards)
+    advantage, next_value = 0.0, 0.0
+    steps = zip(reversed(rewards.tolist()), reversed(state_values.tolist()), reversed(is_terminals.tolist()))
+    for i, (reward, value, is_terminal) in enumerate(steps):
+        if is_terminal:
+            advantage, next_value = 0.0, 0.0
+        delta = reward + gamma * next_value - value
+        advantage = delta + gamma * gae_lambda * advantage
+        advantages[-1 - i] = advantage
+        next_value = value
+    return torch.tensor(advantages, dtype=torch.float32, device=rewards.device)
+
+
+"""
+With `shared_trunk` the actor and the critic share their first two (widest)
+layers and only keep separate heads, so the state_dim x 256 input layer is
+computed once per state instead of twice.
+
+A spatial `state_dim` ((C, H, W), see STATE_ENCODINGS) always gets a shared
+trunk, with the convolutional backbone in place of the first layer.
+
+Checkpoints saved before the option existed have no `trunk` and load as the
+separate-network variant.
+"""
 class ActorCritic(nn.Module):
-    def __init__(self, state_dim, action_dim, has_continuous_action_space, action_std_init):
+    def __init__(self, state_dim, action_dim, has_continuous_action_space, action_std_init, shared_trunk=False):
         super(ActorCritic, self).__init__()
 
         self.has_continuous_action_space = has_continuous_action_space
@@ -36,12 +134,32 @@ class ActorCritic(nn.Module):
         if has_continuous_action_space:
             self.action_dim = action_dim
             self.action_var = torch.full((action_dim,), action_std_init * action_std_init).to(device)
+
+        self.state_encoding = 'spatial' if is_spatial_state_dim(state_dim) else 'flat'
+        if self.state_encoding == 'spatial':
+            encoder = SpatialEncoder(state_dim[0])
+            self.trunk = nn.Sequential(
+                encoder,
+                nn.Linear(encoder.features, 256),
+                nn.ReLU(),
+            )
+            actor_layers, critic_layers = [], []
+        elif shared_trunk:
+            self.trunk = nn.Sequential(
+                nn.Linear(state_dim, 256),
+                nn.ReLU(),
+                nn.Linear(256, 256),
+                nn.ReLU(),
+            )
+            actor_layers, critic_layers = [], []
+        else:
+            self.trunk = None
+            actor_layers = [nn.Linear(state_dim, 256), nn.ReLU(), nn.Linear(256, 256), nn.ReLU()]
+            critic_layers = [nn.Linear(state_dim, 256), nn.ReLU(), nn.Linear(256, 256), nn.ReLU()]
+
         # actor
         self.actor = nn.Sequential(
-            nn.Linear(state_dim, 256),
-            nn.ReLU(),
-            nn.Linear(256, 256),
-            nn.ReLU(),
+            *actor_layers,
             nn.Linear(256, 128),
             nn.ReLU(),
             nn.Linear(128, 128),
@@ -55,10 +173,7 @@ class ActorCritic(nn.Module):
         )
 
         self.critic = nn.Sequential(
-           nn.Linear(state_dim, 256),
-            nn.ReLU(),
-            nn.Linear(256, 256),
-            nn.ReLU(),
+            *critic_layers,
             nn.Linear(256, 128),
             nn.ReLU(),
             nn.Linear(128, 128),
@@ -67,8 +182,12 @@ class ActorCritic(nn.Module):
             nn.ReLU(),
             nn.Linear(64, 64),
             nn.ReLU(),
-           nn.Linear(64, 1),
+            nn.Linear(64, 1),
         )
+
+    def _features(self, state):
+        trunk = getattr(self, "trunk", None)
+        return state if trunk is None else trunk(state)
         
     def set_action_std(self, new_action_std):
         if self.has_continuous_action_space:
@@ -79,25 +198,27 @@ class ActorCritic(nn.Module):
             print("--------------------------------------------------------------------------------------------")
 
     def forward(self, state):
+        features = self._features(state)
 
         if self.has_continuous_action_space:
-            action_mean = self.actor(state)
+            action_mean = self.actor(features)
             cov_mat = torch.diag(self.action_var).unsqueeze(dim=0)
             dist = MultivariateNormal(action_mean, cov_mat)
         else:
-            action_probs = self.actor(state)
+            action_probs = self.actor(features)
             dist = Categorical(action_probs)
 
         action = dist.sample()
         action_logprob = dist.log_prob(action)
-        state_val = self.critic(state)
+        state_val = self.critic(features)
 
         return action.detach(), action_logprob.detach(), state_val.detach()
     
     def evaluate(self, state, action):
+        features = self._features(state)
 
         if self.has_continuous_action_space:
-            action_mean = self.actor(state)
+            action_mean = self.actor(features)
             
             action_var = self.action_var.expand_as(action_mean)
             cov_mat = torch.diag_embed(action_var).to(device)
@@ -107,17 +228,17 @@ class ActorCritic(nn.Module):
             if self.action_dim == 1:
                 action = action.reshape(-1, self.action_dim)
         else:
-            action_probs = self.actor(state)
+            action_probs = self.actor(features)
             dist = Categorical(action_probs)
         action_logprobs = dist.log_prob(action)
         dist_entropy = dist.entropy()
-        state_values = self.critic(state)
+        state_values = self.critic(features)
         
         return action_logprobs, state_values, dist_entropy
 
 
 class PPO:
-    def __init__(self, state_dim, action_dim, lr_actor, lr_critic, gamma, K_epochs, eps_clip, has_continuous_action_space, action_std_init=0.6):
+    def __init__(self, state_dim, action_dim, lr_actor, lr_critic, gamma, K_epochs, eps_clip, has_continuous_action_space, action_std_init=0.6, buffer_size=4096, gae_lambda=None, packed_states=False, minibatch_size=None, target_kl=None, shared_trunk=False):
 
         self.has_continuous_action_space = has_continuous_action_space
 
@@ -125,18 +246,29 @@ class PPO:
             self.action_std = action_std_init
 
         self.gamma = gamma
+        self.gae_lambda = gae_lambda
         self.eps_clip = eps_clip
         self.K_epochs = K_epochs
+        self.minibatch_size = minibatch_size
+        self.target_kl = target_kl
+        self.update_stats = {}
         
-        self.buffer = RolloutBuffer()
-
-        self.policy = ActorCritic(state_dim, action_dim, has_continuous_action_space, action_std_init).to(device)
-        self.optimizer = torch.optim.Adam([
-                        {'params': self.policy.actor.parameters(), 'lr': lr_actor},
-                        {'params': self.policy.critic.parameters(), 'lr': lr_critic}
-                    ])
-
-        self.policy_old = ActorCritic(state_dim, action_dim, has_continuous_action_space, action_std_init).to(device)
+        if has_continuous_action_space:
+            self.buffer = RolloutBuffer(buffer_size, state_dim, (action_dim,), torch.float32, packed_states)
+        else:
+            self.buffer = RolloutBuffer(buffer_size, state_dim, packed_states=packed_states)
+
+        self.policy = ActorCritic(state_dim, action_dim, has_continuous_action_space, action_std_init, shared_trunk).to(device)
+        parameter_groups = [
+            {'params': self.policy.actor.parameters(), 'lr': lr_actor},
+            {'params': self.policy.critic.parameters(), 'lr': lr_critic}
+        ]
+        if self.policy.trunk is not None:
+            # the trunk is trained by both losses, keep it at the (smaller) actor rate
+            parameter_groups.append({'params': self.policy.trunk.parameters(), 'lr': lr_actor})
+        self.optimizer = torch.optim.Adam(parameter_groups)
+
+        self.policy_old = ActorCritic(state_dim, action_dim, has_continuous_action_space, action_std_init, shared_trunk).to(device)
         self.policy_old.load_state_dict(self.policy.state_dict())
         
         self.MseLoss = nn.MSELoss()
@@ -174,10 +306,7 @@ class PPO:
                 state = torch.FloatTensor(state).to(device)
                 action, action_logprob, state_val = self.policy_old(state)
 
-            self.buffer.states.append(state)
-            self.buffer.actions.append(action)
-            self.buffer.logprobs.append(action_logprob)
-            self.buffer.state_values.append(state_val)
+            self.buffer.add(state, action, action_logprob, state_val)
 
             return action.detach().cpu().numpy().flatten()
         else:
@@ -185,65 +314,112 @@ class PPO:
                 state = torch.FloatTensor(state).to(device)
                 action, action_logprob, state_val = self.policy_old(state)
             
-            self.buffer.states.append(state)
-            self.buffer.actions.append(action)
-            self.buffer.logprobs.append(action_logprob)
-            self.buffer.state_values.append(state_val)
+            self.buffer.add(state, action, action_logprob, state_val)
 
             return action.item()
 
+    """
+    K_epochs passes over the buffer, each in shuffled minibatches of
+    `minibatch_size` (the whole buffer at once when None). With `target_kl`
+    the update stops early once the approximate KL divergence between the
+    old and the updated policy on a minibatch exceeds it.
+    Timings and statistics of the last update are kept in `update_stats`.
+    """
     def update(self):
-        # Monte Carlo estimate of returns
-        rewards = []
-        discounted_reward = 0
-        for reward, is_terminal in zip(reversed(self.buffer.rewards), reversed(self.buffer.is_terminals)):
-            if is_terminal:
-                discounted_reward = 0
-            discounted_reward = reward + (self.gamma * discounted_reward)
-            rewards.insert(0, discounted_reward)
-            
-        # Normalizing the rewards
-        rewards = torch.tensor(rewards, dtype=torch.float32).to(device)
-        rewards = (rewards - rewards.mean()) / (rewards.std() + 1e-7)
+        start_time = time.perf_counter()
+        buffer = self.buffer
+        if buffer.size != buffer.rewarded:
+            raise ValueError(f"{buffer.size} actions in the rollout buffer but {buffer.rewarded} rewards")
 
-        # convert list to tensor
-        old_states = torch.squeeze(torch.stack(self.buffer.states, dim=0)).detach().to(device)
-        old_actions = torch.squeeze(torch.stack(self.buffer.actions, dim=0)).detach().to(device)
-        old_logprobs = torch.squeeze(torch.stack(self.buffer.logprobs, dim=0)).detach().to(device)
-        old_state_values = torch.squeeze(torch.stack(self.buffer.state_values, dim=0)).detach().to(device)
+        # views of the filled part of the buffer, states are read per minibatch
+        old_actions = buffer.actions[:buffer.size]
+        old_logprobs = buffer.logprobs[:buffer.size]
+        old_state_values = buffer.state_values[:buffer.size]
 
-        # calculate advantages
-        advantages = rewards.detach() - old_state_values.detach()
+        if self.gae_lambda is None:
+            # Monte Carlo estimate of returns
+            rewards = discounted_returns(buffer.rewards[:buffer.size], buffer.is_terminals[:buffer.size], self.gamma)
 
-        # Optimize policy for K epochs
-        for _ in range(self.K_epochs):
+            # Normalizing the rewards
+            rewards = (rewards - rewards.mean()) / (rewards.std() + 1e-7)
 
-            # Evaluating old actions and values
-            logprobs, state_values, dist_entropy = self.policy.evaluate(old_states, old_actions)
+            # calculate advantages
+            advantages = rewards - old_state_values
+        else:
+            advantages = generalized_advantages(
+                buffer.rewards[:buffer.size], old_state_values, buffer.is_terminals[:buffer.size], self.gamma, self.gae_lambda)
+            rewards = advantages + old_state_values
+            advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-7)
+        returns_time = time.perf_counter()
 
-            # match state_values tensor dimensions with rewards tensor
-            state_values = torch.squeeze(state_values)
-            
-            # Finding the ratio (pi_theta / pi_theta__old)
-            ratios = torch.exp(logprobs - old_logprobs.detach())
+        minibatch_size = self.minibatch_size or buffer.size
+        all_states = buffer.get_states() if minibatch_size >= buffer.size else None
+        epochs, minibatches, approx_kl, stopped_early = 0, 0, 0.0, False
 
-            # Finding Surrogate Loss  
-            surr1 = ratios * advantages
-            surr2 = torch.clamp(ratios, 1-self.eps_clip, 1+self.eps_clip) * advantages
+        # Optimize policy for K epochs
+        for _ in range(self.K_epochs):
+            epochs += 1
+            if all_states is None:
+                order = torch.randperm(buffer.size, device=old_actions.device)
+            for start in range(0, buffer.size, minibatch_size):
+                if all_states is None:
+                    indices = order[start:start + minibatch_size]
+                    states, actions = buffer.get_states(indices), old_actions[indices]
+                    minibatch_logprobs, minibatch_advantages, minibatch_rewards = old_logprobs[indices], advantages[indices], rewards[indices]
+                else:
+                    states, actions = all_states, old_actions
+                    minibatch_logprobs, minibatch_advantages, minibatch_rewards = old_logprobs, advantages, rewards
+
+                # Evaluating old actions and values
+                logprobs, state_values, dist_entropy = self.policy.evaluate(states, actions)
+
+                # match state_values tensor dimensions with rewards tensor
+                state_values = state_values.reshape(-1)
+
+                # Finding the ratio (pi_theta / pi_theta__old)
+                log_ratios = logprobs - minibatch_logprobs
+                ratios = torch.exp(log_ratios)
+
+                # Finding Surrogate Loss  
+                surr1 = ratios * minibatch_advantages
+                surr2 = torch.clamp(ratios, 1-self.eps_clip, 1+self.eps_clip) * minibatch_advantages
+
+                # final loss of clipped objective PPO
+                loss = -torch.min(surr1, surr2) + 0.5 * self.MseLoss(state_values, minibatch_rewards) - 0.01 * dist_entropy
+
+                # take gradient step
+                self.optimizer.zero_grad()
+                loss.mean().backward()
+                self.optimizer.step()
+                minibatches += 1
+
+                # KL(old || new) estimate from the policy before this step (http://joschu.net/blog/kl-approx.html)
+                with torch.no_grad():
+                    approx_kl = ((ratios - 1) - log_ratios).mean().item()
+                if self.target_kl is not None and approx_kl > self.target_kl:
+                    stopped_early = True
+                    break
+            if stopped_early:
+                break
+        optimize_time = time.perf_counter()
 
-            # final loss of clipped objective PPO
-            loss = -torch.min(surr1, surr2) + 0.5 * self.MseLoss(state_values, rewards) - 0.01 * dist_entropy
-            
-            # take gradient step
-            self.optimizer.zero_grad()
-            loss.mean().backward()
-            self.optimizer.step()
-            
         # Copy new weights into old policy
         self.policy_old.load_state_dict(self.policy.state_dict())
 
+        self.update_stats = {
+            "transitions": buffer.size,
+            "epochs": epochs,
+            "minibatches": minibatches,
+            "approx_kl": approx_kl,
+            "stopped_early": stopped_early,
+            "returns_seconds": returns_time - start_time,
+            "optimize_seconds": optimize_time - returns_time,
+            "total_seconds": time.perf_counter() - start_time,
+        }
+
         # clear buffer
         self.buffer.clear()
+        return self.update_stats
     
     def save(self):
         torch.save(self.policy_old, PPO_AGENT_PATH)
@@ -0,0 +1,205 @@
+import asyncio
+import collections
+import copy
+import queue
+import traceback
+import typing
+
+import torch
+import torch.multiprocessing as mp
+
+from components.action import make_action
+from components.environment.config import FWD_MODEL_CONNECTION_DELAY, FWD_MODEL_CONNECTION_RETRIES
+from components.environment.gym import Gym
+from components.environment.local_forward_model import LocalGym
+from components.models.ppo import ActorCritic, RolloutBuffer
+from components.reward import calculate_reward
+from components.state import STATE_ENCODINGS, compact_state_shape, compact_states
+
+RolloutStats = collections.namedtuple(
+    'RolloutStats',
+    ('worker_id', 'steps', 'cumulative_reward', 'episodes_done')
+)
+
+# Sent instead of RolloutStats by a worker that failed, with the formatted traceback
+RolloutError = collections.namedtuple(
+    'RolloutError',
+    ('worker_id', 'traceback')
+)
+
+RESULT_POLL_INTERVAL = 5 # seconds between checks that the workers are still alive while waiting for them
+
+"""
+Everything a worker needs to rebuild its environment and policy in a fresh
+process (Gym connections and models are not picklable).
+"""
+RolloutConfig = collections.namedtuple(
+    'RolloutConfig',
+    ('state_dim', 'action_dim', 'steps_per_rollout', 'initial_state', 'agents', 'units', 'fwd_model_uri', 'fwd_model_local', 'state_encoding')
+)
+
+
+"""
+Transitions of all workers, preallocated in shared memory: worker k writes
+its rollout into row k, the learner reads every row after `collect`.
+States are stored compacted, see compact_states.
+"""
+class SharedRollouts:
+    def __init__(self, num_workers: int, steps: int, state_dim):
+        self.states = torch.zeros((num_workers, steps, *compact_state_shape(state_dim)), dtype=torch.uint8).share_memory_()
+        self.actions = torch.zeros((num_workers, steps), dtype=torch.int64).share_memory_()
+        self.logprobs = torch.zeros((num_workers, steps), dtype=torch.float32).share_memory_()
+        self.state_values = torch.zeros((num_workers, steps), dtype=torch.float32).share_memory_()
+        self.rewards = torch.zeros((num_workers, steps), dtype=torch.float32).share_memory_()
+        self.is_terminals = torch.zeros((num_workers, steps), dtype=torch.bool).share_memory_()
+
+
+def _rollout_worker(worker_id: int, config: RolloutConfig, policy: ActorCritic, shared: SharedRollouts, weights: typing.Dict[str, torch.Tensor], commands, results):
+    torch.set_num_threads(1)
+    try:
+        asyncio.run(_rollout_loop(worker_id, config, policy, shared, weights, commands, results))
+    except Exception:
+        # the learner is waiting on `results`, exceptions may not pickle but their traceback does
+        results.put(RolloutError(worker_id, traceback.format_exc()))
+
+
+async def _connect(gym):
+    for retry in range(1, FWD_MODEL_CONNECTION_RETRIES):
+        try:
+            return await gym.connect()
+        except Exception:
+            await asyncio.sleep(FWD_MODEL_CONNECTION_DELAY)
+    # the last attempt reports its failure
+    return await gym.connect()
+
+
+async def _rollout_loop(worker_id: int, config: RolloutConfig, policy: ActorCritic, shared: SharedRollouts, weights: typing.Dict[str, torch.Tensor], commands, results):
+    gym = LocalGym(seed=worker_id) if config.fwd_model_local else Gym(config.fwd_model_uri)
+    await _connect(gym)
+    env = gym.make(f"rollout-{worker_id}", config.initial_state)
+    loop = asyncio.get_running_loop()
+    encode = STATE_ENCODINGS[config.state_encoding].encode
+
+    steps_done = 0
+    observation = await env.reset()
+    state = encode(observation, current_agent_id=config.agents[0], current_unit_id=config.units[0])
+
+    while True:
+        # Wait without blocking the event loop, the forward model connection has to stay responsive
+        command = await loop.run_in_executor(None, commands.get)
+        if command is None:
+            break
+        if command == "reset":
+            steps_done = 0
+            observation = await env.reset()
+            state = encode(observation, current_agent_id=config.agents[0], current_unit_id=config.units[0])
+
+        # The learner only writes new weights while every worker is idle
+        policy.load_state_dict(weights)
+        cumulative_reward, episodes_done = 0.0, 0
+        for step in range(config.steps_per_rollout):
+            steps_done += 1
+            agent_id = config.agents[steps_done % len(config.agents)]
+            unit_id = config.units[steps_done % len(config.units)]
+
+            with torch.no_grad():
+                action, action_logprob, state_val = policy(state)
+            action_or_idle = make_action(observation, agent_id, unit_id, action.item())
+            next_observation, done, _ = await env.step([] if action_or_idle is None else [action_or_idle])
+            reward = calculate_reward(observation, next_observation, current_agent_id=agent_id, current_unit_id=unit_id)
+
+            shared.states[worker_id, step] = compact_states(state, config.state_dim)
+            shared.actions[worker_id, step] = action
+            shared.logprobs[worker_id, step] = action_logprob
+            shared.state_values[worker_id, step] = state_val.squeeze()
+            shared.rewards[worker_id, step] = reward.item()
+            # Rollouts are concatenated by the learner, so the last step cuts the return off like an episode end
+            shared.is_terminals[worker_id, step] = bool(done) or step == config.steps_per_rollout - 1
+            cumulative_reward += reward.item()
+
+            if done:
+                episodes_done += 1
+                steps_done = 0
+                next_observation = await env.reset()
+            observation = next_observation
+            state = encode(observation, current_agent_id=agent_id, current_unit_id=unit_id)
+
+        results.put(RolloutStats(worker_id, config.steps_per_rollout, cumulative_reward, episodes_done))
+
+    await gym.close()
+
+
+"""
+K worker processes collecting PPO experience in parallel.
+
+Each worker owns its own forward model connection (or a local forward model)
+and a copy of `policy_old`. `collect` lets every worker write one rollout into
+shared memory and `to_buffer` hands them to the learner. After `PPO.update`
+the learner calls `broadcast` with the new weights. A worker that fails, or
+whose process dies, makes `collect` raise a RuntimeError.
+"""
+class RolloutWorkers:
+    def __init__(self, num_workers: int, policy: ActorCritic, config: RolloutConfig):
+        if policy.has_continuous_action_space:
+            raise ValueError("rollout workers only support discrete action spaces")
+        context = mp.get_context("spawn")
+        self.num_workers = num_workers
+        self.config = config
+        self.shared = SharedRollouts(num_workers, config.steps_per_rollout, config.state_dim)
+        self.weights = {key: value.detach().cpu().clone().share_memory_() for key, value in policy.state_dict().items()}
+        # every worker gets a CPU copy of the policy, whatever its architecture
+        worker_policy = copy.deepcopy(policy).cpu()
+        self._commands = [context.Queue() for _ in range(num_workers)]
+        self._results = context.Queue()
+        self._processes = [
+            context.Process(
+                target=_rollout_worker,
+                args=(worker_id, config, worker_policy, self.shared, self.weights, self._commands[worker_id], self._results),
+                daemon=True,
+            )
+            for worker_id in range(num_workers)
+        ]
+        for process in self._processes:
+            process.start()
+
+    def collect(self, reset: bool = False) -> typing.List[RolloutStats]:
+        for commands in self._commands:
+            commands.put("reset" if reset else "collect")
+        stats = [self._get_result() for _ in range(self.num_workers)]
+        return sorted(stats, key=lambda stat: stat.worker_id)
+
+    def _get_result(self) -> RolloutStats:
+        while True:
+            try:
+                result = self._results.get(timeout=RESULT_POLL_INTERVAL)
+                break
+            except queue.Empty:
+                dead = [worker_id for worker_id, process in enumerate(self._processes) if not process.is_alive()]
+                # a failing worker puts its RolloutError before exiting, read that first
+                if dead and self._results.empty():
+                    raise RuntimeError(f"rollout workers {dead} exited without a result")
+        if isinstance(result, RolloutError):
+            raise RuntimeError(f"rollout worker {result.worker_id} failed:\n{result.traceback}")
+        return result
+
+    def to_buffer(self, buffer: RolloutBuffer):
+        shared = self.shared
+        buffer.extend(
+            shared.states.flatten(end_dim=1),
+            shared.actions.reshape(-1),
+            shared.logprobs.reshape(-1),
+            shared.state_values.reshape(-1),
+            shared.rewards.reshape(-1),
+            shared.is_terminals.reshape(-1),
+        )
+        return self.num_workers * self.config.steps_per_rollout
+
+    def broadcast(self, state_dict: typing.Dict[str, torch.Tensor]):
+        for key, value in state_dict.items():
+            self.weights[key].copy_(value)
+
+    def close(self):
+        for commands in self._commands:
+            commands.put(None)
+        for process in self._processes:
+            process.join()
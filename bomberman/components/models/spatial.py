@@ -0,0 +1,37 @@
+import torch
+import torch.nn as nn
+
+from components.state import SPATIAL_PLANE_SCALES
+
+SPATIAL_POOLED_SIZE = 4
+
+"""
+Small convolutional backbone over spatial states ([C, H, W] planes or a
+[N, C, H, W] batch of them, see observation_to_spatial_state).
+
+Two strided 3x3 convolutions bring a 15x15 map down to 4x4 and adaptive
+pooling keeps the grid at SPATIAL_POOLED_SIZE for any other map size, so
+the parameter count does not depend on the map size. Outputs a flat vector
+of `features` values.
+"""
+class SpatialEncoder(nn.Module):
+    def __init__(self, channels: int, hidden_channels: int = 16):
+        super(SpatialEncoder, self).__init__()
+        self.register_buffer("plane_scales", torch.tensor(SPATIAL_PLANE_SCALES[:channels]).reshape(-1, 1, 1))
+        self.convolutions = nn.Sequential(
+            nn.Conv2d(channels, hidden_channels, 3, stride=2, padding=1),
+            nn.ReLU(),
+            nn.Conv2d(hidden_channels, 2 * hidden_channels, 3, stride=2, padding=1),
+            nn.ReLU(),
+            nn.Conv2d(2 * hidden_channels, 2 * hidden_channels, 3, padding=1),
+            nn.ReLU(),
+            nn.AdaptiveAvgPool2d(SPATIAL_POOLED_SIZE),
+        )
+        self.features = 2 * hidden_channels * SPATIAL_POOLED_SIZE * SPATIAL_POOLED_SIZE
+
+    def forward(self, state):
+        batched = state.dim() == 4
+        x = state if batched else state.unsqueeze(0)
+        x = self.convolutions(x / self.plane_scales)
+        x = x.flatten(start_dim=1)
+        return x if batched else x.squeeze(0)
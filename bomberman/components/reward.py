@@ -1,24 +1,23 @@
+import collections
 import torch
 import math 
+import typing as t
 
 from components.types import Observation
+from components.utils.cache import ObservationCache
+from components.utils.danger import DangerMap, dangerous_bomb_count, dangerous_bomb_distances, get_danger_map
+from components.utils.reachability import get_reachability
 from components.utils.observation import (
-    get_nearest_active_bomb, 
-    get_nearest_obstacle,
-    dangerous_bomb_count,
-    dangerous_bomb_distances,
+    OBSTACLE_TYPES,
     get_nearest_blast,
     get_nearest_blast_powerup,
     get_nearest_freeze_powerup,
-    get_nearest_obstacle_count,
-    get_nearest_1_barier_count,
-    get_unit_activated_bombs, 
-    get_count_wooden_obstacle_in_blast_diameter,
-    get_count_ore_obstacle_in_blast_diameter,
-    get_count_metal_obstacle_in_blast_diameter
 )
+from components.utils.log import get_logger
 from components.utils.metrics import manhattan_distance
 
+log = get_logger("reward")
+
 
 def find_my_units_alive(observation: Observation, current_agent_id: str) -> int:
     alive = 0
@@ -61,12 +60,7 @@ def find_current_tick(observation: Observation) -> int:
 def unit_within_reach_of_a_bomb(observation: Observation, current_unit_id: str):
     unit = observation['unit_state'][current_unit_id]
     unit_coords = unit['coordinates']
-    nearest_bomb = get_nearest_active_bomb(observation, current_unit_id)
-    if nearest_bomb is None:
-        return False
-    nearest_bomb_coords = [nearest_bomb['x'], nearest_bomb['y']]
-    within_reach_of_a_bomb = manhattan_distance(unit_coords, nearest_bomb_coords) <= int(nearest_bomb['blast_diameter'])/2.
-    return within_reach_of_a_bomb
+    return get_danger_map(observation).is_dangerous(unit_coords)
     
 
 def unit_within_reach_of_a_bomb_count(observation: Observation, current_unit_id: str) -> int:
@@ -78,94 +72,48 @@ def unit_within_reach_of_a_bomb_distances(observation: Observation, current_unit
 def unit_within_safe_cell_nearby_bomb(observation: Observation, current_unit_id: str):
     unit = observation['unit_state'][current_unit_id]
     unit_coords = unit['coordinates']
-    nearest_bomb = get_nearest_active_bomb(observation, current_unit_id)
-    if nearest_bomb is None:
-        return False
-    nearest_bomb_coords = [nearest_bomb['x'], nearest_bomb['y']]
-    within_safe_cell_nearby_bomb = manhattan_distance(unit_coords, nearest_bomb_coords) > int(nearest_bomb['blast_diameter'])/2.
-    return within_safe_cell_nearby_bomb
+    danger_map = get_danger_map(observation)
+    return len(danger_map.bombs) > 0 and not danger_map.is_dangerous(unit_coords)
     
 def unit_within_safe_cell_nearby_bombs(observation: Observation, current_unit_id: str):
     return dangerous_bomb_count(observation, current_unit_id) == 0
 
 """
-Bomb definition: {'created': 74, 'x': 11, 'y': 10, 'type': 'b', 'unit_id': 'd', 'agent_id': 'b', 'expires': 104, 'hp': 1, 'blast_diameter': 3}
+Bombs of the unit and what their blasts hit, see DangerMap.
 """
 def unit_activated_bomb_near_an_obstacle(observation: Observation, current_unit_id: str):
-    unit_activated_bombs = get_unit_activated_bombs(observation, current_unit_id)
-    if not len(unit_activated_bombs):
-        return False
-    for unit_bomb in unit_activated_bombs:
-        unit_bomb_coords = [unit_bomb['x'], unit_bomb['y']]
-        nearest_obstacle = get_nearest_obstacle(observation, unit_bomb_coords)
-        if nearest_obstacle is None:
-            continue
-        nearest_obstacle_coords = [nearest_obstacle['x'], nearest_obstacle['y']]
-        if manhattan_distance(unit_bomb_coords, nearest_obstacle_coords) <= int(unit_bomb['blast_diameter'])/2.:
-            return True
-    return False
+    danger_map = get_danger_map(observation)
+    return danger_map.count_hit(danger_map.unit_bombs(current_unit_id), OBSTACLE_TYPES) > 0
     
 def unit_activated_bomb_near_a_wooden_obstacle_count(observation: Observation, current_unit_id: str)->int:
-    unit_activated_bombs = get_unit_activated_bombs(observation, current_unit_id)
-    if not len(unit_activated_bombs):
-        return 0
-    all_count = 0
-    for unit_bomb in unit_activated_bombs:
-        unit_bomb_coords = [unit_bomb['x'], unit_bomb['y']]
-        wooden_obstacle_count = get_count_wooden_obstacle_in_blast_diameter(observation, unit_bomb_coords, int(unit_bomb['blast_diameter'])/2.)
-        all_count += wooden_obstacle_count
-    return all_count
+    danger_map = get_danger_map(observation)
+    return danger_map.count_hit(danger_map.unit_bombs(current_unit_id), ["w"])
 
 def unit_activated_bomb_near_an_ore_obstacle_count(observation: Observation, current_unit_id: str)->int:
-    unit_activated_bombs = get_unit_activated_bombs(observation, current_unit_id)
-    if not len(unit_activated_bombs):
-        return 0
-    all_count = 0
-    for unit_bomb in unit_activated_bombs:
-        unit_bomb_coords = [unit_bomb['x'], unit_bomb['y']]
-        ore_obstacle_count = get_count_ore_obstacle_in_blast_diameter(observation, unit_bomb_coords, int(unit_bomb['blast_diameter'])/2.)
-        all_count += ore_obstacle_count
-    return all_count
+    danger_map = get_danger_map(observation)
+    return danger_map.count_hit(danger_map.unit_bombs(current_unit_id), ["o"])
     
 def unit_activated_bomb_near_a_metal_obstacle_count(observation: Observation, current_unit_id: str)->int:
-    unit_activated_bombs = get_unit_activated_bombs(observation, current_unit_id)
-    if not len(unit_activated_bombs):
-        return 0
-    all_count = 0
-    for unit_bomb in unit_activated_bombs:
-        unit_bomb_coords = [unit_bomb['x'], unit_bomb['y']]
-        metal_obstacle_count = get_count_metal_obstacle_in_blast_diameter(observation, unit_bomb_coords, int(unit_bomb['blast_diameter'])/2.)
-        all_count += metal_obstacle_count
-    return all_count
+    danger_map = get_danger_map(observation)
+    return danger_map.count_hit(danger_map.unit_bombs(current_unit_id), ["m"])
 
-def unit_activated_bomb_near_an_enemy_count(observation: Observation, current_unit_id: str, current_agent_id: str)->int:
-    unit_activated_bombs = get_unit_activated_bombs(observation, current_unit_id)
-    if not len(unit_activated_bombs):
+# Pairs of (unit bomb, unit of the given side) where the bomb hits the unit
+def units_within_reach_of_unit_bombs_count(danger_map: DangerMap, observation: Observation, current_unit_id: str, current_agent_id: str, teammates: bool)->int:
+    unit_bombs = danger_map.unit_bombs(current_unit_id)
+    if not unit_bombs:
         return 0
     count = 0
-    for unit_bomb in unit_activated_bombs:
-        unit_bomb_coords = [unit_bomb['x'], unit_bomb['y']]
-        for unit_props in observation['unit_state'].values():
-            if unit_props['agent_id'] != current_agent_id:
-                enemy_coords = unit_props['coordinates']
-                if manhattan_distance(unit_bomb_coords, enemy_coords) <= int(unit_bomb['blast_diameter'])/2.:
-                    count += 1
+    for unit_props in observation['unit_state'].values():
+        if (unit_props['agent_id'] == current_agent_id) == teammates:
+            count += danger_map.count_reaching(unit_bombs, unit_props['coordinates'])
     return count
+
+def unit_activated_bomb_near_an_enemy_count(observation: Observation, current_unit_id: str, current_agent_id: str)->int:
+    return units_within_reach_of_unit_bombs_count(get_danger_map(observation), observation, current_unit_id, current_agent_id, teammates=False)
     
     
 def unit_activated_bomb_near_a_teammate_count(observation: Observation, current_unit_id: str, current_agent_id: str)->int:
-    unit_activated_bombs = get_unit_activated_bombs(observation, current_unit_id)
-    if not len(unit_activated_bombs):
-        return 0
-    count = 0
-    for unit_bomb in unit_activated_bombs:
-        unit_bomb_coords = [unit_bomb['x'], unit_bomb['y']]
-        for unit_props in observation['unit_state'].values():
-            if unit_props['agent_id'] == current_agent_id:
-                enemy_coords = unit_props['coordinates']
-                if manhattan_distance(unit_bomb_coords, enemy_coords) <= int(unit_bomb['blast_diameter'])/2.:
-                    count += 1
-    return count
+    return units_within_reach_of_unit_bombs_count(get_danger_map(observation), observation, current_unit_id, current_agent_id, teammates=True)
     
 def near_blast_powerup(observation: Observation, current_unit_id: str)->int:
     unit = observation['unit_state'][current_unit_id]
@@ -187,26 +135,12 @@ def near_freeze_powerup(observation: Observation, current_unit_id: str)->int:
     return manhattan_distance(nearest_freeze_powerup_coords, unit_coords)
     
 
+"""
+A unit is in a dead end when bombs are about to hit it and no safe cell can be
+reached before they do, see Reachability.
+"""
 def unit_is_in_deadend(observation: Observation, current_unit_id: str):
-    unit = observation['unit_state'][current_unit_id]
-    unit_coords = unit['coordinates']
-    obstacle_count, obstacles = get_nearest_obstacle_count(observation, unit_coords)
-    barier_count, bariers = get_nearest_1_barier_count(observation, unit_coords)
-    if (obstacle_count + barier_count < 2):
-        return False
-    
-    bomb_count = dangerous_bomb_count(observation, current_unit_id)
-    if ((unit_coords[0] <= 0 and (unit_coords[1] <= 0 or unit_coords[1] >= 15)) or (unit_coords[0] >= 15 and (unit_coords[1] <= 0 or unit_coords[1] >= 15))):
-        if (bomb_count != 0 and obstacle_count + barier_count > 1):
-            return True
-        
-    if (unit_coords[0] <= 0 or unit_coords[1] <= 0 or unit_coords[0] >= 15 or unit_coords[1] >= 15):
-        if (bomb_count != 0 and obstacle_count + barier_count > 2):
-            return True
-            
-    if (bomb_count != 0 and obstacle_count + barier_count > 3):
-        return True
-    return False
+    return not get_reachability(observation).unit(current_unit_id).can_escape
     
     
 def unit_near_blast_distance(observation: Observation, current_unit_id: str) -> int:
@@ -219,6 +153,101 @@ def unit_near_blast_distance(observation: Observation, current_unit_id: str) ->
     return manhattan_distance(unit_coords, nearest_blast_coords)
 
 
+"""
+Reward features extracted in one pass per observation.
+
+Agent aggregates (hps, units alive) come from a single walk over unit_state;
+unit features are computed on first request and memoized on the record. Records
+are cached per observation object, so the "next" observation of step t is not
+re-scanned when it becomes the "prev" observation of step t+1. Observations
+are treated as immutable snapshots, as returned by GymEnv.step.
+"""
+UnitRewardFeatures = collections.namedtuple(
+    'UnitRewardFeatures',
+    (
+        'deadend',
+        'bomb_distance_penalty',
+        'bombs_near_wooden_obstacle_count',
+        'bombs_near_ore_obstacle_count',
+        'bombs_near_enemy_count',
+        'bombs_near_teammate_count',
+        'blast_distance',
+        'blast_powerup_distance',
+        'freeze_powerup_distance',
+    )
+)
+
+
+class RewardFeatures:
+    def __init__(self, observation: Observation):
+        self.observation = observation
+        self._units = {}
+        self._hps = collections.Counter()
+        self._alive = collections.Counter()
+        for unit_props in observation['unit_state'].values():
+            self._hps[unit_props['agent_id']] += unit_props['hp']
+            if unit_props['hp'] != 0:
+                self._alive[unit_props['agent_id']] += 1
+        self._total_hps = sum(self._hps.values())
+        self._total_alive = sum(self._alive.values())
+
+    def my_units_hps(self, current_agent_id: str) -> int:
+        return self._hps[current_agent_id]
+
+    def enemy_units_hps(self, current_agent_id: str) -> int:
+        return self._total_hps - self._hps[current_agent_id]
+
+    def my_units_alive(self, current_agent_id: str) -> int:
+        return self._alive[current_agent_id]
+
+    def enemy_units_alive(self, current_agent_id: str) -> int:
+        return self._total_alive - self._alive[current_agent_id]
+
+    def unit(self, current_agent_id: str, current_unit_id: str) -> UnitRewardFeatures:
+        key = (current_agent_id, current_unit_id)
+        if key not in self._units:
+            self._units[key] = self._extract_unit(current_agent_id, current_unit_id)
+        return self._units[key]
+
+    def _extract_unit(self, current_agent_id: str, current_unit_id: str) -> UnitRewardFeatures:
+        observation = self.observation
+        unit_coords = observation['unit_state'][current_unit_id]['coordinates']
+
+        danger_map = get_danger_map(observation)
+        bomb_distances = danger_map.bomb_distances(unit_coords)
+        bomb_distance_penalty = 0
+        for distance in bomb_distances:
+            bomb_distance_penalty += 1.0/(distance + 1)
+
+        unit_bombs = danger_map.unit_bombs(current_unit_id)
+
+        return UnitRewardFeatures(
+            deadend=not get_reachability(observation).unit(current_unit_id).can_escape,
+            bomb_distance_penalty=bomb_distance_penalty,
+            bombs_near_wooden_obstacle_count=danger_map.count_hit(unit_bombs, ["w"]),
+            bombs_near_ore_obstacle_count=danger_map.count_hit(unit_bombs, ["o"]),
+            bombs_near_enemy_count=units_within_reach_of_unit_bombs_count(danger_map, observation, current_unit_id, current_agent_id, teammates=False),
+            bombs_near_teammate_count=units_within_reach_of_unit_bombs_count(danger_map, observation, current_unit_id, current_agent_id, teammates=True),
+            blast_distance=unit_near_blast_distance(observation, current_unit_id),
+            blast_powerup_distance=near_blast_powerup(observation, current_unit_id),
+            freeze_powerup_distance=near_freeze_powerup(observation, current_unit_id),
+        )
+
+
+_reward_features_cache = ObservationCache()
+
+
+def get_reward_features(observation: Observation) -> RewardFeatures:
+    key = id(observation)
+    features = _reward_features_cache.get(key)
+    if features is not None:
+        return features
+
+    features = RewardFeatures(observation)
+    _reward_features_cache.put(key, features)
+    return features
+
+
 """
 Reward function definition:
 1. +0.5: when dealing 1 hp for 1 enemy
@@ -235,10 +264,15 @@ Reward function definition:
 def calculate_reward(prev_observation: Observation, next_observation: Observation, current_agent_id: str, current_unit_id: str):
     reward = 0        
 
+    prev_features = get_reward_features(prev_observation)
+    next_features = get_reward_features(next_observation)
+    prev_unit_features = prev_features.unit(current_agent_id, current_unit_id)
+    next_unit_features = next_features.unit(current_agent_id, current_unit_id)
+
     # 1. +0.5: when dealing 1 hp for 1 enemy
 
-    prev_enemy_units_hps = find_enemy_units_hps(prev_observation, current_agent_id)
-    next_enemy_units_hps = find_enemy_units_hps(next_observation, current_agent_id)
+    prev_enemy_units_hps = prev_features.enemy_units_hps(current_agent_id)
+    next_enemy_units_hps = next_features.enemy_units_hps(current_agent_id)
     
     enemy_units_hps_diff = prev_enemy_units_hps - next_enemy_units_hps
     if enemy_units_hps_diff > 0:
@@ -246,8 +280,8 @@ def calculate_reward(prev_observation: Observation, next_observation: Observatio
 
     # 2. +1: when killing opponent
 
-    prev_enemy_units_alive = find_enemy_units_alive(prev_observation, current_agent_id)
-    next_enemy_units_alive = find_enemy_units_alive(next_observation, current_agent_id)
+    prev_enemy_units_alive = prev_features.enemy_units_alive(current_agent_id)
+    next_enemy_units_alive = next_features.enemy_units_alive(current_agent_id)
 
     if prev_enemy_units_alive > next_enemy_units_alive:
         reward += 1 * (prev_enemy_units_alive - next_enemy_units_alive)
@@ -259,8 +293,8 @@ def calculate_reward(prev_observation: Observation, next_observation: Observatio
 
     # 4. -0.25: when losing 1 hp for 1 teammate
 
-    prev_my_units_hps = find_my_units_hps(prev_observation, current_agent_id)
-    next_my_units_hps = find_my_units_hps(next_observation, current_agent_id)
+    prev_my_units_hps = prev_features.my_units_hps(current_agent_id)
+    next_my_units_hps = next_features.my_units_hps(current_agent_id)
 
     my_units_hps_diff = prev_my_units_hps - next_my_units_hps
     if my_units_hps_diff > 0:
@@ -268,8 +302,8 @@ def calculate_reward(prev_observation: Observation, next_observation: Observatio
 
     # 5. -0.5: when losing teammate
 
-    prev_my_units_alive = find_my_units_alive(prev_observation, current_agent_id)
-    next_my_units_alive = find_my_units_alive(next_observation, current_agent_id)
+    prev_my_units_alive = prev_features.my_units_alive(current_agent_id)
+    next_my_units_alive = next_features.my_units_alive(current_agent_id)
 
     if next_my_units_alive < prev_my_units_alive:
         reward += (-0.7) * (prev_my_units_alive - next_my_units_alive)
@@ -303,26 +337,16 @@ def calculate_reward(prev_observation: Observation, next_observation: Observatio
     #if (prev_within_reach_of_a_bomb_count > next_within_reach_of_a_bomb_count):
     #    reward += 0.006 * (prev_within_reach_of_a_bomb_count - next_within_reach_of_a_bomb_count)
     
-    prev_my_units_deadend = unit_is_in_deadend(prev_observation, current_unit_id) #??????
-    next_my_units_deadend = unit_is_in_deadend(next_observation, current_unit_id)    
+    prev_my_units_deadend = prev_unit_features.deadend #??????
+    next_my_units_deadend = next_unit_features.deadend
     if not prev_my_units_deadend and next_my_units_deadend:
         reward += (-0.05)
         
     elif prev_my_units_deadend and next_my_units_deadend:
         reward += (-0.06)
         
-    prev_within_reach_of_a_bomb_distances = unit_within_reach_of_a_bomb_distances(prev_observation, current_unit_id)
-    next_within_reach_of_a_bomb_distances = unit_within_reach_of_a_bomb_distances(next_observation, current_unit_id)
-    
-    prev_distance_penalty = 0
-    for distance in prev_within_reach_of_a_bomb_distances:
-        prev_distance_penalty += 1.0/(distance + 1)
-    #prev_distance/=len(prev_within_reach_of_a_bomb_distances) + 1
-
-    next_distance_penalty = 0
-    for distance in next_within_reach_of_a_bomb_distances:
-        next_distance_penalty += 1.0/(distance + 1)
-    #next_distance/=len(next_within_reach_of_a_bomb_distances) + 1     
+    prev_distance_penalty = prev_unit_features.bomb_distance_penalty
+    next_distance_penalty = next_unit_features.bomb_distance_penalty
     
     if (prev_distance_penalty < next_distance_penalty):
         reward += -0.4 * (next_distance_penalty - prev_distance_penalty)
@@ -341,14 +365,14 @@ def calculate_reward(prev_observation: Observation, next_observation: Observatio
         
     # 10. +0.1: the unit activated bomb near an obstacle
 
-    prev_unit_activated_bomb_near_an_wooden_obstacle_count = unit_activated_bomb_near_a_wooden_obstacle_count(prev_observation, current_unit_id)
-    next_unit_activated_bomb_near_an_wooden_obstacle_count = unit_activated_bomb_near_a_wooden_obstacle_count(next_observation, current_unit_id)
+    prev_unit_activated_bomb_near_an_wooden_obstacle_count = prev_unit_features.bombs_near_wooden_obstacle_count
+    next_unit_activated_bomb_near_an_wooden_obstacle_count = next_unit_features.bombs_near_wooden_obstacle_count
     
     if prev_unit_activated_bomb_near_an_wooden_obstacle_count < next_unit_activated_bomb_near_an_wooden_obstacle_count:
         reward += 0.05 * (next_unit_activated_bomb_near_an_wooden_obstacle_count - prev_unit_activated_bomb_near_an_wooden_obstacle_count)
         
-    prev_unit_activated_bomb_near_an_ore_obstacle_count = unit_activated_bomb_near_an_ore_obstacle_count(prev_observation, current_unit_id)
-    next_unit_activated_bomb_near_an_ore_obstacle_count = unit_activated_bomb_near_an_ore_obstacle_count(next_observation, current_unit_id)
+    prev_unit_activated_bomb_near_an_ore_obstacle_count = prev_unit_features.bombs_near_ore_obstacle_count
+    next_unit_activated_bomb_near_an_ore_obstacle_count = next_unit_features.bombs_near_ore_obstacle_count
     
     if prev_unit_activated_bomb_near_an_ore_obstacle_count < next_unit_activated_bomb_near_an_ore_obstacle_count:
         reward += 0.03 * (next_unit_activated_bomb_near_an_ore_obstacle_count - prev_unit_activated_bomb_near_an_ore_obstacle_count)
@@ -362,8 +386,8 @@ def calculate_reward(prev_observation: Observation, next_observation: Observatio
         
     # 11. +0.1: the unit activated bomb near an enemy
 
-    prev_unit_activated_bomb_near_an_enemy_count = unit_activated_bomb_near_an_enemy_count(prev_observation, current_unit_id, current_agent_id)
-    next_unit_activated_bomb_near_an_enemy_count = unit_activated_bomb_near_an_enemy_count(next_observation, current_unit_id, current_agent_id)
+    prev_unit_activated_bomb_near_an_enemy_count = prev_unit_features.bombs_near_enemy_count
+    next_unit_activated_bomb_near_an_enemy_count = next_unit_features.bombs_near_enemy_count
     
     if prev_unit_activated_bomb_near_an_enemy_count < next_unit_activated_bomb_near_an_enemy_count:
         reward += 0.09 * (next_unit_activated_bomb_near_an_enemy_count - prev_unit_activated_bomb_near_an_enemy_count) #0.3
@@ -372,8 +396,8 @@ def calculate_reward(prev_observation: Observation, next_observation: Observatio
         
     # 12. +0.1: the unit activated bomb near an teammate
 
-    prev_unit_activated_bomb_near_a_teammate_count = unit_activated_bomb_near_a_teammate_count(prev_observation, current_unit_id, current_agent_id)
-    next_unit_activated_bomb_near_a_teammate_count = unit_activated_bomb_near_a_teammate_count(next_observation, current_unit_id, current_agent_id)
+    prev_unit_activated_bomb_near_a_teammate_count = prev_unit_features.bombs_near_teammate_count
+    next_unit_activated_bomb_near_a_teammate_count = next_unit_features.bombs_near_teammate_count
     
     if prev_unit_activated_bomb_near_a_teammate_count < next_unit_activated_bomb_near_a_teammate_count and next_unit_activated_bomb_near_a_teammate_count != 0:
         reward -= 0.07 * (next_unit_activated_bomb_near_a_teammate_count - prev_unit_activated_bomb_near_a_teammate_count - 1)
@@ -383,8 +407,8 @@ def calculate_reward(prev_observation: Observation, next_observation: Observatio
         
     # 14. +0.1: unit in blast
     
-    prev_unit_near_blast_distance = unit_near_blast_distance(prev_observation, current_unit_id)
-    next_unit_near_blast_distance = unit_near_blast_distance(next_observation, current_unit_id)
+    prev_unit_near_blast_distance = prev_unit_features.blast_distance
+    next_unit_near_blast_distance = next_unit_features.blast_distance
         
     if prev_unit_near_blast_distance > next_unit_near_blast_distance and next_unit_near_blast_distance == 0:
        reward += (-0.09)
@@ -394,8 +418,8 @@ def calculate_reward(prev_observation: Observation, next_observation: Observatio
         
     # 15. +0.1: unit in blastpowerup
     
-    prev_near_blast_powerup = near_blast_powerup(prev_observation, current_unit_id)
-    next_near_blast_powerup = near_blast_powerup(next_observation, current_unit_id)
+    prev_near_blast_powerup = prev_unit_features.blast_powerup_distance
+    next_near_blast_powerup = next_unit_features.blast_powerup_distance
 
     #if prev_near_blast_powerup > next_near_blast_powerup and next_near_blast_powerup != 0:
     #    reward += 0.01 / next_near_blast_powerup
@@ -405,8 +429,8 @@ def calculate_reward(prev_observation: Observation, next_observation: Observatio
         
     # 16. +0.1: unit in freezepowerup
     
-    prev_near_freeze_powerup = near_freeze_powerup(prev_observation, current_unit_id)
-    next_near_freeze_powerup = near_freeze_powerup(next_observation, current_unit_id)
+    prev_near_freeze_powerup = prev_unit_features.freeze_powerup_distance
+    next_near_freeze_powerup = next_unit_features.freeze_powerup_distance
 
     #if prev_near_freeze_powerup > next_near_freeze_powerup and next_near_freeze_powerup != 0:
     #    reward += (0.01) / next_near_freeze_powerup
@@ -414,6 +438,6 @@ def calculate_reward(prev_observation: Observation, next_observation: Observatio
     if prev_near_freeze_powerup > next_near_freeze_powerup and next_near_freeze_powerup == 0:
         reward += (0.03)
     
-    print(reward)
+    log.metric("reward", reward)
 
     return torch.tensor(reward, dtype=torch.float32).reshape(1)
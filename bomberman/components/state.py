@@ -1,9 +1,17 @@
+import collections
 import torch
 import typing as t
 import numpy as np
 
 from components.types import Map, Observation, Unit
-from components.environment.config import ACTIONS, MAX_UNIT_VALUE
+from components.utils.reachability import get_reachability
+from components.environment.config import (
+    ACTIONS,
+    BOMB_DURATION_TICKS,
+    INITIAL_BLAST_DIAMETER,
+    INITIAL_HP,
+    MAX_UNIT_VALUE,
+)
 
 """
 Utils for encoding
@@ -21,6 +29,12 @@ def encode_number(n: int, length: int):
     return [int(c) for c in b]
 
 
+# Vectorized encode_number: one row of bits per number
+def encode_numbers(ns: t.Iterable[int], length: int) -> np.ndarray:
+    shifts = np.arange(length - 1, -1, -1)
+    return ((np.asarray(ns, dtype=np.int64)[..., None] >> shifts) & 1).astype(np.int8)
+
+
 """
 State and action dimensions: HYBRID approach
 """
@@ -74,77 +88,305 @@ def coordinates_dimensions(observation: Observation):
 Map encoding: HYBRID approach
 """
 
+ENTITY_UNITS = {
+    'w': Unit.WoodenBlock,
+    'o': Unit.OreBlock,
+    'm': Unit.MetalBlock,
+    'fp': Unit.FreezePowerup,
+    'bp': Unit.BlastPowerup,
+    'x': Unit.Blast,
+    'b': Unit.Bomb,
+    'a': Unit.Ammunition,
+}
+
+
 def empty_map(observation: Observation) -> Map:
     return np.zeros(map_dimensions(observation), dtype=np.int8)
 
 
-def entities_map(observation: Observation) -> Map:
-    map = empty_map(observation)
-    for entity in observation['entities']:
-        if entity['type'] == 'w':
-            map[entity['x']][entity['y']] = Unit.WoodenBlock
-        if entity['type'] == 'o':
-            map[entity['x']][entity['y']] = Unit.OreBlock
-        if entity['type'] == 'm':
-            map[entity['x']][entity['y']] = Unit.MetalBlock
-        if entity['type'] == 'fp':
-            map[entity['x']][entity['y']] = Unit.FreezePowerup
-        if entity['type'] == 'bp':
-            map[entity['x']][entity['y']] = Unit.BlastPowerup
-        if entity['type'] == 'x':
-            map[entity['x']][entity['y']] = Unit.Blast
-        if entity['type'] == 'b':
-            map[entity['x']][entity['y']] = Unit.Bomb
-        if entity['type'] == 'a':
-            map[entity['x']][entity['y']] = Unit.Ammunition
+# Writes (x, y, unit) cells into the map in one batch; when several cells
+# share a coordinate the last one wins, as with sequential assignment.
+def fill_map(map: Map, cells: t.List[t.Tuple[int, int, int]]) -> Map:
+    if not cells:
+        return map
+    xs, ys, units = np.array(cells, dtype=np.int64).T
+    flat = np.ravel_multi_index((xs, ys), map.shape)
+    _, last_reversed = np.unique(flat[::-1], return_index=True)
+    last = len(flat) - 1 - last_reversed
+    map.flat[flat[last]] = units[last]
     return map
-    
+
+
+def entities_map(observation: Observation) -> Map:
+    cells = [
+        (entity['x'], entity['y'], ENTITY_UNITS[entity['type']])
+        for entity in observation['entities']
+        if entity['type'] in ENTITY_UNITS
+    ]
+    return fill_map(empty_map(observation), cells)
+
 
 def units_map(observation: Observation, current_agent_id: str) -> Map:
-    map = empty_map(observation) 
+    cells = []
     for observed_agent_id, observed_agent_config in observation['agents'].items():
+        unit = Unit.Friend if observed_agent_id == current_agent_id else Unit.Enemy
         for unit_id in observed_agent_config['unit_ids']:
-            unit_config = observation['unit_state'][unit_id]
-            if observed_agent_id == current_agent_id:
-                map[unit_config['coordinates'][0]][unit_config['coordinates'][1]] = Unit.Friend
-            else:
-                map[unit_config['coordinates'][0]][unit_config['coordinates'][1]] = Unit.Enemy
-    return map
+            x, y = observation['unit_state'][unit_id]['coordinates']
+            cells.append((x, y, unit))
+    return fill_map(empty_map(observation), cells)
 
 """
 State encoding: HYBRID approach
 """
 
+# Covers every value a cell can take after OR-ing the unit and entity maps
+UNIT_BITS = encode_numbers(np.arange(2 ** unit_dimensions()), unit_dimensions())
+
+
 def encode_unit(unit: int):
-    unit_binary_dimension = unit_dimensions()
-    return encode_number(n=unit, length=unit_binary_dimension)
+    return UNIT_BITS[unit].tolist()
 
 
 def encode_map(map: Map):
-    ohe_vector = []
-    for i, _ in enumerate(map):
-        for _, unit in enumerate(map[i]):
-            ohe_vector.append(encode_unit(unit))
-    return np.array(ohe_vector, dtype=np.int8)
+    return UNIT_BITS[np.asarray(map, dtype=np.int64).ravel()]
 
 
 def encode_coordinates(observation: Observation, current_unit_id: str):
     binary_coords_length = coordinates_length(observation)
-    binary_unit_coords = [
-        encode_number(n=coord, length=binary_coords_length) 
-        for coord in observation['unit_state'][current_unit_id]['coordinates']
-    ] 
-    return np.array(binary_unit_coords, dtype=np.int8)
+    unit_coords = observation['unit_state'][current_unit_id]['coordinates']
+    return encode_numbers(unit_coords, binary_coords_length)
 
 
-def observation_to_state(observation: Observation, current_agent_id: str, current_unit_id: str):
+def encode_observation_map(observation: Observation, current_agent_id: str):
     map: Map = (
         empty_map(observation) 
         | units_map(observation, current_agent_id) 
         | entities_map(observation)
     )
-    state = np.append(
-        encode_map(map).astype(np.float32),
-        encode_coordinates(observation, current_unit_id).astype(np.float32)
-    )
-    return torch.tensor(state).flatten()
+    return encode_map(map).ravel()
+
+
+def observation_to_state(observation: Observation, current_agent_id: str, current_unit_id: str):
+    state = np.concatenate((
+        encode_observation_map(observation, current_agent_id),
+        encode_coordinates(observation, current_unit_id).ravel()
+    )).astype(np.float32)
+    return torch.from_numpy(state)
+
+
+# Batched observation_to_state: the shared map is encoded once and each row
+# gets the coordinates of one unit, giving a [n_units, state_dim] tensor.
+def observation_to_states(observation: Observation, current_agent_id: str, current_unit_ids: t.List[str]):
+    encoded_map = encode_observation_map(observation, current_agent_id)
+    binary_coords_length = coordinates_length(observation)
+    units_coords = [observation['unit_state'][unit_id]['coordinates'] for unit_id in current_unit_ids]
+    # explicit width, so an empty list of units gives a [0, state_dim] tensor
+    encoded_coords = encode_numbers(units_coords, binary_coords_length).reshape(len(current_unit_ids), 2 * binary_coords_length)
+    states = np.empty((len(current_unit_ids), encoded_map.size + encoded_coords.shape[1]), dtype=np.float32)
+    states[:, :encoded_map.size] = encoded_map
+    states[:, encoded_map.size:] = encoded_coords
+    return torch.from_numpy(states)
+
+
+"""
+Live HYBRID encoding of a game state that is updated event by event (see
+GameState): the entity map and its encoded bits are patched one cell at a
+time, units are OR-ed in when encoding as there are only a few of them.
+Cells follow the entities list order, so the entity of the latest event on
+a cell wins, and `encode_batch` matches observation_to_states.
+"""
+class IncrementalStateEncoder:
+    def __init__(self, observation: Observation):
+        self.width, self.height = map_dimensions(observation)
+        self.coordinates_length = coordinates_length(observation)
+        self.entities = entities_map(observation)
+        self.encoded = encode_map(self.entities).astype(np.float32)
+
+    def _set_cell(self, x: int, y: int, unit: int):
+        self.entities[x, y] = unit
+        self.encoded[x * self.height + y] = UNIT_BITS[unit]
+
+    def set_entity(self, entity: t.Dict):
+        unit = ENTITY_UNITS.get(entity['type'])
+        if unit is not None:
+            self._set_cell(entity['x'], entity['y'], unit)
+
+    def clear_cell(self, x: int, y: int):
+        self._set_cell(x, y, 0)
+
+    def encode_batch(self, observation: Observation, current_agent_id: str, current_unit_ids: t.List[str]):
+        n_bits = self.encoded.shape[1]
+        map_size = self.encoded.size
+        units_cells = {}
+        for observed_agent_id, observed_agent_config in observation['agents'].items():
+            unit = Unit.Friend if observed_agent_id == current_agent_id else Unit.Enemy
+            for unit_id in observed_agent_config['unit_ids']:
+                x, y = observation['unit_state'][unit_id]['coordinates']
+                units_cells[(x, y)] = unit
+
+        units_coords = [observation['unit_state'][unit_id]['coordinates'] for unit_id in current_unit_ids]
+        encoded_coords = encode_numbers(units_coords, self.coordinates_length).reshape(len(current_unit_ids), 2 * self.coordinates_length)
+        states = np.empty((len(current_unit_ids), map_size + encoded_coords.shape[1]), dtype=np.float32)
+        states[:, :map_size] = self.encoded.ravel()
+        for (x, y), unit in units_cells.items():
+            cell = x * self.height + y
+            states[:, cell * n_bits:(cell + 1) * n_bits] = UNIT_BITS[self.entities[x, y] | unit]
+        states[:, map_size:] = encoded_coords
+        return torch.from_numpy(states)
+
+    def encode(self, observation: Observation, current_agent_id: str, current_unit_id: str):
+        return self.encode_batch(observation, current_agent_id, [current_unit_id])[0]
+
+
+"""
+State encoding: SPATIAL approach
+
+A [C, H, W] stack of planes indexed [channel, y, x]: one one-hot plane per
+`Unit` type, a plane marking the current unit, then the ticks left before
+each bomb explodes, the HP of units and blocks, the blast diameter of
+each bomb and the cells the current unit can walk to (see Reachability).
+Planes hold raw integer values (so states fit in uint8 storage),
+models scale them by SPATIAL_PLANE_SCALES.
+"""
+
+CURRENT_UNIT_PLANE = len(Unit)
+BOMB_TIMER_PLANE = CURRENT_UNIT_PLANE + 1
+HP_PLANE = BOMB_TIMER_PLANE + 1
+BLAST_DIAMETER_PLANE = HP_PLANE + 1
+REACHABLE_PLANE = BLAST_DIAMETER_PLANE + 1
+SPATIAL_CHANNELS = REACHABLE_PLANE + 1
+
+# Brings every plane roughly into [0, 1]; a diameter of 5x the initial one is already rare
+SPATIAL_PLANE_SCALES = [1.0] * (CURRENT_UNIT_PLANE + 1) + [
+    float(BOMB_DURATION_TICKS),
+    float(INITIAL_HP),
+    float(5 * INITIAL_BLAST_DIAMETER),
+    1.0,
+]
+
+
+def spatial_state_dimensions(observation: Observation) -> t.Tuple[int, int, int]:
+    width, height = map_dimensions(observation)
+    return SPATIAL_CHANNELS, height, width
+
+
+def encode_observation_planes(observation: Observation, current_agent_id: str) -> np.ndarray:
+    planes = np.zeros(spatial_state_dimensions(observation), dtype=np.float32)
+    tick = observation['tick']
+    for entity in observation['entities']:
+        unit = ENTITY_UNITS.get(entity['type'])
+        if unit is None:
+            continue
+        x, y = entity['x'], entity['y']
+        planes[unit, y, x] = 1
+        if unit == Unit.Bomb:
+            planes[BOMB_TIMER_PLANE, y, x] = max(entity.get('expires', tick) - tick, 0)
+            planes[BLAST_DIAMETER_PLANE, y, x] = entity.get('blast_diameter', 0)
+        elif entity.get('hp') is not None:
+            planes[HP_PLANE, y, x] = entity['hp']
+    for observed_agent_id, observed_agent_config in observation['agents'].items():
+        unit = Unit.Friend if observed_agent_id == current_agent_id else Unit.Enemy
+        for unit_id in observed_agent_config['unit_ids']:
+            unit_state = observation['unit_state'][unit_id]
+            x, y = unit_state['coordinates']
+            planes[unit, y, x] = 1
+            # units never share a cell with a block, only with bombs (which have no HP plane)
+            planes[HP_PLANE, y, x] = max(unit_state['hp'], 0)
+    return planes
+
+
+def observation_to_spatial_state(observation: Observation, current_agent_id: str, current_unit_id: str):
+    planes = encode_observation_planes(observation, current_agent_id)
+    x, y = observation['unit_state'][current_unit_id]['coordinates']
+    planes[CURRENT_UNIT_PLANE, y, x] = 1
+    planes[REACHABLE_PLANE] = get_reachability(observation).reachable_grid(current_unit_id).T
+    return torch.from_numpy(planes)
+
+
+# Batched observation_to_spatial_state, a [n_units, C, H, W] tensor
+def observation_to_spatial_states(observation: Observation, current_agent_id: str, current_unit_ids: t.List[str]):
+    planes = encode_observation_planes(observation, current_agent_id)
+    states = np.repeat(planes[None], len(current_unit_ids), axis=0)
+    reachability = get_reachability(observation)
+    for i, unit_id in enumerate(current_unit_ids):
+        x, y = observation['unit_state'][unit_id]['coordinates']
+        states[i, CURRENT_UNIT_PLANE, y, x] = 1
+        states[i, REACHABLE_PLANE] = reachability.reachable_grid(unit_id).T
+    return torch.from_numpy(states)
+
+
+"""
+Packed state storage: states are 0/1 vectors, so 8 of them fit in one byte
+(most significant bit first, like np.packbits). Replay and rollout buffers
+keep states packed and unpack them per batch.
+"""
+
+PACKED_BIT_SHIFTS = torch.arange(7, -1, -1, dtype=torch.uint8)
+
+
+def packed_state_dimensions(state_dim: int) -> int:
+    return (state_dim + 7) // 8
+
+
+def is_packed_state(state: torch.Tensor, state_dim: int) -> bool:
+    return state.dtype == torch.uint8 and state.shape[-1] == packed_state_dimensions(state_dim)
+
+
+def pack_states(states: torch.Tensor) -> torch.Tensor:
+    state_dim = states.shape[-1]
+    padding = packed_state_dimensions(state_dim) * 8 - state_dim
+    bits = torch.nn.functional.pad((states != 0).to(torch.uint8), (0, padding))
+    bits = bits.reshape(*states.shape[:-1], -1, 8)
+    return (bits << PACKED_BIT_SHIFTS.to(states.device)).sum(dim=-1, dtype=torch.uint8)
+
+
+def unpack_states(packed: torch.Tensor, state_dim: int) -> torch.Tensor:
+    bits = (packed.unsqueeze(-1) >> PACKED_BIT_SHIFTS.to(packed.device)) & 1
+    return bits.reshape(*packed.shape[:-1], -1)[..., :state_dim].to(torch.float32)
+
+
+"""
+Compact state storage for buffers: flat (0/1) states are bit-packed, spatial
+states (integer planes, see SPATIAL_PLANE_SCALES) are kept as uint8.
+`state_dim` is an int for flat states and a (C, H, W) tuple for spatial ones.
+"""
+
+def is_spatial_state_dim(state_dim) -> bool:
+    return isinstance(state_dim, tuple)
+
+
+def compact_state_shape(state_dim) -> t.Tuple[int, ...]:
+    return tuple(state_dim) if is_spatial_state_dim(state_dim) else (packed_state_dimensions(state_dim),)
+
+
+def is_compact_state(state: torch.Tensor, state_dim) -> bool:
+    if is_spatial_state_dim(state_dim):
+        return state.dtype == torch.uint8
+    return is_packed_state(state, state_dim)
+
+
+def compact_states(states: torch.Tensor, state_dim) -> torch.Tensor:
+    if is_compact_state(states, state_dim):
+        return states
+    return states.to(torch.uint8) if is_spatial_state_dim(state_dim) else pack_states(states)
+
+
+def expand_states(compact: torch.Tensor, state_dim) -> torch.Tensor:
+    return compact.to(torch.float32) if is_spatial_state_dim(state_dim) else unpack_states(compact, state_dim)
+
+
+"""
+State encodings a model can be trained on, selected by name. The flat
+encoding feeds the MLPs, the spatial one the convolutional models; models
+record theirs in `state_encoding` so agents encode game states to match.
+"""
+
+StateEncoding = collections.namedtuple(
+    'StateEncoding',
+    ('dimensions', 'encode', 'encode_batch')
+)
+
+STATE_ENCODINGS = {
+    'flat': StateEncoding(state_dimensions, observation_to_state, observation_to_states),
+    'spatial': StateEncoding(spatial_state_dimensions, observation_to_spatial_state, observation_to_spatial_states),
+}
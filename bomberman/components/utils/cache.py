@@ -0,0 +1,49 @@
+import collections
+import typing as t
+
+from components.environment.config import OBSERVATION_CACHE_SIZE
+
+_caches: t.List['ObservationCache'] = []
+_size = OBSERVATION_CACHE_SIZE
+
+
+"""
+LRU cache of something computed from an observation (its index, danger map,
+reachability, reward features), keyed by the identity of what it is computed
+from. Callers check that a hit still belongs to their observation.
+
+A step of training reads every observation twice: as the "next" one of a
+transition, then as the "prev" one of the following transition. So all of
+them hold the same number of entries, enough for the observations of two
+steps of every environment stepped together (see set_observation_cache_size).
+"""
+class ObservationCache:
+    def __init__(self):
+        self._entries: t.Dict[t.Hashable, t.Any] = collections.OrderedDict()
+        _caches.append(self)
+
+    def get(self, key: t.Hashable) -> t.Optional[t.Any]:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: t.Hashable, value: t.Any):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._trim()
+
+    def _trim(self):
+        while len(self._entries) > _size:
+            self._entries.popitem(last=False)
+
+
+"""
+Sets the number of entries of every ObservationCache, e.g. to twice the
+number of environments stepped together.
+"""
+def set_observation_cache_size(size: int):
+    global _size
+    _size = max(size, 1)
+    for cache in _caches:
+        cache._trim()
@@ -0,0 +1,167 @@
+import collections
+import math
+import typing as t
+
+import numpy as np
+
+from components.types import Coordinate, Observation
+from components.utils.cache import ObservationCache
+from components.utils.observation import Cell, get_observation_index
+
+_DIRECTIONS = ((0, 1), (0, -1), (-1, 0), (1, 0))
+
+# Every entity but a blast stops a blast
+BLAST_BLOCKING_TYPES = ["w", "o", "m", "b", "a", "bp", "fp"]
+
+
+"""
+Blast coverage of all bombs of one observation, computed at once.
+
+Blasts follow the engine (Game.createBlastFromOrigin): a bomb reaches
+ceil((blast_diameter - 1) / 2) cells in each cardinal direction and a ray
+stops at the first cell holding an entity other than a blast (metal, ore,
+wood, another bomb, a powerup). That cell is still hit: blocks and bombs
+lose hp there and units standing in it are hurt, but it is not set on fire.
+
+Bombs hit by another bomb's blast explode with it, so every bomb's
+detonation tick is the earliest one along its chain. Manual detonations are
+not predicted, bombs are assumed to run until they expire.
+
+Only the cells along the rays are looked up (in the observation index), so
+a map costs O(bombs * blast radius) rather than a pass over all entities.
+Rays are traced in plain Python: with a handful of bombs reaching a few
+cells each, numpy's per call overhead would dominate.
+
+    bomb_cells[i]       cells hit by bomb i
+    bomb_ticks[i]       ticks until bomb i goes off, chain reactions included
+    cell_bombs          bombs hitting a cell, for every cell hit by one
+    cell_ticks          ticks until a cell is hit, 0 on fire, missing when safe
+Both are also available as [x, y] grids, built on first access:
+    bomb_counts         number of bombs hitting each cell
+    ticks_until_blast   ticks until a cell is hit, 0 on fire, inf when safe
+"""
+class DangerMap:
+    def __init__(self, observation: Observation):
+        self.width, self.height = observation['world']['width'], observation['world']['height']
+        self.tick = observation['tick']
+        self.index = get_observation_index(observation)
+        self.bombs = self.index.of_type(["b"])
+
+        self.bomb_cells: t.List[t.Set[Cell]] = []
+        for bomb in self.bombs:
+            x, y = bomb['x'], bomb['y']
+            radius = math.ceil((int(bomb.get('blast_diameter', 1)) - 1) / 2)
+            cells = {(x, y)}
+            for dx, dy in _DIRECTIONS:
+                for step in range(1, radius + 1):
+                    cell = (x + dx * step, y + dy * step)
+                    if not (0 <= cell[0] < self.width and 0 <= cell[1] < self.height):
+                        break
+                    cells.add(cell)
+                    if self.index.occupied(cell, BLAST_BLOCKING_TYPES):
+                        break
+            self.bomb_cells.append(cells)
+
+        self.cell_bombs: t.Dict[Cell, t.List[int]] = collections.defaultdict(list)
+        for i, cells in enumerate(self.bomb_cells):
+            for cell in cells:
+                self.cell_bombs[cell].append(i)
+
+        # Chain reactions: a bomb goes off no later than any bomb whose blast hits it
+        ticks = [
+            max(bomb['expires'] - self.tick, 0) if bomb.get('expires') is not None else math.inf
+            for bomb in self.bombs
+        ]
+        chains = [(i, j) for j, bomb in enumerate(self.bombs) for i in self.cell_bombs[(bomb['x'], bomb['y'])] if i != j]
+        changed = True
+        while changed:
+            changed = False
+            for i, j in chains:
+                if ticks[i] < ticks[j]:
+                    ticks[j], changed = ticks[i], True
+        self.bomb_ticks = ticks
+
+        self.cell_ticks: t.Dict[Cell, float] = {}
+        for cells, tick in zip(self.bomb_cells, ticks):
+            for cell in cells:
+                if tick < self.cell_ticks.get(cell, math.inf):
+                    self.cell_ticks[cell] = tick
+        for blast in self.index.of_type(["x"]):
+            self.cell_ticks[(blast['x'], blast['y'])] = 0
+        self._bomb_counts = None
+        self._ticks_until_blast = None
+
+    @property
+    def bomb_counts(self) -> np.ndarray:
+        if self._bomb_counts is None:
+            self._bomb_counts = np.zeros((self.width, self.height), dtype=np.int64)
+            for (x, y), bombs in self.cell_bombs.items():
+                self._bomb_counts[x, y] = len(bombs)
+        return self._bomb_counts
+
+    @property
+    def ticks_until_blast(self) -> np.ndarray:
+        if self._ticks_until_blast is None:
+            self._ticks_until_blast = np.full((self.width, self.height), math.inf)
+            for (x, y), ticks in self.cell_ticks.items():
+                self._ticks_until_blast[x, y] = ticks
+        return self._ticks_until_blast
+
+    def is_dangerous(self, coords: Coordinate) -> bool:
+        return tuple(coords) in self.cell_ticks
+
+    def ticks_until(self, coords: Coordinate) -> float:
+        return self.cell_ticks.get(tuple(coords), math.inf)
+
+    # Indices (into `bombs`) of the bombs whose blast hits coords
+    def bombs_reaching(self, coords: Coordinate) -> t.List[int]:
+        return self.cell_bombs.get(tuple(coords), [])
+
+    def bomb_distances(self, coords: Coordinate) -> t.List[int]:
+        x, y = coords
+        return [abs(self.bombs[i]['x'] - x) + abs(self.bombs[i]['y'] - y) for i in self.bombs_reaching(coords)]
+
+    def unit_bombs(self, unit_id: str) -> t.List[int]:
+        return [i for i, bomb in enumerate(self.bombs) if bomb.get('unit_id') == unit_id]
+
+    # Number of the given bombs hitting coords
+    def count_reaching(self, bomb_indices: t.List[int], coords: Coordinate) -> int:
+        cell = tuple(coords)
+        return sum(cell in self.bomb_cells[i] for i in bomb_indices)
+
+    # Number of entities of the given types hit by each of the bombs, summed
+    def count_hit(self, bomb_indices: t.List[int], types: t.List[str]) -> int:
+        return sum(len(self.index.at(self.bomb_cells[i], types)) for i in bomb_indices)
+
+
+_danger_map_cache = ObservationCache()
+
+"""
+Returns the danger map of an observation, building it on first use.
+
+Cached by the observation index it is built from (see get_observation_index)
+and the tick, since bombs get closer to going off with every tick.
+"""
+def get_danger_map(observation: Observation) -> DangerMap:
+    index = get_observation_index(observation)
+    key = (id(index), observation['tick'])
+    danger_map = _danger_map_cache.get(key)
+    if danger_map is not None and danger_map.index is index:
+        return danger_map
+
+    danger_map = DangerMap(observation)
+    _danger_map_cache.put(key, danger_map)
+    return danger_map
+
+
+def dangerous_bomb_count(observation: Observation, unit_id: str) -> int:
+    unit_coords = observation["unit_state"][unit_id]['coordinates']
+    return len(get_danger_map(observation).bombs_reaching(unit_coords))
+
+
+"""
+Distances to the bombs whose blast reaches the unit.
+"""
+def dangerous_bomb_distances(observation: Observation, unit_id: str) -> t.List[int]:
+    unit_coords = observation["unit_state"][unit_id]['coordinates']
+    return get_danger_map(observation).bomb_distances(unit_coords)
@@ -0,0 +1,89 @@
+import json
+import os
+import typing as t
+
+import numpy as np
+
+# Columns of every shard, one row per transition
+DATASET_COLUMNS = (
+    'states',       # compacted states (see compact_states)
+    'actions',      # indices into ACTIONS
+    'rewards',
+    'next_states',
+    'dones',        # the game ended or the unit died
+    'replays',      # index of the replay file in the metadata's `replays`
+    'ticks',        # tick of next_states
+    'agent_ids',
+    'unit_ids',
+    'won',          # whether the unit's agent won the game
+)
+METADATA_FILE = "metadata.json"
+
+
+"""
+Writes transitions to a directory as columnar .npz shards of `shard_size`
+rows (the last one may be smaller), so a dataset of any size is built with
+one shard in memory. `close` writes the metadata: the shard files, the
+number of transitions and whatever the caller adds (encoding, state_dim...).
+"""
+class ShardWriter:
+    def __init__(self, directory: str, shard_size: int, compress: bool = True):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.shard_size = shard_size
+        self.compress = compress
+        self.shards: t.List[str] = []
+        self.transitions = 0
+        self._chunks: t.Dict[str, t.List[np.ndarray]] = {column: [] for column in DATASET_COLUMNS}
+        self._pending = 0
+
+    def add(self, columns: t.Dict[str, np.ndarray]):
+        rows = len(columns['actions'])
+        if rows == 0:
+            return
+        for column in DATASET_COLUMNS:
+            self._chunks[column].append(np.asarray(columns[column]))
+        self._pending += rows
+        while self._pending >= self.shard_size:
+            self._write(self.shard_size)
+
+    def _write(self, rows: int):
+        shard, rest = {}, {}
+        for column, chunks in self._chunks.items():
+            values = np.concatenate(chunks)
+            shard[column], rest[column] = values[:rows], values[rows:]
+        self._chunks = {column: [values] for column, values in rest.items()}
+        self._pending -= rows
+
+        name = f"shard_{len(self.shards):05d}.npz"
+        save = np.savez_compressed if self.compress else np.savez
+        save(os.path.join(self.directory, name), **shard)
+        self.shards.append(name)
+        self.transitions += rows
+
+    def close(self, metadata: t.Optional[t.Dict] = None):
+        if self._pending:
+            self._write(self._pending)
+        metadata = {**(metadata or {}), 'shards': self.shards, 'transitions': self.transitions}
+        with open(os.path.join(self.directory, METADATA_FILE), 'w') as file:
+            json.dump(metadata, file)
+
+
+def read_metadata(directory: str) -> t.Dict:
+    with open(os.path.join(directory, METADATA_FILE)) as file:
+        metadata = json.load(file)
+    # JSON has no tuples, spatial state dimensions are (C, H, W)
+    if isinstance(metadata.get('state_dim'), list):
+        metadata['state_dim'] = tuple(metadata['state_dim'])
+    return metadata
+
+
+"""
+Shards of a dataset one at a time, as dicts of the requested columns (all
+by default); only the columns asked for are read from each shard.
+"""
+def iterate_shards(directory: str, columns: t.Optional[t.Iterable[str]] = None) -> t.Iterator[t.Dict[str, np.ndarray]]:
+    columns = tuple(columns or DATASET_COLUMNS)
+    for name in read_metadata(directory)['shards']:
+        with np.load(os.path.join(directory, name)) as shard:
+            yield {column: shard[column] for column in columns}
@@ -0,0 +1,234 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+import typing as t
+
+from components.environment.config import (
+    LOG_JSON,
+    LOG_LEVEL,
+    LOG_METRICS_INTERVAL,
+    LOG_QUEUE_SIZE,
+)
+
+DEBUG, INFO, WARNING, ERROR = logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR
+
+ROOT_LOGGER_NAME = "bomberman"
+
+
+"""
+Records are written by a background thread: the caller only checks the level
+and enqueues the record, the event's fields are formatted by the writer. So
+fields must not be mutated after they were logged (observations are treated
+as immutable snapshots anyway). When the writer falls behind by more than
+LOG_QUEUE_SIZE records new ones are dropped and counted rather than blocking
+the training loop.
+"""
+class _AsyncHandler(logging.handlers.QueueHandler):
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+"""
+One line per record: "time level logger event key=value ...", or a JSON
+object with the same keys when LOG_JSON is set.
+"""
+class _StructuredFormatter(logging.Formatter):
+    def __init__(self, as_json: bool):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", {})
+        if self.as_json:
+            return json.dumps({
+                "time": record.created,
+                "level": record.levelname,
+                "logger": record.name,
+                "event": record.getMessage(),
+                **fields,
+            }, default=str)
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created))
+        values = " ".join(f"{key}={value}" for key, value in fields.items())
+        return f"{timestamp} {record.levelname:<7} {record.name} {record.getMessage()} {values}".rstrip()
+
+
+_handler: t.Optional[_AsyncHandler] = None
+_listener: t.Optional[logging.handlers.QueueListener] = None
+_loggers: t.List['Logger'] = []
+_configure_lock = threading.Lock()
+
+
+def configure_logging(level: t.Union[int, str] = LOG_LEVEL, as_json: bool = LOG_JSON, stream=None):
+    global _handler, _listener
+    with _configure_lock:
+        if _listener is not None:
+            _listener.stop()
+        root = logging.getLogger(ROOT_LOGGER_NAME)
+        root.setLevel(level if isinstance(level, int) else level.upper())
+        root.propagate = False
+        if _handler is not None:
+            root.removeHandler(_handler)
+
+        writer = logging.StreamHandler(stream or sys.stdout)
+        writer.setFormatter(_StructuredFormatter(as_json))
+        _handler = _AsyncHandler(queue.Queue(LOG_QUEUE_SIZE))
+        root.addHandler(_handler)
+        _listener = logging.handlers.QueueListener(_handler.queue, writer)
+        _listener.start()
+
+
+"""
+Logs the metrics aggregated so far by every logger, e.g. at the end of an epoch.
+"""
+def flush_metrics():
+    for logger in _loggers:
+        logger.flush_metrics()
+
+
+"""
+Flushes pending metrics and waits for the writer to print every record.
+"""
+def shutdown_logging():
+    global _listener
+    flush_metrics()
+    with _configure_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+        if _handler is not None and _handler.dropped:
+            print(f"{_handler.dropped} log records were dropped, the log writer could not keep up")
+
+
+atexit.register(shutdown_logging)
+
+
+"""
+Aggregate of the values of one metric since its last record.
+"""
+class _Metric:
+    __slots__ = ('count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+
+"""
+A named logger of structured events.
+
+    log = get_logger(__name__)
+    log.debug("action", agent_id=agent_id, unit_id=unit_id)
+    log.metric("reward", reward)
+    log.throttled(WARNING, "missed_deadline", 10, latency_ms=latency_ms)
+
+Logging a disabled level costs one method call and a level check; nothing is
+formatted. `metric` aggregates values (count, mean, min, max) and logs them at
+INFO as one "metrics" record every LOG_METRICS_INTERVAL seconds. `throttled`
+logs an event at most once per `seconds`, with the number of calls it
+suppressed in between.
+"""
+class Logger:
+    def __init__(self, name: str):
+        self._logger = logging.getLogger(name)
+        self._metrics: t.Dict[str, _Metric] = {}
+        self._metrics_since = time.monotonic()
+        self._throttled: t.Dict[str, t.Tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    def is_enabled(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def log(self, level: int, event: str, **fields):
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, event, extra={"fields": fields})
+
+    def debug(self, event: str, **fields):
+        if self._logger.isEnabledFor(DEBUG):
+            self._logger.debug(event, extra={"fields": fields})
+
+    def info(self, event: str, **fields):
+        if self._logger.isEnabledFor(INFO):
+            self._logger.info(event, extra={"fields": fields})
+
+    def warning(self, event: str, **fields):
+        if self._logger.isEnabledFor(WARNING):
+            self._logger.warning(event, extra={"fields": fields})
+
+    def error(self, event: str, **fields):
+        if self._logger.isEnabledFor(ERROR):
+            self._logger.error(event, extra={"fields": fields})
+
+    def throttled(self, level: int, event: str, seconds: float, **fields):
+        if not self._logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        with self._lock:
+            last, suppressed = self._throttled.get(event, (-float('inf'), 0))
+            if now - last < seconds:
+                self._throttled[event] = (last, suppressed + 1)
+                return
+            self._throttled[event] = (now, 0)
+        self._logger.log(level, event, extra={"fields": {**fields, "suppressed": suppressed}})
+
+    def metric(self, name: str, value: float):
+        if not self._logger.isEnabledFor(INFO):
+            return
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = _Metric()
+            metric.add(value)
+            due = time.monotonic() - self._metrics_since >= LOG_METRICS_INTERVAL
+        if due:
+            self.flush_metrics()
+
+    def flush_metrics(self):
+        with self._lock:
+            metrics, self._metrics = self._metrics, {}
+            self._metrics_since = time.monotonic()
+        if not metrics:
+            return
+        fields = {}
+        for name, metric in metrics.items():
+            fields[f"{name}_count"] = metric.count
+            fields[f"{name}_mean"] = metric.total / metric.count
+            fields[f"{name}_min"] = metric.min
+            fields[f"{name}_max"] = metric.max
+        self._logger.info("metrics", extra={"fields": fields})
+
+
+"""
+Returns a logger under the "bomberman" hierarchy, configuring logging from
+LOG_LEVEL and LOG_JSON on first use.
+"""
+def get_logger(name: str) -> Logger:
+    if _listener is None:
+        configure_logging()
+    logger = Logger(f"{ROOT_LOGGER_NAME}.{name}")
+    _loggers.append(logger)
+    return logger
@@ -1,17 +1,151 @@
-import math 
+import collections
+import math
 import typing as t
 
 from components.types import Coordinate, Observation
+from components.utils.cache import ObservationCache
 from components.utils.metrics import manhattan_distance
 
+OBSTACLE_TYPES = ["w", "o", "m"]
+BARRIER_TYPES = ["b", "x"]
 
+Cell = t.Tuple[int, int]
+Entity = t.Dict
+PositionedEntity = t.Tuple[int, Entity]
+
+
+def cells_at_distance(coords: Coordinate, distance: int) -> t.List[Cell]:
+    x, y = coords
+    if distance == 0:
+        return [(x, y)]
+    cells = []
+    for dx in range(-distance, distance + 1):
+        dy = distance - abs(dx)
+        cells.append((x + dx, y + dy))
+        if dy != 0:
+            cells.append((x + dx, y - dy))
+    return cells
+
+
+"""
+Entities of a single observation bucketed by type and by (x, y) cell.
+
+Every entity is stored together with its position in observation["entities"],
+so ties between equally distant entities resolve to the one listed first,
+exactly like a linear scan over the list does.
 """
-Bomb definition: 
+class ObservationIndex:
+    def __init__(self, entities: t.List[Entity]):
+        self.entities = entities
+        self.size = len(entities)
+        self._by_type: t.Dict[str, t.List[PositionedEntity]] = collections.defaultdict(list)
+        self._by_cell: t.Dict[Cell, t.List[PositionedEntity]] = collections.defaultdict(list)
+        for position, entity in enumerate(entities):
+            self._by_type[entity.get("type")].append((position, entity))
+            self._by_cell[(entity["x"], entity["y"])].append((position, entity))
+
+    def of_type(self, types: t.List[str]) -> t.List[Entity]:
+        if len(types) == 1:
+            return [entity for _, entity in self._by_type.get(types[0], ())]
+        positioned = []
+        for type in types:
+            positioned.extend(self._by_type.get(type, ()))
+        return [entity for _, entity in sorted(positioned, key=lambda item: item[0])]
+
+    def count_of_type(self, types: t.List[str]) -> int:
+        return sum(len(self._by_type.get(type, ())) for type in types)
+
+    def at(self, cells: t.Iterable[Cell], types: t.List[str]) -> t.List[PositionedEntity]:
+        found = []
+        for cell in cells:
+            for position, entity in self._by_cell.get(cell, ()):
+                if entity.get("type") in types:
+                    found.append((position, entity))
+        return found
+
+    def occupied(self, cell: Cell, types: t.List[str]) -> bool:
+        for _, entity in self._by_cell.get(cell, ()):
+            if entity.get("type") in types:
+                return True
+        return False
+
+    def nearest(self, coords: Coordinate, types: t.List[str]) -> Entity or None:
+        candidates = self.count_of_type(types)
+        if candidates == 0:
+            return None
+
+        # Search outwards ring by ring while that is cheaper than scanning the buckets
+        distance, searched = 0, 1
+        while searched <= candidates:
+            found = self.at(cells_at_distance(coords, distance), types)
+            if found:
+                return min(found, key=lambda item: item[0])[1]
+            distance += 1
+            searched += 4 * distance
+
+        min_key, nearest_entity = (+math.inf, +math.inf), None
+        for type in types:
+            for position, entity in self._by_type.get(type, ()):
+                key = (manhattan_distance(coords, [entity['x'], entity['y']]), position)
+                if key < min_key:
+                    min_key, nearest_entity = key, entity
+        return nearest_entity
+
+    def nearest_adjacent(self, coords: Coordinate, types: t.List[str]) -> t.Tuple[int, t.List[Entity]]:
+        for distance in (0, 1):
+            found = self.at(cells_at_distance(coords, distance), types)
+            if found:
+                return len(found), [entity for _, entity in sorted(found, key=lambda item: item[0])]
+        return 0, []
+
+    def count_within(self, coords: Coordinate, types: t.List[str], radius: float) -> int:
+        candidates = self.count_of_type(types)
+        if candidates == 0:
+            return 0
+
+        max_distance = math.ceil(radius) - 1
+        if max_distance < 0:
+            return 0
+        if 2 * max_distance * (max_distance + 1) + 1 <= candidates:
+            return sum(
+                len(self.at(cells_at_distance(coords, distance), types))
+                for distance in range(max_distance + 1)
+            )
+
+        count = 0
+        for type in types:
+            for _, entity in self._by_type.get(type, ()):
+                if manhattan_distance(coords, [entity['x'], entity['y']]) < radius:
+                    count += 1
+        return count
+
+
+_observation_index_cache = ObservationCache()
+
+"""
+Returns the index of observation["entities"], building it on first use.
+
+The index is cached by the identity of the entities list (the cache keeps the
+list alive, so the identity cannot be reused) and rebuilt when its length changes.
+"""
+def get_observation_index(observation: Observation) -> ObservationIndex:
+    entities = observation["entities"]
+    key = id(entities)
+    index = _observation_index_cache.get(key)
+    if index is not None and index.size == len(entities):
+        return index
+
+    index = ObservationIndex(entities)
+    _observation_index_cache.put(key, index)
+    return index
+
+
+"""
+Bomb definition:
     {'created': 74, 'x': 11, 'y': 10, 'type': 'b', 'unit_id': 'd', 'agent_id': 'b', 'expires': 104, 'hp': 1, 'blast_diameter': 3}
 """
 def get_bomb_to_detonate(observation: Observation, unit_id: str) -> Coordinate or None:
-    entities = observation["entities"]
-    bombs = list(filter(lambda entity: entity.get("unit_id") == unit_id and entity.get("type") == "b", entities))
+    bombs = get_unit_activated_bombs(observation, unit_id)
     bomb = next(iter(bombs or []), None)
     if bomb != None:
         return [bomb.get("x"), bomb.get("y")]
@@ -20,297 +154,92 @@ def get_bomb_to_detonate(observation: Observation, unit_id: str) -> Coordinate o
 
 
 """
-Bomb definition: 
+Bomb definition:
     {'created': 74, 'x': 11, 'y': 10, 'type': 'b', 'unit_id': 'd', 'agent_id': 'b', 'expires': 104, 'hp': 1, 'blast_diameter': 3}
 """
 def get_nearest_active_bomb(observation: Observation, unit_id: str):
     unit = observation["unit_state"][unit_id]
     unit_coords = unit['coordinates']
-
-    entities = observation["entities"]
-    bombs = list(filter(lambda entity: entity.get("type") == "b", entities))
-
-    min_distance, nearest_bomb = +math.inf, None
-    for bomb in bombs:
-        bomb_coords = [bomb['x'], bomb['y']]
-        bomb_distance = manhattan_distance(unit_coords, bomb_coords)
-        if bomb_distance < min_distance:
-            min_distance = bomb_distance
-            nearest_bomb = bomb
-
-    return nearest_bomb
+    return get_observation_index(observation).nearest(unit_coords, ["b"])
 
 
 """
-Bomb definition: 
+Bomb definition:
     {'created': 74, 'x': 11, 'y': 10, 'type': 'b', 'unit_id': 'd', 'agent_id': 'b', 'expires': 104, 'hp': 1, 'blast_diameter': 3}
 """
 def get_unit_activated_bombs(observation: Observation, unit_id: str):
-    entities = observation["entities"]
-    unit_bombs = list(filter(lambda entity: entity["type"] == "b" and entity["unit_id"] == unit_id, entities))
+    bombs = get_observation_index(observation).of_type(["b"])
+    unit_bombs = [bomb for bomb in bombs if bomb.get("unit_id") == unit_id]
     return unit_bombs
-    
+
 
 """
-Obstacle definitions: 
+Obstacle definitions:
     a. Wooden Block: {"created":0, "x":10, "y":1, "type":"w", "hp":1}
     b. Ore Block: {"created":0, "x":0, "y":13, "type":"o", "hp":3}
     c. Metal Block: {"created":0, "x":3, "y":7, "type":"m"}
 """
 def get_obtacles(observation: t.Dict):
-    entities = observation["entities"]
-    obstacles = list(filter(lambda entity: entity.get("type") in ["w", "o", "m"], entities))
-    return obstacles
+    return get_observation_index(observation).of_type(OBSTACLE_TYPES)
 
 
 def get_nearest_obstacle(observation: Observation, coords: Coordinate):
-    entities = observation["entities"]
-    obstacles = list(filter(lambda entity: entity.get("type") in ["w", "o", "m"], entities))
-
-    min_distance, nearest_obstacle = +math.inf, None
-    for obstacle in obstacles:
-        obstacle_coords = [obstacle['x'], obstacle['y']]
-        obstacle_distance = manhattan_distance(coords, obstacle_coords)
-        if obstacle_distance < min_distance:
-            min_distance = obstacle_distance
-            nearest_obstacle = obstacle
-
-    return nearest_obstacle
-    
-    
-def get_nearest_obstacle_count(observation: Observation, coords: Coordinate):
-    entities = observation["entities"]
-    obstacles = list(filter(lambda entity: entity.get("type") in ["w", "o", "m"], entities))
-
-    min_distance, nearest_obstacle = +math.inf, None
-    nearest_obstacles = []
-    if obstacles:
-        count = 1
-    for obstacle in obstacles:
-        obstacle_coords = [obstacle['x'], obstacle['y']]
-        obstacle_distance = manhattan_distance(coords, obstacle_coords)
-        if obstacle_distance < min_distance:
-            min_distance = obstacle_distance
-            nearest_obstacle = obstacle
-            count = 1
-            nearest_obstacles = [nearest_obstacle]
-        elif obstacle_distance == min_distance:
-            count += 1
-            nearest_obstacles.append(obstacle)
-            
-    if (min_distance > 1):
-        return 0, []
-    return (count, nearest_obstacles)
-    
-def get_nearest_1_barier_count(observation: Observation, coords: Coordinate):
-    entities = observation["entities"]
-    obstacles = list(filter(lambda entity: entity.get("type") in ["b", "x"], entities))
-
-    min_distance, nearest_obstacle = +math.inf, None
-    nearest_obstacles = []
-    if obstacles:
-        count = 1
-    for obstacle in obstacles:
-        obstacle_coords = [obstacle['x'], obstacle['y']]
-        obstacle_distance = manhattan_distance(coords, obstacle_coords)
-        if obstacle_distance < min_distance:
-            min_distance = obstacle_distance
-            nearest_obstacle = obstacle
-            count = 1
-            nearest_obstacles = [nearest_obstacle]
-        elif obstacle_distance == min_distance:
-            count += 1
-            nearest_obstacles.append(obstacle)
-            
-    if (min_distance > 1):
-        return 0, []
-    return (count, nearest_obstacles)
-
-def get_bomb(observation: Observation):
-    entities = observation["entities"]
-    bomb = list(filter(lambda entity: entity.get("type") in ["b"], entities))
-    return bomb
-    
-def dangerous_bomb_count(observation: Observation, unit_id: str)->int:
-    unit = observation["unit_state"][unit_id]
-    unit_coords = unit['coordinates']
-
-    entities = observation["entities"]
-    bombs = list(filter(lambda entity: entity.get("type") == "b", entities))
-
-    count = 0
-    for bomb in bombs:
-        bomb_coords = [bomb['x'], bomb['y']]
-        bomb_distance = manhattan_distance(unit_coords, bomb_coords)
-        if (bomb_distance <= int(bomb['blast_diameter']))/2.:
-            count += 1
-
-    return count
+    return get_observation_index(observation).nearest(coords, OBSTACLE_TYPES)
 
-def dangerous_bomb_distances(observation: Observation, unit_id: str)->int:
-    unit = observation["unit_state"][unit_id]
-    unit_coords = unit['coordinates']
 
-    entities = observation["entities"]
-    bombs = list(filter(lambda entity: entity.get("type") == "b", entities))
+def get_nearest_obstacle_count(observation: Observation, coords: Coordinate):
+    return get_observation_index(observation).nearest_adjacent(coords, OBSTACLE_TYPES)
 
-    distances = []
-    for bomb in bombs:
-        bomb_coords = [bomb['x'], bomb['y']]
-        bomb_distance = manhattan_distance(unit_coords, bomb_coords)
-        if (bomb_distance <= int(bomb['blast_diameter']))/2.: #??????????? obstacle
-            distances.append(bomb_distance)
+def get_nearest_1_barier_count(observation: Observation, coords: Coordinate):
+    return get_observation_index(observation).nearest_adjacent(coords, BARRIER_TYPES)
 
-    return distances
+def get_bomb(observation: Observation):
+    return get_observation_index(observation).of_type(["b"])
 
 def get_blast(observation: Observation):
-    entities = observation["entities"]
-    blast = list(filter(lambda entity: entity.get("type") in ["x"], entities))
-    return blast
-    
+    return get_observation_index(observation).of_type(["x"])
+
 def get_nearest_blast(observation: Observation, coords: Coordinate):
-    blasts = get_blast(observation)
-    min_distance, nearest_blast = +math.inf, None
-    for blast in blasts:
-        blast_coords = [blast['x'], blast['y']]
-        blast_distance = manhattan_distance(coords, blast_coords)
-        if blast_distance < min_distance:
-            min_distance = blast_distance
-            nearest_blast = blast
-
-    return nearest_blast
-    
+    return get_observation_index(observation).nearest(coords, ["x"])
+
 def get_wooden_obstacle(observation: Observation):
-    entities = observation["entities"]
-    wooden = list(filter(lambda entity: entity.get("type") in ["w"], entities))
-    return wooden
-    
+    return get_observation_index(observation).of_type(["w"])
+
 def get_nearest_wooden_obstacle(observation: Observation, coords: Coordinate):
-    wooden_obstacles = get_wooden_obstacle(observation)
-    min_distance, nearest_wooden_obstacle = +math.inf, None
-    for wooden_obstacle in wooden_obstacles:
-        wooden_obstacle_coords = [wooden_obstacle['x'], wooden_obstacle['y']]
-        wooden_obstacle_distance = manhattan_distance(coords, wooden_obstacle_coords)
-        if wooden_obstacle_distance < min_distance:
-            min_distance = wooden_obstacle_distance
-            nearest_wooden_obstacle = wooden_obstacle
-
-    return nearest_wooden_obstacle
-    
+    return get_observation_index(observation).nearest(coords, ["w"])
+
 def get_count_wooden_obstacle_in_blast_diameter(observation: Observation, coords: Coordinate, blast_diameter)->int:
-    wooden_obstacles = get_wooden_obstacle(observation)
-    count = 0
-    for wooden_obstacle in wooden_obstacles:
-        wooden_obstacle_coords = [wooden_obstacle['x'], wooden_obstacle['y']]
-        wooden_obstacle_distance = manhattan_distance(coords, wooden_obstacle_coords)
-        if wooden_obstacle_distance < blast_diameter:
-            count += 1
-
-    return count
-    
+    return get_observation_index(observation).count_within(coords, ["w"], blast_diameter)
+
 def get_ore_obstacle(observation: Observation):
-    entities = observation["entities"]
-    ore = list(filter(lambda entity: entity.get("type") in ["o"], entities))
-    return ore
-    
+    return get_observation_index(observation).of_type(["o"])
+
 def get_nearest_ore_obstacle(observation: Observation, coords: Coordinate):
-    ore_obstacles = get_ore_obstacle(observation)
-    min_distance, nearest_ore_obstacle = +math.inf, None
-    for ore_obstacle in ore_obstacles:
-        ore_obstacle_coords = [ore_obstacle['x'], ore_obstacle['y']]
-        ore_obstacle_distance = manhattan_distance(coords, ore_obstacle_coords)
-        if ore_obstacle_distance < min_distance:
-            min_distance = ore_obstacle_distance
-            nearest_ore_obstacle = ore_obstacle
-
-    return nearest_ore_obstacle
-    
+    return get_observation_index(observation).nearest(coords, ["o"])
+
 def get_count_ore_obstacle_in_blast_diameter(observation: Observation, coords: Coordinate, blast_diameter)->int:
-    ore_obstacles = get_ore_obstacle(observation)
-    count = 0
-    for ore_obstacle in ore_obstacles:
-        ore_obstacle_coords = [ore_obstacle['x'], ore_obstacle['y']]
-        ore_obstacle_distance = manhattan_distance(coords, ore_obstacle_coords)
-        if ore_obstacle_distance < blast_diameter:
-            count += 1
-
-    return count
-    
-def get_nearest_blast(observation: Observation, coords: Coordinate):
-    blasts = get_blast(observation)
-    min_distance, nearest_blast = +math.inf, None
-    for blast in blasts:
-        blast_coords = [blast['x'], blast['y']]
-        blast_distance = manhattan_distance(coords, blast_coords)
-        if blast_distance < min_distance:
-            min_distance = blast_distance
-            nearest_blast = blast
-
-    return nearest_blast
-    
+    return get_observation_index(observation).count_within(coords, ["o"], blast_diameter)
+
 def get_metal_obstacle(observation: Observation):
-    entities = observation["entities"]
-    metal = list(filter(lambda entity: entity.get("type") in ["m"], entities))
-    return metal
-    
+    return get_observation_index(observation).of_type(["m"])
+
 def get_nearest_metal_obstacle(observation: Observation, coords: Coordinate):
-    metal_obstacles = get_metal_obstacle(observation)
-    min_distance, nearest_metal_obstacle = +math.inf, None
-    for metal_obstacle in metal_obstacles:
-        metal_obstacle_coords = [metal_obstacle['x'], metal_obstacle['y']]
-        metal_obstacle_distance = manhattan_distance(coords, metal_obstacle_coords)
-        if metal_obstacle_distance < min_distance:
-            min_distance = metal_obstacle_distance
-            nearest_metal_obstacle = metal_obstacle
-
-    return nearest_metal_obstacle
-    
+    return get_observation_index(observation).nearest(coords, ["m"])
+
 def get_count_metal_obstacle_in_blast_diameter(observation: Observation, coords: Coordinate, blast_diameter)->int:
-    metal_obstacles = get_metal_obstacle(observation)
-    count = 0
-    for metal_obstacle in metal_obstacles:
-        metal_obstacle_coords = [metal_obstacle['x'], metal_obstacle['y']]
-        metal_obstacle_distance = manhattan_distance(coords, metal_obstacle_coords)
-        if metal_obstacle_distance < blast_diameter:
-            count += 1
-
-    return count
-    
+    return get_observation_index(observation).count_within(coords, ["m"], blast_diameter)
+
 def get_freeze_powerup(observation: Observation):
-    entities = observation["entities"]
-    freeze_powerup = list(filter(lambda entity: entity.get("type") in ["fp"], entities))
-    return freeze_powerup
-    
+    return get_observation_index(observation).of_type(["fp"])
+
 def get_nearest_freeze_powerup(observation: Observation, coords: Coordinate):
-    freeze_powerups = get_freeze_powerup(observation)
-    min_distance, nearest_freeze_powerup = +math.inf, None
-    for freeze_powerup in freeze_powerups:
-        freeze_powerup_coords = [freeze_powerup['x'], freeze_powerup['y']]
-        freeze_powerup_distance = manhattan_distance(coords, freeze_powerup_coords)
-        if freeze_powerup_distance < min_distance:
-            min_distance = freeze_powerup_distance
-            nearest_freeze_powerup = freeze_powerup
-
-    return nearest_freeze_powerup
-    
+    return get_observation_index(observation).nearest(coords, ["fp"])
+
 def get_blast_powerup(observation: Observation):
-    entities = observation["entities"]
-    blast_powerup = list(filter(lambda entity: entity.get("type") in ["bp"], entities))
-    return blast_powerup
-    
+    return get_observation_index(observation).of_type(["bp"])
+
 def get_nearest_blast_powerup(observation: Observation, coords: Coordinate):
-    blast_powerups = get_blast_powerup(observation)
-    min_distance, nearest_blast_powerup = +math.inf, None
-    for blast_powerup in blast_powerups:
-        blast_powerup_coords = [blast_powerup['x'], blast_powerup['y']]
-        blast_powerup_distance = manhattan_distance(coords, blast_powerup_coords)
-        if blast_powerup_distance < min_distance:
-            min_distance = blast_powerup_distance
-            nearest_blast_powerup = blast_powerup
-
-    return nearest_blast_powerup
-    
+    return get_observation_index(observation).nearest(coords, ["bp"])
+
 def get_ammunition(observation: Observation):
-    entities = observation["entities"]
-    blast_powerup = list(filter(lambda entity: entity.get("type") in ["a"], entities))
-    return blast_powerup
\ No newline at end of file
+    return get_observation_index(observation).of_type(["a"])
@@ -0,0 +1,163 @@
+import bisect
+import csv
+import json
+import os
+import threading
+import time
+import typing as t
+
+# Upper bounds (seconds) of the histogram buckets, 4 per decade from 1 us to 10 s
+HISTOGRAM_BOUNDS = [10 ** (exponent / 4) for exponent in range(-24, 5)]
+SUMMARY_PERCENTILES = (50, 90, 99)
+SUMMARY_FIELDS = ['step', 'time', 'phase', 'count', 'total_ms', 'mean_ms', 'min_ms'] + \
+    [f'p{percentile}_ms' for percentile in SUMMARY_PERCENTILES] + ['max_ms']
+
+
+"""
+Durations of one phase: count, total, extremes and a log-bucketed histogram
+that percentiles are estimated from (the upper bound of the bucket holding
+them, capped by the maximum).
+"""
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.buckets[bisect.bisect_left(HISTOGRAM_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percentile: float) -> float:
+        rank = percentile / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(HISTOGRAM_BOUNDS[bucket], self.max) if bucket < len(HISTOGRAM_BOUNDS) else self.max
+        return self.max
+
+
+class _PhaseTimer:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler: 'Profiler', name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+"""
+Per step timings of the training loop's phases, kept in memory.
+
+    with profiler.phase("env_step"):
+        observation, done, info = await env.step(actions)
+    profiler.step()
+
+Every `export_every` steps the histograms collected since the previous export
+are summarized (count, total, mean, min, percentiles and max per phase, in ms),
+appended to `path` and reset; `totals` keeps histograms of the whole run. A path ending in .csv gets one row per phase and
+export, any other one a JSON object per line. Without a path summaries are
+only kept in `summaries`. Phases may be recorded from several threads (the DQN
+learner optimizes in its own). A disabled profiler records nothing.
+"""
+class Profiler:
+    def __init__(self, path: t.Optional[str] = None, export_every: int = 1000, enabled: bool = True):
+        self.path = path
+        self.export_every = export_every
+        self.enabled = enabled
+        self.steps = 0
+        self.histograms: t.Dict[str, Histogram] = {}
+        self.totals: t.Dict[str, Histogram] = {}
+        self.summaries: t.List[t.List[t.Dict]] = []
+        self._lock = threading.Lock()
+
+    def phase(self, name: str):
+        return _PhaseTimer(self, name) if self.enabled else _NO_TIMER
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            for histograms in (self.histograms, self.totals):
+                histogram = histograms.get(name)
+                if histogram is None:
+                    histogram = histograms[name] = Histogram()
+                histogram.add(seconds)
+
+    def step(self, steps: int = 1):
+        if not self.enabled:
+            return
+        self.steps += steps
+        if self.export_every and self.steps % self.export_every < steps:
+            self.export()
+
+    def summary(self, totals: bool = False) -> t.List[t.Dict]:
+        with self._lock:
+            return self._summarize(self.totals if totals else self.histograms)
+
+    def _summarize(self, histograms: t.Dict[str, Histogram]) -> t.List[t.Dict]:
+        now = time.time()
+        rows = []
+        for name, histogram in histograms.items():
+            row = {
+                'step': self.steps,
+                'time': now,
+                'phase': name,
+                'count': histogram.count,
+                'total_ms': histogram.total * 1000,
+                'mean_ms': histogram.total / histogram.count * 1000,
+                'min_ms': histogram.min * 1000,
+            }
+            for percentile in SUMMARY_PERCENTILES:
+                row[f'p{percentile}_ms'] = histogram.percentile(percentile) * 1000
+            row['max_ms'] = histogram.max * 1000
+            rows.append(row)
+        return rows
+
+    def export(self):
+        with self._lock:
+            histograms, self.histograms = self.histograms, {}
+        rows = self._summarize(histograms)
+        if not rows:
+            return
+        self.summaries.append(rows)
+        if self.path is None:
+            return
+        if self.path.endswith('.csv'):
+            write_header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, 'a', newline='') as file:
+                writer = csv.DictWriter(file, fieldnames=SUMMARY_FIELDS)
+                if write_header:
+                    writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(self.path, 'a') as file:
+                file.write(json.dumps({'step': self.steps, 'phases': rows}) + '\n')
+
+    def print_summary(self, totals: bool = True):
+        rows = self.summary(totals)
+        total = sum(row['total_ms'] for row in rows) or 1.0
+        for row in sorted(rows, key=lambda row: -row['total_ms']):
+            print(f"{row['phase']:>24}: {row['count']:>8} calls, mean {row['mean_ms']:8.3f} ms, p99 {row['p99_ms']:8.3f} ms, {100 * row['total_ms'] / total:5.1f}% of the recorded time")
@@ -0,0 +1,153 @@
+import collections
+import math
+import typing as t
+
+import numpy as np
+
+from components.types import Coordinate, Observation
+from components.utils.cache import ObservationCache
+from components.utils.danger import get_danger_map
+
+# Entities a unit cannot step onto, everything else is walkable (like _walkable_entities of the forward model)
+MOVE_BLOCKING_TYPES = ["w", "o", "m", "b"]
+
+UnitReachability = collections.namedtuple(
+    'UnitReachability',
+    ('reachable', 'reachable_count', 'safe_distance', 'can_escape')
+)
+
+
+"""
+Where every unit of an observation can go, from bitboard flood fills.
+
+A board is a Python int holding one bit per cell, bit y * (width + 1) + x.
+The extra column always stays empty, so shifting a board by one never wraps
+a row into the next one and a flood fill step is four shifts and a mask,
+whatever the size of the map.
+
+For every unit in unit_state:
+    reachable           bitboard of the cells it can walk to, danger ignored
+    reachable_count     number of those cells, its own included
+    safe_distance       moves to the nearest cell no bomb reaches (see DangerMap)
+                        along a path whose cells are not hit before the unit
+                        has passed them, waiting allowed; 0 when already safe,
+                        inf when there is no such path
+    can_escape          whether safe_distance is finite
+
+Other units are not treated as obstacles since they move every tick.
+"""
+class Reachability:
+    def __init__(self, observation: Observation):
+        self.width, self.height = observation['world']['width'], observation['world']['height']
+        self.stride = self.width + 1
+        self.danger_map = get_danger_map(observation)
+        self.unit_state = observation['unit_state']
+        index = self.danger_map.index
+
+        row = (1 << self.width) - 1
+        board = 0
+        for y in range(self.height):
+            board |= row << (y * self.stride)
+        blocked = 0
+        for type in MOVE_BLOCKING_TYPES:
+            for entity in index.of_type([type]):
+                blocked |= self.cell_bit((entity['x'], entity['y']))
+        self.walkable = board & ~blocked
+
+        danger_by_ticks: t.Dict[float, int] = collections.defaultdict(int)
+        for cell, ticks in self.danger_map.cell_ticks.items():
+            danger_by_ticks[ticks] |= self.cell_bit(cell)
+        # (ticks, cells hit within that many ticks) in increasing order of ticks
+        self._hit_within: t.List[t.Tuple[float, int]] = []
+        hit = 0
+        for ticks in sorted(danger_by_ticks):
+            hit |= danger_by_ticks[ticks]
+            self._hit_within.append((ticks, hit))
+        self.danger = hit
+
+        # Units in the same walkable area share its flood fill
+        self._areas: t.List[int] = []
+        self.units: t.Dict[str, UnitReachability] = {
+            unit_id: self._unit(unit['coordinates']) for unit_id, unit in observation['unit_state'].items()
+        }
+
+    def cell_bit(self, coords: Coordinate) -> int:
+        x, y = coords
+        return 1 << (y * self.stride + x)
+
+    def _grow(self, cells: int) -> int:
+        return cells | cells << 1 | cells >> 1 | cells << self.stride | cells >> self.stride
+
+    def _unit(self, coords: Coordinate) -> UnitReachability:
+        start = self.cell_bit(coords)
+        # a unit standing on its bomb can stay there
+        walkable = self.walkable | start
+
+        reachable = next((area for area in self._areas if area & start), None)
+        if reachable is None:
+            reachable = start
+            while True:
+                grown = self._grow(reachable) & walkable
+                if grown == reachable:
+                    break
+                reachable = grown
+            if start & self.walkable:
+                self._areas.append(reachable)
+
+        # Cells the unit can be in after `moves` ticks without having been hit; masks only
+        # get stricter with time, so once the set stops growing no safe cell is left to find
+        cells, moves, hit, next_hit = start, 0, 0, 0
+        safe_distance = math.inf
+        while cells:
+            if cells & ~self.danger:
+                safe_distance = moves
+                break
+            moves += 1
+            while next_hit < len(self._hit_within) and self._hit_within[next_hit][0] <= moves:
+                hit = self._hit_within[next_hit][1]
+                next_hit += 1
+            grown = self._grow(cells) & walkable & ~hit
+            if grown == cells:
+                break
+            cells = grown
+
+        return UnitReachability(
+            reachable=reachable,
+            reachable_count=bin(reachable).count("1"),
+            safe_distance=safe_distance,
+            can_escape=safe_distance < math.inf,
+        )
+
+    def unit(self, unit_id: str) -> UnitReachability:
+        return self.units[unit_id]
+
+    # A bitboard as an [x, y] grid like the ones of DangerMap
+    def to_grid(self, cells: int) -> np.ndarray:
+        n_bits = self.height * self.stride
+        packed = np.frombuffer(cells.to_bytes((n_bits + 7) // 8, 'little'), dtype=np.uint8)
+        bits = np.unpackbits(packed, count=n_bits, bitorder='little')
+        return bits.reshape(self.height, self.stride)[:, :self.width].T.astype(bool)
+
+    def reachable_grid(self, unit_id: str) -> np.ndarray:
+        return self.to_grid(self.units[unit_id].reachable)
+
+
+_reachability_cache = ObservationCache()
+
+"""
+Returns the reachability of all units of an observation, computing it on first
+use. Cached like get_danger_map, by the danger map it is built on and the
+unit states it starts from: observations may share their entities and tick
+but not where their units stand.
+"""
+def get_reachability(observation: Observation) -> Reachability:
+    danger_map = get_danger_map(observation)
+    unit_state = observation['unit_state']
+    key = (id(danger_map), id(unit_state))
+    reachability = _reachability_cache.get(key)
+    if reachability is not None and reachability.danger_map is danger_map and reachability.unit_state is unit_state:
+        return reachability
+
+    reachability = Reachability(observation)
+    _reachability_cache.put(key, reachability)
+    return reachability
@@ -0,0 +1,188 @@
+import collections
+import datetime
+import multiprocessing as mp
+import sys
+import typing as t
+
+import numpy as np
+import torch
+
+from components.environment.config import ACTIONS
+from components.environment.replay import find_replays, load_replay, replay_observations
+from components.reward import calculate_reward
+from components.state import STATE_ENCODINGS, compact_state_shape, compact_states
+from components.utils.dataset import DATASET_COLUMNS, ShardWriter
+from components.utils.log import get_logger
+
+log = get_logger("replay_dataset")
+
+"""
+Offline dataset of engine replays, for pretraining and behavior cloning:
+every replay is played back tick by tick (see replay_observations) and
+every unit alive at the start of a tick gives one transition, from the
+observation before the tick to the one after it, with the action the unit
+took (idle when it did nothing) and its reward. Transitions are terminal on
+the last tick and on the tick their unit dies. Usage:
+
+    python replay_dataset.py [replay files or directories...]
+"""
+
+REPLAY_PATHS = ["replay.json"] # replay files or directories of them, when none are given
+DATASET_DIR = "replay_dataset"
+STATE_ENCODING = "flat" # "flat" binary vectors for an MLP or "spatial" [C, H, W] planes for a CNN
+SHARD_SIZE = 100000 # transitions per shard
+COMPRESS_SHARDS = True
+NUM_WORKERS = 4 # processes replaying games, 0 replays them in this process
+REPLAYS_IN_FLIGHT = 2 # replays per worker being processed or waiting to be written
+LOG_EVERY = 100 # replays between progress records in the log
+
+IDLE_ACTION = ACTIONS.index("idle")
+
+
+def _init_worker():
+    # replays are processed in parallel already
+    torch.set_num_threads(1)
+
+
+"""
+The transitions of one replay as dataset columns (see DATASET_COLUMNS), with
+every observation encoded once per agent. `replays` is left to the caller.
+"""
+def replay_transitions(path: str, state_encoding: str = STATE_ENCODING) -> t.Tuple[t.Any, t.Dict[str, np.ndarray]]:
+    replay = load_replay(path)
+    encoding = STATE_ENCODINGS[state_encoding]
+    agents = replay["initial_state"]["agents"]
+    state_dim = encoding.dimensions(replay["initial_state"])
+    history = replay.get("history", [])
+    last_tick = history[-1]["tick"] if history else None
+
+    def encode(observation):
+        return {
+            agent_id: compact_states(encoding.encode_batch(observation, agent_id, agent["unit_ids"]), state_dim).numpy()
+            for agent_id, agent in agents.items()
+        }
+
+    rows = {column: [] for column in DATASET_COLUMNS if column != 'replays'}
+    steps = replay_observations(replay)
+    prev = next(steps)
+    prev_states = encode(prev.observation)
+    for step in steps:
+        next_states = encode(step.observation)
+        for agent_id, agent in agents.items():
+            for i, unit_id in enumerate(agent["unit_ids"]):
+                if prev.observation["unit_state"][unit_id]["hp"] <= 0:
+                    continue
+                reward = calculate_reward(prev.observation, step.observation, current_agent_id=agent_id, current_unit_id=unit_id)
+                rows['states'].append(prev_states[agent_id][i])
+                rows['actions'].append(step.actions.get(unit_id, IDLE_ACTION))
+                rows['rewards'].append(reward.item())
+                rows['next_states'].append(next_states[agent_id][i])
+                # a unit that dies has no later transitions to bootstrap from
+                rows['dones'].append(step.tick == last_tick or step.observation["unit_state"][unit_id]["hp"] <= 0)
+                rows['ticks'].append(step.tick)
+                rows['agent_ids'].append(agent_id)
+                rows['unit_ids'].append(unit_id)
+                rows['won'].append(agent_id == replay.get("winning_agent_id"))
+        prev, prev_states = step, next_states
+
+    state_shape = compact_state_shape(state_dim)
+    columns = {
+        'states': np.array(rows['states'], dtype=np.uint8).reshape(-1, *state_shape),
+        'actions': np.array(rows['actions'], dtype=np.int8),
+        'rewards': np.array(rows['rewards'], dtype=np.float32),
+        'dones': np.array(rows['dones'], dtype=bool),
+        'ticks': np.array(rows['ticks'], dtype=np.int32),
+        'agent_ids': np.array(rows['agent_ids'], dtype=str),
+        'unit_ids': np.array(rows['unit_ids'], dtype=str),
+        'won': np.array(rows['won'], dtype=bool),
+    }
+    columns['next_states'] = np.array(rows['next_states'], dtype=np.uint8).reshape(-1, *state_shape)
+    return state_dim, columns
+
+
+def _replay_transitions(path: str):
+    try:
+        return path, replay_transitions(path)
+    except Exception as error:
+        return path, error
+
+
+"""
+Results of `function` over `paths` in order, like Pool.imap, but with at most
+`in_flight` paths submitted and not yet consumed: imap hands every path to the
+workers up front, and their results pile up when the caller is slower.
+"""
+def _bounded_imap(pool, function, paths: t.Iterable[str], in_flight: int) -> t.Iterator:
+    pending = collections.deque()
+    for path in paths:
+        pending.append(pool.apply_async(function, (path,)))
+        if len(pending) >= in_flight:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+"""
+Replays the games under `paths` and writes their transitions to `directory`
+(see ShardWriter), keeping at most one shard and REPLAYS_IN_FLIGHT replays
+per worker in memory.
+Replays that cannot be read, or whose map does not match the first one's
+state dimensions, are skipped.
+"""
+def build_dataset(paths: t.Iterable[str], directory: str = DATASET_DIR, num_workers: int = NUM_WORKERS):
+    writer = ShardWriter(directory, SHARD_SIZE, COMPRESS_SHARDS)
+    replays, skipped, transitions, state_dim = [], 0, 0, None
+
+    pool = mp.get_context("spawn").Pool(num_workers, initializer=_init_worker) if num_workers > 0 else None
+    if pool is not None:
+        results = _bounded_imap(pool, _replay_transitions, find_replays(paths), num_workers * REPLAYS_IN_FLIGHT)
+    else:
+        results = map(_replay_transitions, find_replays(paths))
+    try:
+        for path, result in results:
+            if isinstance(result, Exception):
+                log.warning("replay_skipped", path=path, error=repr(result))
+                skipped += 1
+                continue
+            replay_state_dim, columns = result
+            if state_dim is None:
+                state_dim = replay_state_dim
+            elif replay_state_dim != state_dim:
+                log.warning("replay_skipped", path=path, error=f"state dimensions {replay_state_dim} instead of {state_dim}")
+                skipped += 1
+                continue
+            columns['replays'] = np.full(len(columns['actions']), len(replays), dtype=np.int32)
+            replays.append(path)
+            writer.add(columns)
+            transitions += len(columns['actions'])
+            if len(replays) % LOG_EVERY == 0:
+                log.info("progress", replays=len(replays), skipped=skipped, transitions=transitions)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    writer.close({
+        'state_encoding': STATE_ENCODING,
+        'state_dim': state_dim,
+        'actions': ACTIONS,
+        'replays': replays,
+    })
+    return writer, skipped
+
+
+def main():
+    paths = sys.argv[1:] or REPLAY_PATHS
+    print("============================================================================================")
+    print("Building replay dataset")
+    start_time = datetime.datetime.now().replace(microsecond=0)
+    print("Started at (GMT) : ", start_time)
+    writer, skipped = build_dataset(paths)
+    end_time = datetime.datetime.now().replace(microsecond=0)
+    print(f"Dataset: {writer.transitions} transitions in {len(writer.shards)} shards under {writer.directory}, {skipped} replays skipped")
+    print("Total time  : ", end_time - start_time)
+    print("============================================================================================")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import random
+import sys
+import typing as t
+
+from components.environment.config import ACTIONS
+from components.environment.local_forward_model import LocalForwardModel
+from components.environment.mocks import MOCK_15x15_INITIAL_OBSERVATION
+from components.environment.replay import load_replay, replay_observations, snapshot_observation
+from components.environment.state import GameState
+
+"""
+Checks the in-process forward model (LocalForwardModel) against the engine.
+
+Every tick of an engine replay is evaluated from the engine's state before
+it, with the unit actions the engine recorded for it, and the resulting
+entities and unit states are compared with the engine's. Powerups and
+ammunition spawned during the tick are left out and new stuns are compared
+by agent: they come from random rolls (spawns, drops of destroyed blocks,
+the unit a freeze powerup stuns) the two sides make differently.
+
+A game of random actions from MOCK_15x15_INITIAL_OBSERVATION then checks that
+the tick events the model returns, applied with GameState's handlers (as
+agents and replays do), lead to the state it returns. Usage:
+
+    python validate_forward_model.py [replay files...]
+
+Exits with status 1 when a tick does not match.
+"""
+
+REPLAY_PATHS = ["replay.json"] # replays checked when none are given
+RANDOM_GAME_TICKS = 300
+SEED = 0
+MAX_REPORTED_MISMATCHES = 10
+
+RANDOM_ENTITY_TYPES = set(("a", "bp", "fp"))
+
+
+def _entities(observation: t.Dict, tick: t.Optional[int]) -> t.Dict[t.Tuple[int, int], t.Dict]:
+    return {
+        (entity["x"], entity["y"]): entity
+        for entity in observation["entities"]
+        if not (entity["type"] in RANDOM_ENTITY_TYPES and entity.get("created") == tick)
+    }
+
+
+# Stun values set during the tick, by agent
+def _new_stuns(previous: t.Dict, observation: t.Dict) -> t.Dict[str, t.List[int]]:
+    stuns: t.Dict[str, t.List[int]] = {}
+    for unit_id, unit in observation["unit_state"].items():
+        if unit["stunned"] != previous["unit_state"][unit_id]["stunned"]:
+            stuns.setdefault(unit["agent_id"], []).append(unit["stunned"])
+    return {agent_id: sorted(values) for agent_id, values in stuns.items()}
+
+
+def _forward_actions(game_tick: t.Dict) -> t.List[t.Dict]:
+    return [
+        {"action": event["data"], "agent_id": event["agent_id"]}
+        for event in game_tick["events"] if event.get("type") == "unit"
+    ]
+
+
+"""
+Differences between two observations of the same tick, as readable lines.
+With the `previous` observation, a freeze powerup may stun any unit of the
+other agent: the stuns set during the tick are compared by agent and the
+units they were set on are compared without their `stunned`.
+"""
+def compare_observations(expected: t.Dict, actual: t.Dict, tick: t.Optional[int], previous: t.Optional[t.Dict] = None) -> t.List[str]:
+    mismatches = []
+    expected_entities, actual_entities = _entities(expected, tick), _entities(actual, tick)
+    for cell in sorted(set(expected_entities) | set(actual_entities)):
+        if expected_entities.get(cell) != actual_entities.get(cell):
+            mismatches.append(f"tick {tick}, entity at {cell}: expected {expected_entities.get(cell)}, got {actual_entities.get(cell)}")
+
+    restunned = set()
+    if previous is not None:
+        expected_stuns, actual_stuns = _new_stuns(previous, expected), _new_stuns(previous, actual)
+        if expected_stuns != actual_stuns:
+            mismatches.append(f"tick {tick}, stuns: expected {expected_stuns}, got {actual_stuns}")
+        restunned = set(
+            unit_id for state in (expected, actual) for unit_id, unit in state["unit_state"].items()
+            if unit["stunned"] != previous["unit_state"][unit_id]["stunned"]
+        )
+    for unit_id in sorted(set(expected["unit_state"]) | set(actual["unit_state"])):
+        expected_unit, actual_unit = expected["unit_state"].get(unit_id), actual["unit_state"].get(unit_id)
+        if unit_id in restunned:
+            expected_unit = {key: value for key, value in expected_unit.items() if key != "stunned"}
+            actual_unit = {key: value for key, value in actual_unit.items() if key != "stunned"}
+        if expected_unit != actual_unit:
+            mismatches.append(f"tick {tick}, unit {unit_id}: expected {expected_unit}, got {actual_unit}")
+    return mismatches
+
+
+"""
+Evaluates every tick of a replay from the engine's previous state and
+returns the mismatches and the number of ticks checked.
+"""
+def check_replay(replay: t.Dict, fwd: LocalForwardModel) -> t.Tuple[t.List[str], int]:
+    game_ticks = {game_tick["tick"]: game_tick for game_tick in replay.get("history", [])}
+    steps = replay_observations(replay)
+    prev = next(steps)
+    mismatches, ticks, result = [], 0, None
+    for step in steps:
+        game_tick = game_ticks.get(step.tick, {"tick": step.tick, "events": []})
+        result = fwd.evaluate_next_state(prev.observation, _forward_actions(game_tick))
+        if result["tick_result"]["tick"] != step.tick:
+            mismatches.append(f"tick {step.tick}: evaluated tick {result['tick_result']['tick']}")
+        mismatches.extend(compare_observations(step.observation, result["next_state"], step.tick, prev.observation))
+        prev, ticks = step, ticks + 1
+    if result is not None and replay.get("winning_agent_id") is not None and not result["is_complete"]:
+        mismatches.append(f"tick {prev.tick}: the engine ended the game, the forward model did not")
+    return mismatches, ticks
+
+
+def _random_actions(observation: t.Dict, rng: random.Random) -> t.List[t.Dict]:
+    actions = []
+    for agent_id, agent in observation["agents"].items():
+        for unit_id in agent["unit_ids"]:
+            action = rng.choice(ACTIONS)
+            if action in ("up", "down", "left", "right"):
+                packet = {"type": "move", "move": action, "unit_id": unit_id}
+            elif action == "bomb":
+                packet = {"type": "bomb", "unit_id": unit_id}
+            elif action == "detonate":
+                bombs = [entity for entity in observation["entities"] if entity["type"] == "b" and entity.get("unit_id") == unit_id]
+                if not bombs:
+                    continue
+                packet = {"type": "detonate", "coordinates": [bombs[0]["x"], bombs[0]["y"]], "unit_id": unit_id}
+            else:
+                continue
+            actions.append({"action": packet, "agent_id": agent_id})
+    return actions
+
+
+"""
+Plays random actions from `initial_state` and checks after every tick that
+applying the returned events to the previous state gives the returned state.
+"""
+def check_tick_events(initial_state: t.Dict, fwd: LocalForwardModel, ticks: int, rng: random.Random) -> t.Tuple[t.List[str], int]:
+    game_state = GameState(None)
+    game_state.set_state({**initial_state, "unit_state": dict(initial_state["unit_state"])})
+    observation = initial_state
+    mismatches = []
+    for tick in range(ticks):
+        result = fwd.evaluate_next_state(observation, _random_actions(observation, rng))
+        game_state.apply_tick(result["tick_result"])
+        observation = result["next_state"]
+        replayed = snapshot_observation(game_state.state)
+        # spawned entities come from the events too, nothing is left out here
+        mismatches.extend(compare_observations(observation, replayed, tick=None))
+        if result["is_complete"]:
+            return mismatches, tick + 1
+    return mismatches, ticks
+
+
+def main():
+    paths = sys.argv[1:] or REPLAY_PATHS
+    fwd = LocalForwardModel(SEED)
+    failed = False
+    for path in paths:
+        mismatches, ticks = check_replay(load_replay(path), fwd)
+        print(f"{path}: {ticks} ticks, {len(mismatches)} mismatches")
+        for mismatch in mismatches[:MAX_REPORTED_MISMATCHES]:
+            print(f"    {mismatch}")
+        failed |= bool(mismatches)
+
+    mismatches, ticks = check_tick_events(MOCK_15x15_INITIAL_OBSERVATION, fwd, RANDOM_GAME_TICKS, random.Random(SEED))
+    print(f"Random game from MOCK_15x15_INITIAL_OBSERVATION: {ticks} ticks, {len(mismatches)} mismatches between tick events and states")
+    for mismatch in mismatches[:MAX_REPORTED_MISMATCHES]:
+        print(f"    {mismatch}")
+    failed |= bool(mismatches)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()